@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Move feature counts out of the Feature entries of the Tesserae database
+
+Databases built before feature counts were stored as FeatureCounts entries
+keep the counts of every text in the Feature entries. This gathers them into
+FeatureCounts entries and takes them out of the Feature entries. It only has
+to be run once per database, but running it again does no harm.
+
+The database credentials file must contain a JSON object with the following
+attributes and values:
+    * "user": user to access the database as
+    * "password": password to use in accessing the database
+    * "host": the host name or IP address of the MongoDB database
+    * "port": the port number that the database listens on
+    * "database": the name of the database to access
+NEVER COMMIT THE DATABASE CREDENTIALS FILE TO GIT!
+
+An example database credentials file would contain the following JSON object:
+{
+    "user": "me",
+    "password": "no_one_will_guess_this",
+    "host": "127.0.0.1",
+    "port": 27017,
+    "database": "tesserae"
+}
+"""
+import argparse
+import json
+
+from tesserae.db import TessMongoConnection
+from tesserae.utils.freqcache import migrate_feature_counts
+
+
+def parse_args(args=None):
+    p = argparse.ArgumentParser(
+        prog='tesserae.cli.migrate_feature_counts',
+        description=('Move feature counts out of Feature entries into '
+                     'FeatureCounts entries'))
+
+    p.add_argument(
+        'db_cred',
+        type=str,
+        help=('path to database credentials file (see '
+              'migrate_feature_counts.py for details)'))
+
+    return p.parse_args(args)
+
+
+def main():
+    args = parse_args()
+
+    with open(args.db_cred) as ifh:
+        db_cred = json.load(ifh)
+
+    conn = TessMongoConnection(db_cred['host'],
+                               db_cred['port'],
+                               db_cred['user'],
+                               db_cred['password'],
+                               db=db_cred['database'])
+
+    created = migrate_feature_counts(conn)
+    print(f'Created {created} FeatureCounts entries')
+
+
+if __name__ == '__main__':
+    main()
@@ -105,6 +105,17 @@ def parse_args(args=None):
                         type=int,
                         default=0,
                         help='lowest scoring match to keep')
+    search.add_argument('--max-feature-share',
+                        type=float,
+                        default=None,
+                        help=('leave out features found in more than this '
+                              'share of the units'))
+
+    search.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help=('number of processes to match with; 0 uses '
+                              'every available core'))
 
     search.add_argument('--output',
                         type=str,
@@ -171,7 +182,8 @@ def main():
             'freq_basis': args.freq_basis,
             'max_distance': args.max_distance,
             'distance_basis': args.distance_basis,
-            'min_score': args.min_score
+            'min_score': args.min_score,
+            'max_feature_share': args.max_feature_share
         }
     }
     results_id = check_cache(connection, parameters['source'],
@@ -195,7 +207,9 @@ def main():
             'freq_basis': parameters['method']['freq_basis'],
             'max_distance': parameters['method']['max_distance'],
             'distance_basis': parameters['method']['distance_basis'],
-            'min_score': parameters['method']['min_score']
+            'min_score': parameters['method']['min_score'],
+            'max_feature_share': parameters['method']['max_feature_share'],
+            'workers': args.workers
         }
         _run_search(connection, search, SparseMatrixSearch.matcher_type,
                     search_params)
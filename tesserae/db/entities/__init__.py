@@ -1,5 +1,7 @@
 from .entity import Entity
+from .allpairsrow import AllPairsRow
 from .feature import Feature
+from .featurecounts import FeatureCounts
 from .match import Match
 from .multiresult import MultiResult
 from .search import Search
@@ -11,7 +13,9 @@ from .translation import Translation
 from .vector import Vector
 
 entity_map = {}
+entity_map[AllPairsRow.collection] = AllPairsRow
 entity_map[Feature.collection] = Feature
+entity_map[FeatureCounts.collection] = FeatureCounts
 entity_map[Match.collection] = Match
 entity_map[MultiResult.collection] = MultiResult
 entity_map[Search.collection] = Search
@@ -22,5 +26,6 @@ entity_map[Unit.collection] = Unit
 entity_map[Translation.collection] = Translation
 entity_map[Vector.collection] = Vector
 
-__all__ = ['Entity', 'Feature', 'Match', 'MultiResult', 'Search',
-           'Text', 'Token', 'Unit', 'Translation', 'Vector']
+__all__ = ['AllPairsRow', 'Entity', 'Feature', 'FeatureCounts', 'Match',
+           'MultiResult', 'Search', 'Text', 'Token', 'Unit', 'Translation',
+           'Vector']
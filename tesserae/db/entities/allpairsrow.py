@@ -0,0 +1,64 @@
+"""Database standardization for the rows of an all-pairs job.
+
+Classes
+-------
+AllPairsRow
+    Data model for the pairs sharing a source in an all-pairs job.
+"""
+import typing
+
+from tesserae.db.entities.entity import Entity
+
+
+class AllPairsRow(Entity):
+    """Data model for the pairs sharing a source in an all-pairs job.
+
+    An all-pairs job is made up of a pair for every ordered pair of texts in
+    a language, too many to be kept in the job's Search entry. The pairs are
+    stored instead a row at a time, each row holding the pairs searched from
+    one source text.
+
+    Parameters
+    ----------
+    id : bson.objectid.ObjectId, optional
+        Database id of the entry. Should not be set locally.
+    all_pairs_id : str, optional
+        UUID of the all-pairs job the row belongs to.
+    index : int, optional
+        Position of the row among the rows of the job.
+    source : dict, optional
+        The source of every pair in the row, as found in the parameters of a
+        Search.
+    row_id : str, optional
+        UUID of the search submitted for the pairs of the row which had not
+        been searched before, if there were any.
+    pairs : list of dict
+        One dictionary per pair, with the keys 'target' (as found in the
+        parameters of a Search) and 'results_id' (of the search for the
+        pair).
+    """
+
+    collection = 'all_pairs_rows'
+
+    def __init__(self,
+                 id=None,
+                 all_pairs_id=None,
+                 index=None,
+                 source=None,
+                 row_id=None,
+                 pairs=None):
+        super(AllPairsRow, self).__init__(id=id)
+        self.all_pairs_id: typing.Optional[str] = all_pairs_id
+        self.index: typing.Optional[int] = index
+        self.source: typing.Optional[typing.Dict[str, typing.Any]] = source
+        self.row_id: typing.Optional[str] = row_id
+        self.pairs: typing.List[typing.Dict[str, typing.Any]] = \
+            pairs if pairs is not None else []
+
+    def unique_values(self):
+        return {'all_pairs_id': self.all_pairs_id, 'index': self.index}
+
+    def __repr__(self):
+        return (f'AllPairsRow(all_pairs_id={self.all_pairs_id}, '
+                f'index={self.index}, source={self.source}, '
+                f'row_id={self.row_id}, pairs={self.pairs})')
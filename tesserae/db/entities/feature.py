@@ -30,7 +30,14 @@ class Feature(Entity):
     token : str, optional
         The string representation of the feature.
     frequencies : dict
-        Mapping of frequency data per text.
+        Mapping of frequency data per text, tallied while texts are
+        processed. It is only kept in memory, to be handed to
+        tesserae.utils.freqcache.register_feature_counts, which stores the
+        tallies of the newly processed text as
+        tesserae.db.entities.FeatureCounts entries; it is never written with
+        the Feature. Older databases whose Feature entries still hold
+        frequencies are moved over by
+        tesserae.utils.freqcache.migrate_feature_counts.
     semantic : ObjectId or tesserae.db.entities.Feature
         Semantic data tied to the form or lemma.
     sound : ObjectId or tesserae.db.entities.Feature
@@ -54,6 +61,11 @@ class Feature(Entity):
         self.frequencies: typing.Dict[ObjectId, int] = \
             frequencies if frequencies is not None else {}
 
+    def json_encode(self, exclude=None):
+        exclude = exclude if exclude is not None else []
+        return super(Feature, self).json_encode(
+            exclude=exclude + ['frequencies'])
+
     def unique_values(self):
         return {
             'language': self.language,
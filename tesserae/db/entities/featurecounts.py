@@ -0,0 +1,63 @@
+"""Database standardization for per-text feature counts.
+
+Classes
+-------
+FeatureCounts
+    Data model for the feature counts of a text.
+"""
+import typing
+
+from bson.objectid import ObjectId
+
+from tesserae.db.entities.entity import Entity
+
+
+class FeatureCounts(Entity):
+    """Data model for the feature counts of a text.
+
+    Each text has one FeatureCounts entry per feature type, recording how
+    many times each feature of that type was found in the text. Keeping
+    these apart from the Feature entries means that ingesting a text adds
+    entries of its own instead of rewriting every Feature it touches.
+
+    Parameters
+    ----------
+    id : bson.objectid.ObjectId, optional
+        Database id of the entry. Should not be set locally.
+    text : bson.objectid.ObjectId, optional
+        Database id of the text that was counted.
+    language : str, optional
+        Language of the text.
+    feature : str, optional
+        The type of feature counted.
+    indices : list of int
+        Indices of the features found in the text.
+    counts : list of int
+        ``counts[i]`` is how many times the feature with index ``indices[i]``
+        was found in the text.
+    """
+
+    collection = 'feature_counts'
+
+    def __init__(self,
+                 id=None,
+                 text=None,
+                 language=None,
+                 feature=None,
+                 indices=None,
+                 counts=None):
+        super(FeatureCounts, self).__init__(id=id)
+        self.text: typing.Optional[ObjectId] = text
+        self.language: typing.Optional[str] = language
+        self.feature: typing.Optional[str] = feature
+        self.indices: typing.List[int] = \
+            indices if indices is not None else []
+        self.counts: typing.List[int] = counts if counts is not None else []
+
+    def unique_values(self):
+        return {'text': self.text, 'feature': self.feature}
+
+    def __repr__(self):
+        return (f'FeatureCounts(text={self.text}, language={self.language}, '
+                f'feature={self.feature}, indices={self.indices}, '
+                f'counts={self.counts})')
@@ -205,8 +205,9 @@ class TessMongoConnection():
 
         Parameters
         ----------
-        entity : tesserae.db.entities.Entity or list of Entity
-            The entities to insert into the database.
+        entity : tesserae.db.entities.Entity or iterable of Entity
+            The entities to insert into the database; any iterable which
+            produces entities (such as a MatchTable) is accepted.
 
         Raises
         ------
@@ -214,8 +215,10 @@ class TessMongoConnection():
             Raised when provided entity could not be inserted
 
         """
-        if not isinstance(entity, list):
+        if isinstance(entity, tesserae.db.entities.Entity):
             entity = [entity]
+        elif not isinstance(entity, list):
+            entity = list(entity)
 
         try:
             collection = self.connection[entity[0].__class__.collection]
@@ -500,6 +503,12 @@ class TessMongoConnection():
         ])
         self.connection[tesserae.db.entities.MultiResult.
                         collection].create_index('match_id')
+        # index AllPairsRow entities by all-pairs job, in order
+        self.connection[tesserae.db.entities.AllPairsRow.
+                        collection].create_index([
+                            ('all_pairs_id', pymongo.ASCENDING),
+                            ('index', pymongo.ASCENDING),
+                        ])
 
     def drop_indices(self):
         """Drops all indices
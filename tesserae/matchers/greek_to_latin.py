@@ -1,17 +1,19 @@
 """Match Greek units to Latin units"""
 from collections import defaultdict
+import itertools
 
 import numpy as np
 from scipy.sparse import csr_matrix
 
 from tesserae.data import load_greek_to_latin
-from tesserae.db.entities import Feature, Match
+from tesserae.db.entities import Feature
+from tesserae.matchers.match_table import MatchTable
 from tesserae.matchers.sparse_encoding import \
-    _get_units, _inverse_averaged_freq_getter, _lookup_wrapper, \
-    gen_hits2positions, _get_distance_by_span, _get_distance_by_least_frequency
-from tesserae.utils.calculations import \
-    get_corpus_frequencies, get_feature_counts_by_text, \
-    get_inverse_text_frequencies
+    _append_scored, _averaged_inverse_frequency_table, _flatten_units, \
+    _get_units, _score_batch, gen_hits2positions
+from tesserae.utils.calculations import count_matching_tokens
+from tesserae.utils.freqcache import inverse_frequency_table, \
+    load_corpus_frequencies, load_inverse_frequencies
 from tesserae.utils.retrieve import TagHelper
 from tesserae.utils.stopwords import get_feature_indices
 
@@ -130,7 +132,10 @@ class GreekToLatinSearch:
               freq_basis='texts',
               max_distance=10,
               distance_basis='frequency',
-              min_score=6):
+              min_score=6,
+              workers=1,
+              spill_rows=None,
+              memory_budget=None):
         """Find matches between a Greek text and a Latin text
 
         Texts will contain lines or phrases with matching tokens, with varying
@@ -160,6 +165,16 @@ class GreekToLatinSearch:
         min_score : float
             The minimum score a match must have in order to be returned as a
             result
+        workers : int
+            How many processes to use for matching. 0 or less uses one process
+            per available core. Results do not depend on this setting.
+        spill_rows : int, optional
+            If given, matches are written to disk in sorted runs of about this
+            many rows; see ``tesserae.matchers.match_table.MatchTable``.
+        memory_budget : int, optional
+            How many bytes the sparse matrix products of the search may take
+            up at once; see
+            ``tesserae.matchers.sparse_encoding.SparseMatrixSearch.match()``.
 
         Raises
         ------
@@ -194,98 +209,43 @@ class GreekToLatinSearch:
 
         tag_helper = TagHelper(self.connection, [source.text, target.text])
 
-        greek_inv_frequencies_getter = _get_inv_greek_to_latin_freq_getter(
+        greek_inv_freq_table = _get_inv_greek_to_latin_freq_table(
             self.connection, freq_basis, source, greek_units,
             greek_ind_to_other_greek_inds)
-        latin_inv_frequencies_getter = _get_inv_lemmata_freq_getter(
+        latin_inv_freq_table = _get_inv_lemmata_freq_table(
             self.connection, freq_basis, target, latin_units)
 
-        search_id = search.id
-
-        match_ents = []
-        numerator_sparse_rows = []
-        numerator_sparse_cols = []
-        numerator_sparse_data = []
-        denominators = []
-        for greek_ind, latin_ind, positions in _gen_greek_to_latin_matches(
+        # matched features are looked for among the translations of every
+        # Greek feature, stopwords included, as they are in Latin
+        latinized_features, _ = make_latinized_greek_matrix(
+            greek_units, greek_features, set(), self.greek_to_latin,
+            valid_latin_tokens_to_indices, len(latin_features))
+        greek_breaks, greek_forms = _flatten_units(greek_units)[:2]
+        greek_arrays = (greek_breaks, greek_forms, latinized_features.indptr,
+                        latinized_features.indices)
+        latin_arrays = _flatten_units(latin_units)
+        greek_inv_freqs = greek_inv_freq_table[greek_forms]
+        latin_inv_freqs = latin_inv_freq_table[latin_arrays[1]]
+        latin_stoplist = np.array(sorted(latin_stoplist_set), dtype=np.int64)
+
+        match_table = MatchTable(search.id, greek_units, latin_units,
+                                 latin_features, tag_helper, spill_rows)
+        for hits in _gen_greek_to_latin_hits(
                 search, self.connection, greek_units, greek_features,
                 greek_stoplist_set, self.greek_to_latin,
                 valid_latin_tokens_to_indices, latin_units, latin_features,
-                latin_stoplist_set):
-            greek_unit = greek_units[greek_ind]
-            latin_unit = latin_units[latin_ind]
-            greek_forms = np.array(greek_unit['forms'])
-            latin_forms = np.array(latin_unit['forms'])
-            greek_positions = positions[:, 0]
-            latin_positions = positions[:, 1]
-            if distance_basis == 'span':
-                greek_distance = _get_distance_by_span(greek_positions,
-                                                       greek_forms)
-                latin_distance = _get_distance_by_span(latin_positions,
-                                                       latin_forms)
-            else:
-                greek_distance = _get_distance_by_least_frequency(
-                    greek_inv_frequencies_getter, greek_positions, greek_forms)
-                latin_distance = _get_distance_by_least_frequency(
-                    latin_inv_frequencies_getter, latin_positions, latin_forms)
-            if greek_distance <= 0 or latin_distance <= 0:
-                continue
-            distance = greek_distance + latin_distance
-            if distance <= max_distance:
-                matched_greek_to_latin_features = \
-                    _get_matched_greek_to_latin_features(
-                        greek_unit['features'], greek_positions,
-                        greek_features, self.greek_to_latin,
-                        valid_latin_tokens_to_indices
-                    )
-                matched_latin_features = [
-                    latin_unit['features'][latin_pos]
-                    for latin_pos in latin_positions
-                ]
-                match_features = _get_match_features(
-                    matched_greek_to_latin_features, matched_latin_features,
-                    latin_stoplist_set)
-                if match_features:
-                    match_inv_frequencies = [
-                        greek_inv_frequencies_getter(greek_forms[pos])
-                        for pos in set(greek_positions)
-                    ]
-                    match_inv_frequencies.extend([
-                        latin_inv_frequencies_getter(latin_forms[pos])
-                        for pos in set(latin_positions)
-                    ])
-                    numerator_sparse_rows.extend([len(match_ents)] *
-                                                 len(match_inv_frequencies))
-                    numerator_sparse_cols.extend(
-                        [i for i in range(len(match_inv_frequencies))])
-                    numerator_sparse_data.extend(match_inv_frequencies)
-                    denominators.append(distance)
-                    match_ents.append(
-                        Match(search_id=search_id,
-                              source_unit=greek_unit['_id'],
-                              target_unit=latin_unit['_id'],
-                              source_tag=tag_helper.get_display_tag(
-                                  greek_unit['text'], greek_unit['tags']),
-                              target_tag=tag_helper.get_display_tag(
-                                  latin_unit['text'], latin_unit['tags']),
-                              matched_features=[
-                                  latin_features[int(mf)].token
-                                  for mf in match_features
-                              ],
-                              source_snippet=greek_unit['snippet'],
-                              target_snippet=latin_unit['snippet'],
-                              highlight=[(int(greek_pos), int(latin_pos))
-                                         for greek_pos, latin_pos in zip(
-                                             greek_positions, latin_positions)
-                                         ]))
-        if match_ents:
-            numerators = csr_matrix((numerator_sparse_data,
-                                     (numerator_sparse_rows,
-                                      numerator_sparse_cols))).sum(axis=-1).A1
-            scores = np.log(numerators) - np.log(denominators)
-            for match, score in zip(match_ents, scores):
-                match.score = score
-        return match_ents
+                latin_stoplist_set, workers, memory_budget):
+            greek_inds, latin_inds, offsets, greek_positions, \
+                latin_positions = hits
+            # Greek units are the source of the match table
+            hits = (latin_inds, greek_inds, offsets, latin_positions,
+                    greek_positions)
+            scored = _score_batch(hits, latin_arrays, greek_arrays,
+                                  latin_inv_freqs, greek_inv_freqs,
+                                  latin_stoplist, distance_basis,
+                                  max_distance)
+            _append_scored(match_table, hits, scored)
+        return match_table
 
 
 def _reverse_mapping(a2bs):
@@ -316,128 +276,129 @@ def _build_greek_ind_to_other_greek_inds(conn, greek_to_latin):
     return result
 
 
-def _get_inv_lemmata_freq_getter(conn, freq_basis, text_options, latin_units):
+def _get_inv_lemmata_freq_table(conn, freq_basis, text_options, latin_units):
     if freq_basis != 'texts':
-        return _inverse_averaged_freq_getter(
-            get_corpus_frequencies(conn, 'lemmata',
-                                   text_options.text.language), latin_units)
-    return _lookup_wrapper(
-        get_inverse_text_frequencies(conn, 'lemmata', text_options.text.id))
+        return _averaged_inverse_frequency_table(
+            load_corpus_frequencies(conn, 'lemmata',
+                                   text_options.text.language), [latin_units])
+    return load_inverse_frequencies(conn, 'lemmata', text_options.text.id)
 
 
 def _get_greek_to_latin_inv_freqs_by_text(conn, text_options, text_length,
                                           greek_ind_to_other_greek_inds):
-    greek_lemma_counts = get_feature_counts_by_text(conn, 'lemmata',
-                                                    text_options.text)
-    result = {}
-    for greek_form_ind, greek_counts in greek_lemma_counts.items():
-        already_seen = set([greek_form_ind])
-        value = greek_counts
-        for other_greek_ind in greek_ind_to_other_greek_inds[greek_form_ind]:
-            if other_greek_ind in already_seen:
-                continue
-            value += greek_lemma_counts[other_greek_ind]
-            already_seen.add(other_greek_ind)
-        if value > 0:
-            result[greek_form_ind] = float(text_length) / float(value)
-    return result
-
-
-def _get_inv_greek_to_latin_freq_getter(conn, freq_basis, text_options,
-                                        greek_units,
-                                        greek_ind_to_other_greek_inds):
+    word_types, greek_lemma_counts, _ = count_matching_tokens(
+        conn, 'lemmata', text_options.text.id)
+    # every word type counts itself and each of the other Greek words
+    # sharing a Latin translation with it (once, however often it is listed)
+    others = [
+        greek_ind_to_other_greek_inds.get(greek_form_ind, ())
+        for greek_form_ind in word_types.tolist()
+    ]
+    other_rows = np.repeat(np.arange(len(word_types)),
+                           [len(o) for o in others])
+    other_inds = np.fromiter(itertools.chain.from_iterable(others),
+                             dtype=np.int64, count=len(other_rows))
+    other_cols = np.searchsorted(word_types, other_inds)
+    # words not found in the text have nothing to add
+    found = other_cols < len(word_types)
+    found[found] = word_types[other_cols[found]] == other_inds[found]
+    self_inds = np.arange(len(word_types))
+    related_words_matrix = csr_matrix(
+        (np.ones(len(self_inds) + np.count_nonzero(found), dtype=bool),
+         (np.concatenate([self_inds, other_rows[found]]),
+          np.concatenate([self_inds, other_cols[found]]))),
+        shape=(len(word_types), len(word_types)))
+    values = related_words_matrix.dot(greek_lemma_counts)
+    keep = values > 0
+    return dict(
+        zip(word_types[keep].tolist(),
+            (float(text_length) / values[keep]).tolist()))
+
+
+def _get_inv_greek_to_latin_freq_table(conn, freq_basis, text_options,
+                                       greek_units,
+                                       greek_ind_to_other_greek_inds):
     if freq_basis != 'texts':
-        return _inverse_averaged_freq_getter(
-            get_corpus_frequencies(conn, 'lemmata',
-                                   text_options.text.language), greek_units)
+        return _averaged_inverse_frequency_table(
+            load_corpus_frequencies(conn, 'lemmata',
+                                   text_options.text.language), [greek_units])
     # otherwise, handle text case
-    text_length = sum(len(u['forms']) for u in greek_units)
-    return _lookup_wrapper(
+    text_length = len(_flatten_units(greek_units)[1])
+    return inverse_frequency_table(
         _get_greek_to_latin_inv_freqs_by_text(conn, text_options, text_length,
                                               greek_ind_to_other_greek_inds))
 
 
+def _make_translation_matrix(greek_features, greek_stoplist_set,
+                             greek_to_latin, valid_latin_tokens_to_indices,
+                             latin_features_size):
+    """Map every Greek feature to the Latin features it translates to
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix of bool
+        ``matrix[g, l]`` is True when the Greek feature with index g is not a
+        stopword and translates to the (valid) Latin feature with index l
+    """
+    rows = []
+    cols = []
+    for greek_ind, greek_feature in enumerate(greek_features):
+        if greek_ind in greek_stoplist_set or \
+                greek_feature.token not in greek_to_latin:
+            continue
+        latin_inds = [
+            valid_latin_tokens_to_indices[latin_token]
+            for latin_token in greek_to_latin[greek_feature.token]
+            if latin_token in valid_latin_tokens_to_indices
+        ]
+        rows.extend([greek_ind] * len(latin_inds))
+        cols.extend(latin_inds)
+    return csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, cols)),
+        shape=(len(greek_features), latin_features_size))
+
+
 def make_latinized_greek_matrix(greek_units, greek_features,
                                 greek_stoplist_set, greek_to_latin,
                                 valid_latin_tokens_to_indices,
                                 latin_features_size):
-    latin_feature_inds = []
-    pos_inds = []
-    break_inds = [0]
-    for unit in greek_units:
-        end_break_inds = break_inds[-1]
-        cur_features = unit['features']
-        for i, features in enumerate(cur_features):
-            valid_greek_features = [
-                f for f in features if f not in greek_stoplist_set and f >= 0
-            ]
-            translated_tokens = [
-                greek_to_latin[greek_features[f].token]
-                for f in valid_greek_features
-                if greek_features[f].token in greek_to_latin
-            ]
-            valid_latin_features = [
-                valid_latin_tokens_to_indices[latin_token]
-                for translations in translated_tokens
-                for latin_token in translations
-                if latin_token in valid_latin_tokens_to_indices
-            ]
-            latin_feature_inds.extend(valid_latin_features)
-            pos_inds.extend([end_break_inds + i] * len(valid_latin_features))
-        break_inds.append(end_break_inds + len(cur_features))
-    return (csr_matrix(
-        (np.ones(len(pos_inds), dtype=np.bool),
-         (pos_inds, latin_feature_inds)),
-        shape=(break_inds[-1], latin_features_size)), np.array(break_inds))
-
-
-def _gen_greek_to_latin_matches(search, conn, greek_units, greek_features,
-                                greek_stoplist_set, greek_to_latin,
-                                valid_latin_tokens_to_indices, latin_units,
-                                latin_features, latin_stoplist_set):
+    breaks, _, feature_breaks, feature_inds = _flatten_units(greek_units)
+    positions = np.repeat(np.arange(breaks[-1]), np.diff(feature_breaks))
+    valid = feature_inds >= 0
+    greek_feature_matrix = csr_matrix(
+        (np.ones(np.count_nonzero(valid), dtype=bool),
+         (positions[valid], feature_inds[valid])),
+        shape=(breaks[-1], len(greek_features)))
+    # a position has a Latin feature when any of its Greek features
+    # translates to it
+    latinized_greek_matrix = greek_feature_matrix.dot(
+        _make_translation_matrix(greek_features, greek_stoplist_set,
+                                 greek_to_latin,
+                                 valid_latin_tokens_to_indices,
+                                 latin_features_size))
+    latinized_greek_matrix.eliminate_zeros()
+    return latinized_greek_matrix, np.asarray(breaks)
+
+
+def _gen_greek_to_latin_hits(search, conn, greek_units, greek_features,
+                             greek_stoplist_set, greek_to_latin,
+                             valid_latin_tokens_to_indices, latin_units,
+                             latin_features, latin_stoplist_set, workers=1,
+                             memory_budget=None):
+    """Generate batches of Greek and Latin units sharing Latin features
+
+    Yields
+    ------
+    tuple of 1d np.array of ints
+        ``(greek_inds, latin_inds, offsets, greek_positions,
+        latin_positions)`` for one batch of Latin units; see
+        ``tesserae.matchers.sparse_encoding.gen_hits2positions()``
+    """
     latinized_greek_matrix, greek_break_inds = make_latinized_greek_matrix(
         greek_units, greek_features, greek_stoplist_set, greek_to_latin,
         valid_latin_tokens_to_indices, len(latin_features))
 
-    for hits2positions in gen_hits2positions(search, conn,
-                                             latinized_greek_matrix,
-                                             greek_break_inds, latin_units,
-                                             latin_stoplist_set,
-                                             len(latin_features)):
-        overhits2positions = {
-            k: np.array(v)
-            for k, v in hits2positions.items() if len(v) >= 2
-        }
-        for (t_ind, s_ind), positions in overhits2positions.items():
-            yield (t_ind, s_ind, positions)
-
-
-def _get_matched_greek_to_latin_features(greek_unit_features, greek_positions,
-                                         greek_features, greek_to_latin,
-                                         valid_latin_tokens_to_indices):
-    result = []
-    for greek_pos in greek_positions:
-        greek_features_by_pos = greek_unit_features[greek_pos]
-        cur_pos_latin_features = []
-        for greek_feature_index in greek_features_by_pos:
-            greek_token = greek_features[greek_feature_index].token
-            if greek_token in greek_to_latin:
-                translations = greek_to_latin[greek_token]
-                for latin_token in translations:
-                    if latin_token in valid_latin_tokens_to_indices:
-                        cur_pos_latin_features.append(
-                            valid_latin_tokens_to_indices[latin_token])
-        result.append(cur_pos_latin_features)
-    return result
-
-
-def _get_match_features(matched_greek_to_latin_features,
-                        matched_latin_features, latin_stoplist_set):
-    result = set()
-    for features_by_pos1, features_by_pos2 in \
-            zip(matched_greek_to_latin_features, matched_latin_features):
-        features_in_both = set(features_by_pos1).intersection(
-            set(features_by_pos2))
-        for feature in features_in_both:
-            result.add(feature)
-    return result - latin_stoplist_set
+    yield from gen_hits2positions(search, conn, latinized_greek_matrix,
+                                  greek_break_inds, latin_units,
+                                  latin_stoplist_set, len(latin_features),
+                                  workers, memory_budget)
@@ -0,0 +1,451 @@
+"""Columnar storage for the matches found by a search
+
+Classes
+-------
+MatchTable
+    Matches held as numpy arrays, turned into Match entities on demand.
+"""
+import heapq
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from tesserae.db.entities import Match
+
+
+def _unit_column(units, key):
+    """Collect one piece of information from every unit
+
+    Parameters
+    ----------
+    units : list of dict or tesserae.utils.unitcache.CompiledUnits
+    key : str
+
+    Returns
+    -------
+    list
+    """
+    if hasattr(units, 'column'):
+        return units.column(key)
+    return [u[key] for u in units]
+
+
+def _unit_columns(units, tag_helper):
+    """Gather what the Matches of a table need from every unit
+
+    Display tags are rendered here, once per unit, so that building a Match
+    only has to look them up.
+
+    Parameters
+    ----------
+    units : list of dict or tesserae.utils.unitcache.CompiledUnits
+    tag_helper : tesserae.utils.retrieve.TagHelper
+
+    Returns
+    -------
+    dict
+        the lists '_id', 'display_tag' and 'snippet', indexed by unit
+    """
+    return {
+        '_id': _unit_column(units, '_id'),
+        'display_tag': [
+            tag_helper.get_display_tag(text_id, tags)
+            for text_id, tags in zip(_unit_column(units, 'text'),
+                                     _unit_column(units, 'tags'))
+        ],
+        'snippet': _unit_column(units, 'snippet')
+    }
+
+
+def _take_segments(offsets, values, rows):
+    """Gather the segments of ``rows`` into new contiguous arrays
+
+    Parameters
+    ----------
+    offsets : 1d np.array of int
+        ``values[j][offsets[k]:offsets[k+1]]`` belongs to row k
+    values : list of 1d np.array
+        arrays sharing ``offsets``
+    rows : 1d np.array of int
+        the rows to keep, in the order in which they should appear
+
+    Returns
+    -------
+    offsets : 1d np.array of int
+    values : list of 1d np.array
+    """
+    sizes = offsets[1:][rows] - offsets[:-1][rows]
+    new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=new_offsets[1:])
+    owners = np.repeat(np.arange(len(rows)), sizes)
+    indices = np.arange(new_offsets[-1]) - new_offsets[owners] + \
+        offsets[:-1][rows][owners]
+    return new_offsets, [v[indices] for v in values]
+
+
+def _empty_columns():
+    empty = np.zeros(0, dtype=np.int64)
+    return (empty, empty, np.zeros(0, dtype=np.float64),
+            np.zeros(1, dtype=np.int64), empty, empty,
+            np.zeros(1, dtype=np.int64), empty)
+
+
+def _concatenate(chunks):
+    """Join batches of columns, one after the other
+
+    Parameters
+    ----------
+    chunks : list of tuple of 1d np.array
+        columns in the order of ``MatchTable._COLUMNS``
+
+    Returns
+    -------
+    tuple of 1d np.array
+    """
+    if not chunks:
+        return _empty_columns()
+    columns = []
+    for i, name in enumerate(MatchTable._COLUMNS):
+        parts = [c[i] for c in chunks]
+        if name.endswith('_offsets'):
+            # shift every batch's offsets past the batches before it
+            shifted = [parts[0]]
+            for part in parts[1:]:
+                shifted.append(part[1:] + shifted[-1][-1])
+            parts = shifted
+        columns.append(np.concatenate(parts))
+    return tuple(columns)
+
+
+def _select_rows(columns, rows):
+    """Keep only ``rows`` of the given columns, in the given order"""
+    (source_inds, target_inds, scores, highlight_offsets, highlight_source,
+     highlight_target, feature_offsets, feature_inds) = columns
+    highlight_offsets, (highlight_source, highlight_target) = \
+        _take_segments(highlight_offsets, [highlight_source, highlight_target],
+                       rows)
+    feature_offsets, (feature_inds,) = _take_segments(feature_offsets,
+                                                      [feature_inds], rows)
+    return (source_inds[rows], target_inds[rows], scores[rows],
+            highlight_offsets, highlight_source, highlight_target,
+            feature_offsets, feature_inds)
+
+
+def _gen_merge_keys(source, scores, blocksize=4096):
+    """Yield ``(-score, source, row)`` for every row of a sorted source
+
+    Scores are read a block at a time, so that a spilled run need not be read
+    into memory all at once.
+    """
+    for start in range(0, len(scores), blocksize):
+        block = scores[start:start + blocksize].tolist()
+        for row, score in enumerate(block, start):
+            yield -score, source, row
+
+
+def _flatten_lists(lists, dtype):
+    """Lay out a list of lists as offsets and one flat array"""
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in lists], out=offsets[1:])
+    flat = np.fromiter((item for x in lists for item in x), dtype=dtype,
+                       count=offsets[-1])
+    return offsets, flat
+
+
+class MatchTable:
+    """Matches found by a search, stored column by column
+
+    Matchers fill the table one batch at a time. Match entities are only
+    built when the table is read from (by iterating over it, indexing into it
+    or calling ``iter_by_score()``), so that a search with many results does
+    not need to keep every Match around at once.
+
+    Parameters
+    ----------
+    search_id : bson.objectid.ObjectId
+        database ID of the search the matches belong to
+    source_units, target_units : list of dict or CompiledUnits
+        the units of each side of the search; rows of the table refer to them
+        by index
+    features : list of tesserae.db.entities.Feature
+        features indexed by Feature index; matched features are recorded by
+        index
+    tag_helper : tesserae.utils.retrieve.TagHelper
+        used to render the display tag of every unit, once, when the table is
+        created
+    spill_rows : int, optional
+        if given, whenever at least this many matches are held in memory, they
+        are sorted by score and written to disk as a run; ``iter_by_score()``
+        merges the runs as it reads them, so that memory use does not grow
+        with the number of matches
+
+    Attributes
+    ----------
+    source_inds, target_inds : 1d np.array of int
+        for every match, the index of its source and target unit
+    scores : 1d np.array of float
+        the score of every match
+    highlight_offsets : 1d np.array of int
+        ``highlight_source[highlight_offsets[k]:highlight_offsets[k+1]]`` (and
+        likewise for ``highlight_target``) are the matched positions of match
+        k
+    highlight_source, highlight_target : 1d np.array of int
+        matched positions in the source and target units
+    feature_offsets : 1d np.array of int
+        ``feature_inds[feature_offsets[k]:feature_offsets[k+1]]`` are the
+        matched features of match k
+    feature_inds : 1d np.array of int
+        matched feature indices
+
+    Notes
+    -----
+    Reading the attributes above, indexing or iterating brings any spilled
+    runs back into memory; rows which were spilled are then ordered by score
+    within their run.
+    """
+
+    SPILL_DIR = os.path.join(os.path.expanduser('~'), 'tess_data', 'spill')
+    # ``spill_rows`` used when search results are streamed out to storage
+    SPILL_ROWS = 200000
+
+    _COLUMNS = ('source_inds', 'target_inds', 'scores', 'highlight_offsets',
+                'highlight_source', 'highlight_target', 'feature_offsets',
+                'feature_inds')
+
+    def __init__(self, search_id, source_units, target_units, features,
+                 tag_helper, spill_rows=None):
+        self.search_id = search_id
+        self.features = features
+        self.spill_rows = spill_rows
+        self._source = _unit_columns(source_units, tag_helper)
+        if target_units is source_units:
+            # a text searched within itself
+            self._target = self._source
+        else:
+            self._target = _unit_columns(target_units, tag_helper)
+        # rows held in memory are in ``_columns`` followed by ``_chunks``;
+        # the rest have been spilled to the runs listed in ``_runs``
+        self._chunks = []
+        self._columns = None
+        self._runs = []
+        self._spill_path = None
+        self._length = 0
+        self._buffered = 0
+
+    def append(self, source_inds, target_inds, scores, highlight_offsets,
+               highlight_source, highlight_target, feature_offsets,
+               feature_inds):
+        """Add a batch of matches to the end of the table
+
+        Parameters
+        ----------
+        source_inds, target_inds : 1d np.array of int
+        scores : 1d np.array of float
+        highlight_offsets : 1d np.array of int
+            starts at 0; one more item than there are matches in the batch
+        highlight_source, highlight_target : 1d np.array of int
+        feature_offsets : 1d np.array of int
+            starts at 0; one more item than there are matches in the batch
+        feature_inds : 1d np.array of int
+        """
+        if len(scores) == 0:
+            return
+        self._chunks.append(
+            (np.asarray(source_inds, dtype=np.int64),
+             np.asarray(target_inds, dtype=np.int64),
+             np.asarray(scores, dtype=np.float64),
+             np.asarray(highlight_offsets, dtype=np.int64),
+             np.asarray(highlight_source, dtype=np.int64),
+             np.asarray(highlight_target, dtype=np.int64),
+             np.asarray(feature_offsets, dtype=np.int64),
+             np.asarray(feature_inds, dtype=np.int64)))
+        self._length += len(scores)
+        self._buffered += len(scores)
+        if self.spill_rows is not None and self._buffered >= self.spill_rows:
+            self._spill()
+
+    def append_rows(self, source_inds, target_inds, scores, highlights,
+                    matched_features):
+        """Add matches given as Python lists to the end of the table
+
+        Parameters
+        ----------
+        source_inds, target_inds : list of int
+        scores : list of float or 1d np.array of float
+        highlights : list of list of (int, int)
+            for every match, its (source position, target position) pairs
+        matched_features : list of iterable of int
+            for every match, the indices of its matched features, in the order
+            in which they should be reported
+        """
+        highlight_offsets, flat = _flatten_lists(
+            [[p for pair in h for p in pair] for h in highlights], np.int64)
+        feature_offsets, feature_inds = _flatten_lists(
+            [list(f) for f in matched_features], np.int64)
+        self.append(source_inds, target_inds, scores, highlight_offsets // 2,
+                    flat[0::2], flat[1::2], feature_offsets, feature_inds)
+
+    def _in_memory(self):
+        """Concatenate the rows held in memory into single columns"""
+        if self._chunks or self._columns is None:
+            chunks = self._chunks
+            if self._columns is not None:
+                chunks = [self._columns] + chunks
+            self._columns = _concatenate(chunks)
+            self._chunks = []
+        return self._columns
+
+    def _consolidate(self):
+        """Bring every row into memory, as single columns"""
+        if self._runs:
+            self._columns = _concatenate(
+                [self._read_run(run) for run in self._runs] +
+                [self._in_memory()])
+            self._chunks = []
+            self._discard_runs()
+            self._buffered = self._length
+        return self._in_memory()
+
+    def _spill(self):
+        """Write the rows held in memory to disk as a run sorted by score"""
+        columns = self._in_memory()
+        columns = _select_rows(columns, np.argsort(-columns[2],
+                                                   kind='stable'))
+        if self._spill_path is None:
+            os.makedirs(MatchTable.SPILL_DIR, exist_ok=True)
+            self._spill_path = tempfile.mkdtemp(dir=MatchTable.SPILL_DIR)
+        prefix = os.path.join(self._spill_path, str(len(self._runs)))
+        for name, column in zip(MatchTable._COLUMNS, columns):
+            np.save(f'{prefix}_{name}.npy', column)
+        self._runs.append({'prefix': prefix, 'length': len(columns[2])})
+        self._columns = None
+        self._buffered = 0
+
+    def _read_run(self, run):
+        """Map the columns of a spilled run from disk"""
+        (source_inds, target_inds, scores, highlight_offsets,
+         highlight_source, highlight_target, feature_offsets,
+         feature_inds) = [
+             np.load(f'{run["prefix"]}_{name}.npy', mmap_mode='r')
+             for name in MatchTable._COLUMNS
+         ]
+        # rows dropped by ``filter_by_score()`` are at the end of the run
+        length = run['length']
+        return (source_inds[:length], target_inds[:length], scores[:length],
+                highlight_offsets[:length + 1],
+                highlight_source[:highlight_offsets[length]],
+                highlight_target[:highlight_offsets[length]],
+                feature_offsets[:length + 1],
+                feature_inds[:feature_offsets[length]])
+
+    def _discard_runs(self):
+        self._runs = []
+        if self._spill_path is not None:
+            shutil.rmtree(self._spill_path, ignore_errors=True)
+            self._spill_path = None
+
+    def close(self):
+        """Remove any runs which were spilled to disk"""
+        self._discard_runs()
+
+    def __getattr__(self, name):
+        if name in MatchTable._COLUMNS:
+            return self._consolidate()[MatchTable._COLUMNS.index(name)]
+        raise AttributeError(name)
+
+    def __len__(self):
+        return self._length
+
+    def _select(self, rows):
+        """Keep only ``rows`` of the table, in the given order"""
+        self._columns = _select_rows(self._consolidate(), rows)
+        self._length = len(rows)
+        self._buffered = self._length
+
+    def sort_by_score(self):
+        """Order the matches from highest to lowest score
+
+        Matches with equal scores keep their relative order.
+        """
+        self._select(np.argsort(-self.scores, kind='stable'))
+
+    def filter_by_score(self, min_score):
+        """Drop every match that scored less than ``min_score``"""
+        for run in self._runs:
+            # runs are sorted, so the rows to drop are at the end
+            kept = int(np.count_nonzero(self._read_run(run)[2] >= min_score))
+            self._length -= run['length'] - kept
+            run['length'] = kept
+        columns = self._in_memory()
+        kept = np.flatnonzero(columns[2] >= min_score)
+        self._columns = _select_rows(columns, kept)
+        self._length -= self._buffered - len(kept)
+        self._buffered = len(kept)
+
+    def iter_by_score(self):
+        """Build the Matches from highest to lowest score
+
+        Matches with equal scores come out in the order in which they were
+        added. Spilled runs are merged as they are read rather than brought
+        back into memory.
+
+        Yields
+        ------
+        tesserae.db.entities.Match
+        """
+        sources = [self._read_run(run) for run in self._runs]
+        columns = self._in_memory()
+        sources.append(_select_rows(columns,
+                                    np.argsort(-columns[2], kind='stable')))
+        # ties are broken by source (runs are in the order in which they were
+        # written) and then by position within the source
+        rows = heapq.merge(*[_gen_merge_keys(i, source[2])
+                             for i, source in enumerate(sources)])
+        for _, i, k in rows:
+            yield self._materialize(k, sources[i])
+
+    def _materialize(self, k, columns):
+        (source_inds, target_inds, scores, highlight_offsets,
+         highlight_source, highlight_target, feature_offsets,
+         feature_inds) = columns
+        s_ind = source_inds[k]
+        t_ind = target_inds[k]
+        h_start, h_end = highlight_offsets[k], highlight_offsets[k + 1]
+        f_start, f_end = feature_offsets[k], feature_offsets[k + 1]
+        return Match(
+            search_id=self.search_id,
+            source_unit=self._source['_id'][s_ind],
+            target_unit=self._target['_id'][t_ind],
+            source_tag=self._source['display_tag'][s_ind],
+            target_tag=self._target['display_tag'][t_ind],
+            matched_features=[
+                self.features[mf].token
+                for mf in feature_inds[f_start:f_end].tolist()
+            ],
+            source_snippet=self._source['snippet'][s_ind],
+            target_snippet=self._target['snippet'][t_ind],
+            highlight=list(
+                zip(highlight_source[h_start:h_end].tolist(),
+                    highlight_target[h_start:h_end].tolist())),
+            score=scores[k])
+
+    def __getitem__(self, key):
+        """Build the Match at an index, or a list of Matches for a slice"""
+        columns = self._consolidate()
+        if isinstance(key, slice):
+            return [
+                self._materialize(k, columns)
+                for k in range(*key.indices(len(self)))
+            ]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('MatchTable index out of range')
+        return self._materialize(key, columns)
+
+    def __iter__(self):
+        columns = self._consolidate()
+        for k in range(len(self)):
+            yield self._materialize(k, columns)
@@ -4,16 +4,41 @@ Classes
 -------
 
 """
+import collections
 import itertools
 
 import numpy as np
 from scipy.sparse import csr_matrix
 
-from tesserae.db.entities import Feature, Match, Unit
-from tesserae.utils.calculations import \
-    get_corpus_frequencies, get_inverse_text_frequencies, get_sound_inverse_text_freq
+from tesserae.db.entities import Feature, Unit
+from tesserae.matchers.match_table import MatchTable
+from tesserae.utils.freqcache import load_corpus_frequencies, \
+    load_inverse_frequencies
+from tesserae.utils.parallel import SharedArrays, imap_ordered, \
+    resolve_workers
 from tesserae.utils.retrieve import TagHelper
 from tesserae.utils.stopwords import create_stoplist, get_stoplist_indices, get_stoplist_tokens
+from tesserae.utils.unitcache import CompiledUnits, load_units
+
+# how many bytes the sparse matrix products of a search may take up at once,
+# unless the search is given a budget of its own
+MATCH_MEMORY_BUDGET = 2 * 1024 ** 3
+
+# a rough count of the bytes taken up by every hit of a source batch, from the
+# position-level product through to the arrays the hits are binned into
+BYTES_PER_HIT = 64
+
+# how many hits a source batch is meant to have when memory allows for more;
+# larger batches are no faster, since sorting their hits comes to dominate
+BATCH_HITS = 500000
+
+# how many target positions may be stacked together when one source is
+# matched against many targets
+CORPUS_BLOCK_POSITIONS = 2000000
+
+# the smallest distance two matched positions within a unit can have; since
+# distances are measured inclusively, adjacent positions are 2 apart
+MIN_UNIT_DISTANCE = 2
 
 
 class SparseMatrixSearch(object):
@@ -37,14 +62,16 @@ class SparseMatrixSearch(object):
         -------
         dict
         """
+        # a search within one text may leave out the target
+        target = search_params.get('target') or search_params['source']
         return {
             'source': {
                 'object_id': str(search_params['source'].text.id),
                 'units': search_params['source'].unit_type
             },
             'target': {
-                'object_id': str(search_params['target'].text.id),
-                'units': search_params['target'].unit_type
+                'object_id': str(target.text.id),
+                'units': target.unit_type
             },
             'method': {
                 'name': SparseMatrixSearch.matcher_type,
@@ -54,7 +81,8 @@ class SparseMatrixSearch(object):
                 'freq_basis': search_params['freq_basis'],
                 'max_distance': search_params['max_distance'],
                 'distance_basis': search_params['distance_basis'],
-                'min_score': search_params['min_score']
+                'min_score': search_params['min_score'],
+                'max_feature_share': search_params.get('max_feature_share')
             }
         }
 
@@ -107,7 +135,10 @@ class SparseMatrixSearch(object):
             'parameters.method.distance_basis':
             method['distance_basis'],
             'parameters.method.min_score':
-            method['min_score']
+            method['min_score'],
+            # searches from before features could be capped match None too
+            'parameters.method.max_feature_share':
+            method.get('max_feature_share')
         }
 
     def match(self,
@@ -121,12 +152,18 @@ class SparseMatrixSearch(object):
               freq_basis='texts',
               max_distance=10,
               distance_basis='frequency',
-              min_score=6):
+              min_score=6,
+              workers=1,
+              spill_rows=None,
+              memory_budget=None,
+              max_feature_share=None):
         """Find matches between one or more texts.
 
         Texts will contain lines or phrases with matching tokens, with varying
         degrees of strength to the match. If one text is provided, each unit in
-        the text will be matched with every subsequent unit.
+        the text will be matched with every subsequent unit (and never with
+        itself), with the later unit on the target side; only that half of
+        the unit pairs is ever computed.
 
         Parameters
         ----------
@@ -134,8 +171,10 @@ class SparseMatrixSearch(object):
             The search job associated with this matching job.
         source : tesserae.matchers.text_options.TextOptions
             The source text to compare against, specifying by which units.
-        target : tesserae.matchers.text_options.TextOptions
-            The target text to compare against, specifying by which units.
+        target : tesserae.matchers.text_options.TextOptions or None
+            The target text to compare against, specifying by which units. If
+            None, or if it gives the same text and units as ``source``, only
+            one text is provided.
         feature : {'form','lemmata','semantic','semantic + lemmata','sound'}
             The token feature to match on.
         stopwords : int or list of str
@@ -160,7 +199,28 @@ class SparseMatrixSearch(object):
             - 'span': the greatest distance between any two matching words
         min_score : float
             The minimum score a match must have in order to be included in the
-            results
+            results; unit pairs which cannot reach it are dropped before their
+            distances are computed
+        workers : int
+            How many processes to use for matching and scoring. 0 or less uses
+            one process per available core. Results do not depend on this
+            setting.
+        spill_rows : int, optional
+            If given, matches are written to disk in sorted runs of about this
+            many rows while matching goes on; see
+            ``tesserae.matchers.match_table.MatchTable``.
+        memory_budget : int, optional
+            How many bytes the sparse matrix products of the search may take
+            up at once, across all of its processes; the source (and, if need
+            be, the target) is matched in pieces small enough to stay within
+            it. Defaults to ``MATCH_MEMORY_BUDGET``. Results do not depend on
+            this setting.
+        max_feature_share : float, optional
+            If given, features found in more than this share of the units of
+            the texts are not matched on, as though they were stopwords; see
+            ``_cap_features()``. Common trigrams or broad synonym clusters
+            can otherwise make 'sound' and 'semantic' searches very slow.
+            Must be greater than 0 and no greater than 1.
 
         Raises
         ------
@@ -169,164 +229,464 @@ class SparseMatrixSearch(object):
 
         Returns
         -------
-        list of tesserae.db.entities.Match
+        tesserae.matchers.match_table.MatchTable
         """
+        if target is None:
+            target = source
+        _check_feature_share(max_feature_share)
         texts = [source.text, target.text]
+        stoplist, features = self._get_stoplist_and_features(
+            source.text.language, texts, feature, stopwords, stopword_basis,
+            score_basis)
+
+        source_units = _get_units(self.connection, source, feature)
+        if _is_same_units(source, target):
+            # a search within a single text shares its units between both
+            # sides; see ``_match_source_batch()``
+            target_units = source_units
+        else:
+            target_units = _get_units(self.connection, target, feature)
+        if max_feature_share is not None:
+            stoplist = _cap_features(stoplist, [source_units, target_units],
+                                     len(features), max_feature_share)
+
+        tag_helper = TagHelper(self.connection, texts)
+
+        if freq_basis != 'texts':
+            match_ents = _score_by_corpus_frequencies(search, self.connection,
+                                                      score_basis, texts,
+                                                      target_units,
+                                                      source_units, features,
+                                                      stoplist, distance_basis,
+                                                      max_distance, tag_helper,
+                                                      workers, min_score,
+                                                      spill_rows,
+                                                      memory_budget)
+        else:
+            match_ents = _score_by_text_frequencies(search, self.connection,
+                                                    score_basis, texts,
+                                                    target_units, source_units,
+                                                    features, stoplist,
+                                                    distance_basis,
+                                                    max_distance, tag_helper,
+                                                    workers, min_score,
+                                                    spill_rows, memory_budget)
+
+        match_ents.filter_by_score(min_score)
+        return match_ents
+
+    def match_corpus(self,
+                     searches,
+                     source,
+                     targets,
+                     feature,
+                     stopwords=10,
+                     stopword_basis='corpus',
+                     score_basis='word',
+                     freq_basis='texts',
+                     max_distance=10,
+                     distance_basis='frequency',
+                     min_score=6,
+                     workers=1,
+                     spill_rows=None,
+                     memory_budget=None,
+                     max_feature_share=None):
+        """Match one source against each of many target texts
+
+        The result for every target is the same as that of ``match()`` with
+        the same options, but everything which only depends on the source
+        (its units, stoplist, features and frequencies) is worked out once,
+        and targets are stacked into blocks of up to
+        ``CORPUS_BLOCK_POSITIONS`` positions, so that every source batch is
+        built once per block rather than once per target.
+
+        Parameters
+        ----------
+        searches : list of tesserae.db.entities.Search
+            The search job of every target; matches against ``targets[i]``
+            belong to ``searches[i]``, which is also where the progress of
+            that target is reported.
+        source : tesserae.matchers.text_options.TextOptions
+            The source text to compare against, specifying by which units.
+        targets : list of tesserae.matchers.text_options.TextOptions
+            The target texts to compare against; they must be in the same
+            language as the source.
+
+        See ``match()`` for the other parameters. With ``stopword_basis`` set
+        to 'texts', the stoplist of every target is drawn from the source and
+        that target, as in ``match()``; targets are then not stacked. The
+        same goes for features capped by ``max_feature_share``.
+
+        Raises
+        ------
+        ValueError
+            Raised when a parameter was poorly specified
+
+        Yields
+        ------
+        target : tesserae.matchers.text_options.TextOptions
+        matches : tesserae.matchers.match_table.MatchTable
+            the matches against ``target``; targets come up in the order in
+            which they were given
+        """
+        language = source.text.language
+        _check_feature_share(max_feature_share)
+        for target in targets:
+            if target.text.language != language:
+                raise ValueError(f'Target "{target.text.title}" is not in '
+                                 f'the source language "{language}"')
+        texts = [source.text] + [t.text for t in targets]
+        # a stoplist drawn from the texts of a search differs from target to
+        # target, and the target matrix is built without stopwords
+        stoplist_per_target = isinstance(stopwords, int) and \
+            stopword_basis == 'texts'
+        stoplist, features = self._get_stoplist_and_features(
+            language, texts, feature, [] if stoplist_per_target else stopwords,
+            stopword_basis, score_basis)
+
+        source_units = _get_units(self.connection, source, feature)
+        all_target_units = [
+            source_units if _is_same_units(source, t) else _get_units(
+                self.connection, t, feature) for t in targets
+        ]
+        tag_helper = TagHelper(self.connection, texts)
+
+        if freq_basis == 'texts':
+            source_inv_freq_table = _text_inverse_frequencies(
+                self.connection, score_basis, source.text)
+        # sound scores look up inverse frequencies by feature rather than by
+        # position, and capped features depend on the target, so those
+        # targets are not stacked either
+        block_size = CORPUS_BLOCK_POSITIONS
+        if stoplist_per_target or score_basis == 'sound' or \
+                max_feature_share is not None:
+            block_size = 1
+        for block in _group_targets(all_target_units, block_size,
+                                    source_units):
+            block_searches = [searches[i] for i in block]
+            block_units = [all_target_units[i] for i in block]
+            block_stoplist = stoplist
+            if stoplist_per_target:
+                block_stoplist = create_stoplist(
+                    self.connection, stopwords, feature, language,
+                    basis=[source.text, targets[block[0]].text])
+            if max_feature_share is not None:
+                block_stoplist = _cap_features(
+                    block_stoplist, [source_units, block_units[0]],
+                    len(features), max_feature_share)
+            if freq_basis == 'texts':
+                target_inv_freq_tables = [
+                    _text_inverse_frequencies(self.connection, score_basis,
+                                              targets[i].text) for i in block
+                ]
+            else:
+                source_inv_freq_table = _averaged_inverse_frequency_table(
+                    load_corpus_frequencies(self.connection, score_basis,
+                                           language),
+                    [source_units] + [
+                        units for units in block_units
+                        if units is not source_units
+                    ])
+                target_inv_freq_tables = [source_inv_freq_table] * len(block)
+            if score_basis == 'sound' or block_units[0] is source_units:
+                scorer = _score_sound if score_basis == 'sound' else _score
+                tables = [
+                    scorer(block_searches[0], self.connection,
+                           block_units[0], source_units, features,
+                           block_stoplist,
+                           distance_basis, max_distance,
+                           source_inv_freq_table, target_inv_freq_tables[0],
+                           tag_helper, workers, min_score, spill_rows,
+                           memory_budget)
+                ]
+            else:
+                tables = _score_stacked(block_searches, self.connection,
+                                        block_units, source_units, features,
+                                        block_stoplist, distance_basis,
+                                        max_distance, source_inv_freq_table,
+                                        target_inv_freq_tables, tag_helper,
+                                        workers, min_score, spill_rows,
+                                        memory_budget)
+            for i, match_ents in zip(block, tables):
+                match_ents.filter_by_score(min_score)
+                yield targets[i], match_ents
+
+    def _get_stoplist_and_features(self, language, texts, feature, stopwords,
+                                   stopword_basis, score_basis):
+        """Look up what a search in ``language`` matches on
+
+        See ``match()`` for the parameters.
+
+        Returns
+        -------
+        stoplist : list of int
+            feature indices which may not be matched on
+        features : list of tesserae.db.entities.Feature
+            every feature of the chosen type, in order of index
+        """
         if isinstance(stopwords, int):
             stopword_basis = stopword_basis if stopword_basis != 'texts' \
                     else texts
             stoplist = create_stoplist(self.connection,
                                        stopwords,
                                        feature,
-                                       source.text.language,
+                                       language,
                                        basis=stopword_basis)
         else:
             stoplist = get_stoplist_indices(
                 self.connection,
                 stopwords,
                 feature,
-                source.text.language,
+                language,
             )
         features = sorted(self.connection.find(Feature.collection,
-                                               language=source.text.language,
+                                               language=language,
                                                feature=feature),
                           key=lambda x: x.index)
         if len(features) <= 0:
             raise ValueError(f'Chosen feature was invalid: '
                              f'Feature type "{feature}" for language '
-                             f'"{source.text.language}" '
+                             f'"{language}" '
                              f'was not found in the database.')
         score_feature_found = \
             self.connection.connection[Feature.collection].find_one(
-                filter={'language': source.text.language,
+                filter={'language': language,
                         'feature': score_basis})
         if score_feature_found is None:
             raise ValueError(f'Chosen score basis was invalid: '
                              f'Feature type "{score_basis}" for language '
-                             f'"{source.text.language}" '
+                             f'"{language}" '
                              f'was not found in the database.')
+        return stoplist, features
 
-        target_units = _get_units(self.connection, target, feature)
-        source_units = _get_units(self.connection, source, feature)
 
-        tag_helper = TagHelper(self.connection, texts)
+def _get_units(connection, textoptions, feature):
+    """Get the units of a text, compiled for matching
 
-        if freq_basis != 'texts':
-            match_ents = _score_by_corpus_frequencies(search, self.connection,
-                                                      score_basis, texts,
-                                                      target_units,
-                                                      source_units, features,
-                                                      stoplist, distance_basis,
-                                                      max_distance, tag_helper)
-        else:
-            match_ents = _score_by_text_frequencies(search, self.connection,
-                                                    score_basis, texts,
-                                                    target_units, source_units,
-                                                    features, stoplist,
-                                                    distance_basis,
-                                                    max_distance, tag_helper)
+    Compiled units are kept on disk, so that only the first search involving
+    a text, unit type, and feature needs to query the database for them; see
+    ``tesserae.utils.unitcache``.
 
-        return [m for m in match_ents if m.score >= min_score]
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    textoptions : tesserae.matchers.text_options.TextOptions
+        which text and which units of it to get
+    feature : str
+        the feature type to get along with the token forms
 
+    Returns
+    -------
+    tesserae.utils.unitcache.CompiledUnits
+    """
+    return load_units(connection, textoptions.text, textoptions.unit_type,
+                      feature)
 
-def _get_units(connection, textoptions, feature):
-    return [
-        u for u in connection.aggregate(
-            Unit.collection,
-            [
-                {
-                    '$match': {
-                        'text': textoptions.text.id,
-                        'unit_type': textoptions.unit_type
-                    }
-                },
-                {
-                    '$project': {
-                        '_id': True,
-                        'text': True,
-                        'index': True,
-                        'snippet': True,
-                        'tags': True,
-                        'forms': {
-                            # flatten list of lists of ints into list of ints
-                            # https://docs.mongodb.com/manual/reference/operator/aggregation/reduce/
-                            '$reduce': {
-                                'input': '$tokens.features.form',
-                                'initialValue': [],
-                                'in': {
-                                    '$concatArrays': ['$$value', '$$this']
-                                }
-                            }
-                        },
-                        'features': '$tokens.features.' + feature,
-                    }
-                }
-            ],
-            encode=False)
-    ]
+
+def _check_feature_share(max_feature_share):
+    """Make sure that ``max_feature_share`` is a share of the units
+
+    Raises
+    ------
+    ValueError
+        Raised when ``max_feature_share`` is given but not in (0, 1]
+    """
+    if max_feature_share is not None and not 0 < max_feature_share <= 1:
+        raise ValueError(f'Chosen maximum feature share was invalid: '
+                         f'{max_feature_share} is not greater than 0 and no '
+                         f'greater than 1.')
+
+
+def _cap_features(stoplist, all_units, features_size, max_share):
+    """Add the features found in too many units to the stoplist
+
+    A feature found in a large share of the units hits nearly every position
+    pair of the texts, which makes the sparse products of matching nearly
+    dense. Leaving such features out bounds how many hits any single feature
+    can bring about.
+
+    Parameters
+    ----------
+    stoplist : list of int
+        feature indices on which matches are already not permitted
+    all_units : list of list of dict or CompiledUnits
+        the units of every text of the search; the same units listed twice
+        (as in a search within a single text) are only counted once
+    features_size : int
+    max_share : float
+        how large a share of all of the units a feature may be found in
+
+    Returns
+    -------
+    list of int
+        ``stoplist`` along with every feature found in more than
+        ``max_share`` of the units, in ascending order
+    """
+    unit_counts = np.zeros(features_size, dtype=np.int64)
+    num_units = 0
+    distinct = []
+    for units in all_units:
+        if not any(units is seen for seen in distinct):
+            distinct.append(units)
+    for units in distinct:
+        breaks, _, feature_breaks, feature_inds = _flatten_units(units)
+        unit_starts = feature_breaks[breaks]
+        owners = np.repeat(np.arange(len(breaks) - 1), np.diff(unit_starts))
+        valid = feature_inds >= 0
+        # a feature is counted once per unit, however often it comes up there
+        keys = np.unique(owners[valid] * features_size + feature_inds[valid])
+        unit_counts += np.bincount(keys % features_size,
+                                   minlength=features_size)
+        num_units += len(breaks) - 1
+    capped = np.flatnonzero(unit_counts > max_share * num_units)
+    return sorted(set(int(i) for i in stoplist) | set(capped.tolist()))
 
 
 def _score_by_corpus_frequencies(search, connection, score_basis, texts,
                                  target_units, source_units, features,
                                  stoplist, distance_basis, max_distance,
-                                 tag_helper):
-    if score_basis == 'sound':
-        if texts[0].language != texts[1].language:
-            source_inv_frequencies_getter = _inverse_averaged_freq_getter(
-                get_corpus_frequencies(connection, score_basis, texts[0].language),
-                source_units)
-            target_inv_frequencies_getter = _inverse_averaged_freq_getter(
-                get_corpus_frequencies(connection, score_basis, texts[1].language),
-                target_units)
-        else:
-            source_inv_frequencies_getter = _inverse_averaged_freq_getter(
-                get_corpus_frequencies(connection, score_basis, texts[0].language),
-                itertools.chain.from_iterable([source_units, target_units]))
-            target_inv_frequencies_getter = source_inv_frequencies_getter
-        return _score_sound(search, connection, target_units, source_units, features,
-                    stoplist, distance_basis, max_distance,
-                    source_inv_frequencies_getter, target_inv_frequencies_getter,
-                    tag_helper)
+                                 tag_helper, workers=1, min_score=None,
+                                 spill_rows=None, memory_budget=None):
+    if texts[0].language != texts[1].language:
+        source_inv_freq_table = _averaged_inverse_frequency_table(
+            load_corpus_frequencies(connection, score_basis,
+                                    texts[0].language),
+            [source_units])
+        target_inv_freq_table = _averaged_inverse_frequency_table(
+            load_corpus_frequencies(connection, score_basis,
+                                    texts[1].language),
+            [target_units])
     else:
-        if texts[0].language != texts[1].language:
-            source_inv_frequencies_getter = _inverse_averaged_freq_getter(
-                get_corpus_frequencies(connection, score_basis, texts[0].language),
-                source_units)
-            target_inv_frequencies_getter = _inverse_averaged_freq_getter(
-                get_corpus_frequencies(connection, score_basis, texts[1].language),
-                target_units)
-        else:
-            source_inv_frequencies_getter = _inverse_averaged_freq_getter(
-                get_corpus_frequencies(connection, score_basis, texts[0].language),
-                itertools.chain.from_iterable([source_units, target_units]))
-            target_inv_frequencies_getter = source_inv_frequencies_getter
-        return _score(search, connection, target_units, source_units, features,
-                    stoplist, distance_basis, max_distance,
-                    source_inv_frequencies_getter, target_inv_frequencies_getter,
-                    tag_helper)
+        source_inv_freq_table = _averaged_inverse_frequency_table(
+            load_corpus_frequencies(connection, score_basis,
+                                    texts[0].language),
+            [source_units] if target_units is source_units else
+            [source_units, target_units])
+        target_inv_freq_table = source_inv_freq_table
+    scorer = _score_sound if score_basis == 'sound' else _score
+    return scorer(search, connection, target_units, source_units, features,
+                  stoplist, distance_basis, max_distance,
+                  source_inv_freq_table, target_inv_freq_table, tag_helper,
+                  workers, min_score, spill_rows, memory_budget)
 
 
 def _score_by_text_frequencies(search, connection, score_basis, texts,
                                target_units, source_units, features, stoplist,
-                               distance_basis, max_distance, tag_helper):
-    if score_basis == 'sound':
-        source_inv_frequencies_getter = _lookup_wrapper(
-            get_sound_inverse_text_freq(connection, texts[0].id))
-        target_inv_frequencies_getter = _lookup_wrapper(
-            get_sound_inverse_text_freq(connection, texts[1].id))
-        return _score_sound(search, connection, target_units, source_units, features,
-                    stoplist, distance_basis, max_distance,
-                    source_inv_frequencies_getter, target_inv_frequencies_getter,
-                    tag_helper)
+                               distance_basis, max_distance, tag_helper,
+                               workers=1, min_score=None, spill_rows=None,
+                               memory_budget=None):
+    source_inv_freq_table = _text_inverse_frequencies(connection, score_basis,
+                                                      texts[0])
+    if target_units is source_units:
+        target_inv_freq_table = source_inv_freq_table
     else:
-        source_inv_frequencies_getter = _lookup_wrapper(
-            get_inverse_text_frequencies(connection, score_basis, texts[0].id))
-        target_inv_frequencies_getter = _lookup_wrapper(
-            get_inverse_text_frequencies(connection, score_basis, texts[1].id))
-        return _score(search, connection, target_units, source_units, features,
-                    stoplist, distance_basis, max_distance,
-                    source_inv_frequencies_getter, target_inv_frequencies_getter,
-                    tag_helper)
+        target_inv_freq_table = _text_inverse_frequencies(
+            connection, score_basis, texts[1])
+    scorer = _score_sound if score_basis == 'sound' else _score
+    return scorer(search, connection, target_units, source_units, features,
+                  stoplist, distance_basis, max_distance,
+                  source_inv_freq_table, target_inv_freq_table, tag_helper,
+                  workers, min_score, spill_rows, memory_budget)
+
+
+def _is_same_units(source, target):
+    """Whether a search is to be run within a single text
+
+    Parameters
+    ----------
+    source, target : tesserae.matchers.text_options.TextOptions
+    """
+    return source.text.id == target.text.id and \
+        source.unit_type == target.unit_type
+
+
+def _text_inverse_frequencies(connection, score_basis, text):
+    """Look up inverse frequencies within a single text
+
+    Returns
+    -------
+    1d np.array of float
+        the inverse frequency in ``text`` of every form index (or, when
+        scoring by sound, of every sound feature index); see
+        ``tesserae.utils.freqcache.inverse_frequency_table()``
+    """
+    return load_inverse_frequencies(connection, score_basis, text.id)
+
+
+def _averaged_inverse_frequency_table(freqs, all_units):
+    """Invert the corpus frequency of every form, averaged over its features
+
+    Each form is given the features it has where it first appears in
+    ``all_units``.
+
+    Parameters
+    ----------
+    freqs : 1d np.array of float
+        the corpus frequency of every feature index; see
+        ``tesserae.utils.freqcache.load_corpus_frequencies()``
+    all_units : list of (list of dict or CompiledUnits)
+        the units whose forms are to be looked up
+
+    Returns
+    -------
+    1d np.array of float
+        laid out as by ``tesserae.utils.freqcache.inverse_frequency_table()``
+    """
+    all_forms = []
+    all_means = []
+    for units in all_units:
+        _, forms, feature_breaks, feature_inds = _flatten_units(units)
+        uniq_forms, firsts = np.unique(forms, return_index=True)
+        starts = feature_breaks[firsts]
+        sizes = feature_breaks[firsts + 1] - starts
+        means = np.full(len(uniq_forms), np.nan)
+        # forms with as many features are averaged together, as rows of a
+        # matrix, so that they are summed up in the same way as by np.mean
+        for size in np.unique(sizes[sizes > 0]).tolist():
+            selected = np.flatnonzero(sizes == size)
+            gathered = freqs[feature_inds[starts[selected, np.newaxis] +
+                                          np.arange(size)]]
+            means[selected] = gathered.sum(axis=1) / size
+        all_forms.append(uniq_forms)
+        all_means.append(means)
+    forms = np.concatenate(all_forms) if all_forms else \
+        np.zeros(0, dtype=np.int64)
+    means = np.concatenate(all_means) if all_means else np.zeros(0)
+    # earlier units take precedence
+    uniq_forms, firsts = np.unique(forms, return_index=True)
+    table = np.full(int(uniq_forms.max(initial=-1)) + 2, np.nan)
+    with np.errstate(divide='ignore'):
+        table[uniq_forms] = 1.0 / means[firsts]
+    return table
+
+
+def _group_targets(all_target_units, max_positions, source_units=None):
+    """Divide targets into blocks to be stacked together
+
+    Targets are kept in order, and a block is closed once adding the next
+    target would take it past ``max_positions`` positions; a target larger
+    than that makes up a block of its own, as does a target which is the
+    source itself (``source_units``), since it is searched within itself.
+
+    Yields
+    ------
+    list of int
+        the indices of the targets in a block
+    """
+    block = []
+    positions = 0
+    for i, units in enumerate(all_target_units):
+        size = int(_flatten_units(units)[0][-1])
+        if units is source_units:
+            size = max_positions + 1
+        if block and positions + size > max_positions:
+            yield block
+            block = []
+            positions = 0
+        block.append(i)
+        positions += size
+    if block:
+        yield block
 
 
 def _get_trivial_distance(p0, p1):
@@ -342,20 +702,21 @@ def _get_trivial_distance(p0, p1):
     return abs(p0 - p1) + 1
 
 
-def _get_distance_by_least_frequency(get_inv_freq, positions, forms):
+def _get_distance_by_least_frequency(inv_freqs, positions, forms):
     """Obtains the distance by least frequency for a unit
 
     Contrary to the v3 help documentation on --dist in read_table.pl, v3
     behavior is that distance is inclusive of both matched words.  Thus,
     adjacent words have a distance of 2, an intervening word increases the
     distance to 3, and so forth.  This function behaves as v3 behaves instead
-    of how it prescribes.
+    of how it prescribes.  Words that are equally frequent are ranked by
+    position, the earlier one first.
 
     Parameters
     ----------
-    get_inv_freq : (int) -> float
-        a function that takes a word form index as input and returns its
-        inverse frequency as output
+    inv_freqs : 1d np.array of float
+        the inverse frequency of every form index; see
+        ``tesserae.utils.freqcache.inverse_frequency_table()``
     positions : 1d np.array of ints
         token positions in the unit where matches were found
     forms : 1d np.array of ints
@@ -366,9 +727,9 @@ def _get_distance_by_least_frequency(get_inv_freq, positions, forms):
     if len(positions) == 2:
         return _get_trivial_distance(positions[0], positions[1])
     sorted_positions = np.array(sorted(positions))
-    inv_freqs = np.array([get_inv_freq(f) for f in forms[sorted_positions]])
     # lowest inverse frequencies are the highest frequencies, so need to flip
-    freq_sort = np.argsort(-inv_freqs)
+    freq_sort = np.argsort(-inv_freqs[forms[sorted_positions]],
+                           kind='stable')
     idx = sorted_positions[freq_sort]
     if idx.shape[0] >= 2:
         not_first_pos = idx[idx != idx[0]]
@@ -400,26 +761,388 @@ def _get_distance_by_span(matched_positions, forms):
     return 0
 
 
-def _lookup_wrapper(d):
-    """Useful for making dictionaries act like functions"""
-    def _inner(key):
-        return d[key]
+def _flatten_units(units):
+    """Lay out the token information of units as flat arrays
+
+    Parameters
+    ----------
+    units : list of dict or tesserae.utils.unitcache.CompiledUnits
+        ``units`` should be either ``source_units`` or ``target_units`` from
+        ``_gen_matches(...)``; compiled units are already laid out this way
+
+    Returns
+    -------
+    breaks : 1d np.array of int
+        for the slice ``breaks[i]:breaks[i+1]``, those are the positions that
+        belong to ``units[i]``
+    forms : 1d np.array of int
+        ``forms[p]`` is the form index of the token at position ``p``
+    feature_breaks : 1d np.array of int
+        for the slice ``feature_breaks[p]:feature_breaks[p+1]``, those are the
+        indices into ``feature_inds`` that belong to position ``p``
+    feature_inds : 1d np.array of int
+        the feature indices of every position, laid out one after the other
+
+    """
+    if isinstance(units, CompiledUnits):
+        return units.arrays
+    unit_sizes = np.fromiter((len(u['forms']) for u in units),
+                             dtype=np.int64,
+                             count=len(units))
+    breaks = np.zeros(len(units) + 1, dtype=np.int64)
+    np.cumsum(unit_sizes, out=breaks[1:])
+    forms = np.fromiter(itertools.chain.from_iterable(u['forms']
+                                                      for u in units),
+                        dtype=np.int64,
+                        count=breaks[-1])
+    feature_sizes = np.fromiter(
+        (len(f) for u in units for f in u['features']), dtype=np.int64)
+    feature_breaks = np.zeros(len(feature_sizes) + 1, dtype=np.int64)
+    np.cumsum(feature_sizes, out=feature_breaks[1:])
+    feature_inds = np.fromiter(itertools.chain.from_iterable(
+        f for u in units for f in u['features']),
+                               dtype=np.int64,
+                               count=feature_breaks[-1])
+    return breaks, forms, feature_breaks, feature_inds
+
+
+def _gather_inverse_frequencies(inv_freqs, forms):
+    """Look up the inverse frequency of every position
+
+    Parameters
+    ----------
+    inv_freqs : 1d np.array of float
+        the inverse frequency of every form index; see
+        ``tesserae.utils.freqcache.inverse_frequency_table()``
+    forms : 1d np.array of int
+        the form index at each position
+
+    Returns
+    -------
+    1d np.array of float
+        the inverse frequency at each position; positions without a valid form
+        (such as punctuation) are given 0
+    """
+    result = np.zeros(len(forms), dtype=np.float64)
+    valid = forms >= 0
+    result[valid] = inv_freqs[forms[valid]]
+    return result
+
+
+def _expand_segments(starts, sizes):
+    """Enumerate every index of the given segments
+
+    Parameters
+    ----------
+    starts : 1d np.array of int
+        where each segment begins
+    sizes : 1d np.array of int
+        how long each segment is
+
+    Returns
+    -------
+    owners : 1d np.array of int
+        ``owners[i]`` tells which segment ``indices[i]`` came from
+    indices : 1d np.array of int
+        the indices ``starts[k]:starts[k]+sizes[k]`` for every k, laid out one
+        after the other
+    """
+    total = int(sizes.sum())
+    owners = np.repeat(np.arange(len(sizes)), sizes)
+    seg_offsets = np.zeros(len(sizes), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=seg_offsets[1:])
+    indices = np.arange(total) - seg_offsets[owners] + starts[owners]
+    return owners, indices
+
+
+def _count_distinct_per_segment(seg_ids, values, num_segments):
+    """Count how many distinct values each segment contains"""
+    order = np.lexsort((values, seg_ids))
+    sorted_segs = seg_ids[order]
+    sorted_vals = values[order]
+    is_new = np.ones(len(order), dtype=bool)
+    is_new[1:] = (sorted_segs[1:] != sorted_segs[:-1]) | \
+        (sorted_vals[1:] != sorted_vals[:-1])
+    return np.bincount(sorted_segs[is_new], minlength=num_segments)
+
+
+def _at_distinct_positions(seg_ids, positions, values):
+    """Per segment, keep ``values`` only once for each distinct position
+
+    Returns
+    -------
+    seg_ids : 1d np.array of int
+        the segment of each kept value, in ascending order
+    values : 1d np.array
+        the kept values, ordered by segment and then by position
+    """
+    order = np.lexsort((positions, seg_ids))
+    sorted_segs = seg_ids[order]
+    sorted_pos = positions[order]
+    is_new = np.ones(len(order), dtype=bool)
+    is_new[1:] = (sorted_segs[1:] != sorted_segs[:-1]) | \
+        (sorted_pos[1:] != sorted_pos[:-1])
+    return sorted_segs[is_new], values[order][is_new]
+
 
-    return _inner
+def _get_distances_by_least_frequency(inv_freqs, positions, forms, offsets):
+    """Obtains the distance by least frequency for every segment at once
 
+    This is the segment-wise counterpart of
+    ``_get_distance_by_least_frequency()`` and follows the same (v3) rules:
+    matched positions are ranked from least to most frequent, with ties going
+    to the earlier position, and the distance is measured inclusively between
+    the least frequent position and the next least frequent position that
+    differs from it.
 
-def _inverse_averaged_freq_getter(d, units_iter):
-    cache = {}
-    for unit in units_iter:
-        for form, feats in zip(unit['forms'], unit['features']):
-            if form in cache:
-                continue
-            cache[form] = 1.0 / np.mean([d[f] for f in feats])
+    Parameters
+    ----------
+    inv_freqs : 1d np.array of float
+        the inverse frequency of the form found at each matched position
+    positions : 1d np.array of int
+        matched positions; ``positions[offsets[k]:offsets[k+1]]`` belong to
+        segment k
+    forms : 1d np.array of int
+        the form found at each matched position
+    offsets : 1d np.array of int
+        segment boundaries into ``positions``
+
+    Returns
+    -------
+    1d np.array of int
+        the distance of each segment; 0 if a segment matched fewer than two
+        distinct forms
+    """
+    num_segments = len(offsets) - 1
+    sizes = np.diff(offsets)
+    distances = np.zeros(num_segments, dtype=np.int64)
+    nonempty = sizes > 0
+    if not nonempty.any():
+        return distances
+    seg_ids = np.repeat(np.arange(num_segments), sizes)
+    distinct = _count_distinct_per_segment(seg_ids, forms, num_segments)
+    # lowest inverse frequencies are the highest frequencies, so need to flip
+    order = np.lexsort((positions, -inv_freqs, seg_ids))
+    sorted_pos = positions[order]
+    starts = offsets[:-1][nonempty]
+    first = sorted_pos[starts]
+    total = len(sorted_pos)
+    candidates = np.where(sorted_pos != np.repeat(first, sizes[nonempty]),
+                          np.arange(total), total)
+    ends = np.minimum.reduceat(candidates, starts)
+    found = (ends < total) & (distinct[nonempty] >= 2)
+    ends = sorted_pos[np.minimum(ends, total - 1)]
+    distances[nonempty] = np.where(found, np.abs(ends - first) + 1, 0)
+    return distances
 
-    def _inner(key):
-        return cache[key]
 
-    return _inner
+def _get_distances_by_span(positions, forms, offsets):
+    """Calculate the span distance for every segment at once
+
+    This is the segment-wise counterpart of ``_get_distance_by_span()``.
+
+    Parameters
+    ----------
+    positions : 1d np.array of int
+        matched positions; ``positions[offsets[k]:offsets[k+1]]`` belong to
+        segment k
+    forms : 1d np.array of int
+        the form found at each matched position
+    offsets : 1d np.array of int
+        segment boundaries into ``positions``
+
+    Returns
+    -------
+    1d np.array of int
+        the distance of each segment; 0 if a segment matched fewer than two
+        distinct forms
+    """
+    num_segments = len(offsets) - 1
+    sizes = np.diff(offsets)
+    distances = np.zeros(num_segments, dtype=np.int64)
+    nonempty = sizes > 0
+    if not nonempty.any():
+        return distances
+    seg_ids = np.repeat(np.arange(num_segments), sizes)
+    distinct = _count_distinct_per_segment(seg_ids, forms, num_segments)
+    starts = offsets[:-1][nonempty]
+    start_pos = np.minimum.reduceat(positions, starts)
+    end_pos = np.maximum.reduceat(positions, starts)
+    distances[nonempty] = np.where(
+        (distinct[nonempty] >= 2) & (start_pos != end_pos),
+        end_pos - start_pos + 1, 0)
+    return distances
+
+
+def _get_matched_features(seg_ids, t_rows, s_rows, target_feature_breaks,
+                          target_feature_inds, source_feature_breaks,
+                          source_feature_inds, stoplist, num_segments):
+    """Find the features shared at matched positions, segment by segment
+
+    Parameters
+    ----------
+    seg_ids : 1d np.array of int
+        the segment to which each hit belongs
+    t_rows, s_rows : 1d np.array of int
+        the flattened target and source positions of each hit
+    target_feature_breaks, target_feature_inds : 1d np.array of int
+        feature layout of the target positions; see ``_flatten_units()``
+    source_feature_breaks, source_feature_inds : 1d np.array of int
+        feature layout of the source positions; see ``_flatten_units()``
+    stoplist : 1d np.array of int
+        feature indices which may not count as matched features
+    num_segments : int
+
+    Returns
+    -------
+    offsets : 1d np.array of int
+        ``feature_inds[offsets[k]:offsets[k+1]]`` are the matched features of
+        segment k
+    feature_inds : 1d np.array of int
+        matched feature indices, sorted within each segment
+    """
+    t_hits, t_inds = _expand_segments(
+        target_feature_breaks[t_rows],
+        target_feature_breaks[t_rows + 1] - target_feature_breaks[t_rows])
+    s_hits, s_inds = _expand_segments(
+        source_feature_breaks[s_rows],
+        source_feature_breaks[s_rows + 1] - source_feature_breaks[s_rows])
+    t_feats = target_feature_inds[t_inds]
+    s_feats = source_feature_inds[s_inds]
+    t_valid = (t_feats >= 0) & ~np.isin(t_feats, stoplist)
+    s_valid = (s_feats >= 0) & ~np.isin(s_feats, stoplist)
+    t_hits, t_feats = t_hits[t_valid], t_feats[t_valid]
+    s_hits, s_feats = s_hits[s_valid], s_feats[s_valid]
+    features_size = int(max(t_feats.max(initial=-1), s_feats.max(initial=-1)))
+    features_size += 1
+    shared = np.intersect1d(t_hits * features_size + t_feats,
+                            s_hits * features_size + s_feats)
+    seg_feature_keys = np.unique(seg_ids[shared // features_size] *
+                                 features_size + shared % features_size)
+    owners = seg_feature_keys // features_size
+    offsets = np.zeros(num_segments + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owners, minlength=num_segments), out=offsets[1:])
+    return offsets, seg_feature_keys % features_size
+
+
+def _keep_segments(seg_ids, num_segments, kept):
+    """Drop every segment not listed in ``kept``
+
+    Parameters
+    ----------
+    seg_ids : 1d np.array of int
+        the segment to which each entry belongs
+    num_segments : int
+    kept : 1d np.array of int
+        the segments to keep, in ascending order
+
+    Returns
+    -------
+    keep_entry : 1d np.array of bool
+        whether each entry belongs to a kept segment
+    seg_ids : 1d np.array of int
+        the renumbered segment of each kept entry, so that kept segments are
+        contiguous
+    """
+    keep_entry = np.zeros(num_segments, dtype=bool)
+    keep_entry[kept] = True
+    keep_entry = keep_entry[seg_ids]
+    new_ids = np.full(num_segments, -1, dtype=np.int64)
+    new_ids[kept] = np.arange(len(kept))
+    return keep_entry, new_ids[seg_ids[keep_entry]]
+
+
+def _score_batch(hits, target_arrays, source_arrays, target_inv_freqs,
+                 source_inv_freqs, stoplist, distance_basis, max_distance,
+                 min_score=None):
+    """Score every candidate unit pair of a batch at once
+
+    Parameters
+    ----------
+    hits : tuple of 1d np.array of int
+        ``(t_inds, s_inds, offsets, t_positions, s_positions)``; the k-th
+        candidate pair is target unit ``t_inds[k]`` with source unit
+        ``s_inds[k]``, and its matched positions are found in
+        ``t_positions[offsets[k]:offsets[k+1]]`` and
+        ``s_positions[offsets[k]:offsets[k+1]]``
+    target_arrays, source_arrays : tuple of 1d np.array of int
+        the flattened units of each side; see ``_flatten_units()``
+    target_inv_freqs, source_inv_freqs : 1d np.array of float
+        inverse frequency of every flattened position of each side
+    stoplist : 1d np.array of int
+        feature indices on which matches should not be permitted
+    distance_basis : {'frequency', 'span'}
+    max_distance : float
+    min_score : float, optional
+        if given, pairs which could not score at least this much are dropped
+        before their distances are computed
+
+    Returns
+    -------
+    kept : 1d np.array of int
+        indices of the candidate pairs that were accepted as matches
+    scores : 1d np.array of float
+        the score of each accepted pair
+    feature_offsets, feature_inds : 1d np.array of int
+        the matched features of each accepted pair; see
+        ``_get_matched_features()``
+    """
+    t_inds, s_inds, offsets, t_positions, s_positions = hits
+    t_breaks, t_forms, t_feature_breaks, t_feature_inds = target_arrays
+    s_breaks, s_forms, s_feature_breaks, s_feature_inds = source_arrays
+    num_pairs = len(t_inds)
+    seg_ids = np.repeat(np.arange(num_pairs), np.diff(offsets))
+    t_rows = t_breaks[t_inds][seg_ids] + t_positions
+    s_rows = s_breaks[s_inds][seg_ids] + s_positions
+    # every position contributes its inverse frequency once, no matter how
+    # many times it was matched
+    t_segs, t_inv = _at_distinct_positions(seg_ids, t_rows,
+                                           target_inv_freqs[t_rows])
+    s_segs, s_inv = _at_distinct_positions(seg_ids, s_rows,
+                                           source_inv_freqs[s_rows])
+    numerators = np.bincount(np.concatenate([t_segs, s_segs]),
+                             weights=np.concatenate([t_inv, s_inv]),
+                             minlength=num_pairs)
+    candidates = np.arange(num_pairs)
+    if min_score is not None:
+        # the numerator does not depend on distance, so the best a pair can
+        # do is to have the smallest possible distance in both units
+        with np.errstate(divide='ignore'):
+            upper_bounds = np.log(numerators) - np.log(2 * MIN_UNIT_DISTANCE)
+        candidates = np.flatnonzero(upper_bounds >= min_score)
+        if len(candidates) < num_pairs:
+            keep_hit, seg_ids = _keep_segments(seg_ids, num_pairs, candidates)
+            t_positions = t_positions[keep_hit]
+            s_positions = s_positions[keep_hit]
+            t_rows = t_rows[keep_hit]
+            s_rows = s_rows[keep_hit]
+            offsets = np.zeros(len(candidates) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(seg_ids, minlength=len(candidates)),
+                      out=offsets[1:])
+    if distance_basis == 'span':
+        # adjacent matched words have a distance of 2, etc.
+        target_distances = _get_distances_by_span(t_positions, t_forms[t_rows],
+                                                  offsets)
+        source_distances = _get_distances_by_span(s_positions, s_forms[s_rows],
+                                                  offsets)
+    else:
+        target_distances = _get_distances_by_least_frequency(
+            target_inv_freqs[t_rows], t_positions, t_forms[t_rows], offsets)
+        source_distances = _get_distances_by_least_frequency(
+            source_inv_freqs[s_rows], s_positions, s_forms[s_rows], offsets)
+    distances = target_distances + source_distances
+    # fewer than two matching tokens in one of the units means no match
+    kept = np.flatnonzero((target_distances > 0) & (source_distances > 0) &
+                          (distances <= max_distance))
+    keep_hit, seg_ids = _keep_segments(seg_ids, len(candidates), kept)
+    t_rows = t_rows[keep_hit]
+    s_rows = s_rows[keep_hit]
+    feature_offsets, feature_inds = _get_matched_features(
+        seg_ids, t_rows, s_rows, t_feature_breaks, t_feature_inds,
+        s_feature_breaks, s_feature_inds, stoplist, len(kept))
+    kept_pairs = candidates[kept]
+    scores = np.log(numerators[kept_pairs]) - np.log(distances[kept])
+    return kept_pairs, scores, feature_offsets, feature_inds
 
 
 def _extract_features_and_positions(units, stoplist_set):
@@ -458,22 +1181,14 @@ def _extract_features_and_positions(units, stoplist_set):
     >>> break_inds == np.array([0, 1, 3])
 
     """
-    feature_inds = []
-    pos_inds = []
-    break_inds = [0]
-    for unit in units:
-        end_break_inds = break_inds[-1]
-        cur_features = unit['features']
-        for i, features in enumerate(cur_features):
-            valid_features = [
-                f for f in features if f not in stoplist_set and f >= 0
-            ]
-            if -1 in valid_features:
-                print(unit)
-            feature_inds.extend(valid_features)
-            pos_inds.extend([end_break_inds + i] * len(valid_features))
-        break_inds.append(end_break_inds + len(cur_features))
-    return np.array(feature_inds), np.array(pos_inds), np.array(break_inds)
+    break_inds, _, feature_breaks, feature_inds = _flatten_units(units)
+    pos_inds = np.repeat(np.arange(len(feature_breaks) - 1),
+                         np.diff(feature_breaks))
+    valid = feature_inds >= 0
+    if stoplist_set:
+        valid &= ~np.isin(feature_inds,
+                          np.fromiter(stoplist_set, dtype=np.int64))
+    return feature_inds[valid], pos_inds[valid], break_inds
 
 
 def _construct_feature_unit_matrix(units, stoplist_set, features_size):
@@ -548,6 +1263,9 @@ def _bin_hits_to_unit_indices(rows, cols, row2t_unit_ind, target_breaks,
                               source_breaks, su_start):
     """Extract which units matched from the ``match_matrix``
 
+    Hits are grouped by (target unit, source unit) pair by sorting on the pair
+    keys, so that the positions of every pair end up contiguous.
+
     Parameters
     ----------
     rows : 1d np.array of ints
@@ -573,59 +1291,84 @@ def _bin_hits_to_unit_indices(rows, cols, row2t_unit_ind, target_breaks,
 
     Returns
     -------
-    hits2positions : dict [(int, int), 2d np.array of ints]
-        the key is a tuple, where the first value refers to the index of a
-        target unit and the second value refers to the index of a source unit;
-        the associated 2d array tells which positions within the target and
-        source units had a match; in particular, each row represent matched
-        positions, where the value in the first column tells the target
-        position and the the value in the second column tells the source
-        position; there will always be at least two rows in the 2d array
+    t_inds : 1d np.array of ints
+        ``t_inds[k]`` is the index of the target unit of the k-th matched pair
+    s_inds : 1d np.array of ints
+        ``s_inds[k]`` is the index of the source unit of the k-th matched pair
+    offsets : 1d np.array of ints
+        the matched positions of the k-th pair are found in the slice
+        ``offsets[k]:offsets[k+1]`` of ``t_positions`` and ``s_positions``;
+        every pair has at least two matched positions
+    t_positions : 1d np.array of ints
+        matched positions within the target units
+    s_positions : 1d np.array of ints
+        matched positions within the source units, corresponding to
+        ``t_positions``
+
+    Pairs are ordered by source unit and then by target unit; within a pair,
+    matched positions are ordered by target position and then by source
+    position. Since source batches are made up of consecutive source units,
+    pairs thus come out in the same order however the source units were
+    batched.
 
     Example
     -------
-    >>> target_breaks = [0, 2]
-    >>> source_breaks = [0, 3]
+    >>> target_breaks = np.array([0, 2])
+    >>> source_breaks = np.array([0, 3])
     >>> match_matrix = csr_matrix([
     >>> ... [True, False, False],
     >>> ... [False, False, True]
     >>> ... ])
     >>> coo = match_matrix.tocoo()
-    >>> hits2positions = _bin_hits_to_unit_indices(
-    >>> ... coo.rows, coo.cols, target_breaks, target_breaks)
-    >>> hits2positions[(0, 0)] == np.array([[0, 0], [1, 2]])
+    >>> t_inds, s_inds, offsets, t_positions, s_positions = \
+    >>> ... _bin_hits_to_unit_indices(coo.row, coo.col, np.array([0, 0]),
+    >>> ...                            target_breaks, source_breaks, 0)
+    >>> t_inds == np.array([0])
+    >>> s_inds == np.array([0])
+    >>> offsets == np.array([0, 2])
+    >>> t_positions == np.array([0, 1])
+    >>> s_positions == np.array([0, 2])
 
     """
     # keep track of mapping between matrix column index and source unit index
     # in ``source_units``
-    col2s_unit_ind = np.array([
-        u_ind for u_ind in range(len(source_breaks) - 1)
-        for _ in range(source_breaks[u_ind + 1] - source_breaks[u_ind])
-    ])
-    tmp = {}
-    hits2positions = {}
+    col2s_unit_ind = np.repeat(np.arange(len(source_breaks) - 1),
+                               np.diff(source_breaks))
     t_inds = row2t_unit_ind[rows]
     s_inds = col2s_unit_ind[cols]
-    t_poses = rows - target_breaks[t_inds]
-    s_poses = cols - source_breaks[s_inds]
+    order = np.lexsort((cols, rows, t_inds, s_inds))
+    rows = rows[order]
+    cols = cols[order]
+    t_inds = t_inds[order]
+    s_inds = s_inds[order]
+    # each run of equal (t_ind, s_ind) keys makes up one pair
+    is_start = np.ones(len(order), dtype=bool)
+    is_start[1:] = (t_inds[1:] != t_inds[:-1]) | (s_inds[1:] != s_inds[:-1])
+    starts = np.flatnonzero(is_start)
+    sizes = np.diff(np.append(starts, len(order)))
+    # only pairs with at least two matched positions are of interest
+    keep_pair = sizes >= 2
+    keep_hit = np.repeat(keep_pair, sizes)
+    starts = starts[keep_pair]
+    sizes = sizes[keep_pair]
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    pair_t_inds = t_inds[starts]
+    pair_s_inds = s_inds[starts]
+    t_positions = rows[keep_hit] - target_breaks[t_inds[keep_hit]]
+    s_positions = cols[keep_hit] - source_breaks[s_inds[keep_hit]]
     # although s_inds needs to index the source_breaks by the ordering of this
     # batch of source_units, s_inds needs to account for source_unit indices as
     # referenced from outside of this batch
-    s_inds += su_start
-    for t_ind, s_ind, t_pos, s_pos in zip(t_inds, s_inds, t_poses, s_poses):
-        key = (t_ind, s_ind)
-        if key not in tmp:
-            tmp[key] = (t_pos, s_pos)
-        elif key not in hits2positions:
-            hits2positions[key] = [tmp[key], (t_pos, s_pos)]
-        else:
-            hits2positions[key].append((t_pos, s_pos))
-    hits2positions = {k: np.array(v) for k, v in hits2positions.items()}
-    return hits2positions
+    pair_s_inds = pair_s_inds + su_start
+    return (pair_t_inds.astype(np.int64), pair_s_inds.astype(np.int64),
+            offsets, t_positions.astype(np.int64),
+            s_positions.astype(np.int64))
 
 
 def gen_hits2positions(search, conn, target_feature_matrix, target_breaks,
-                       source_units, stoplist_set, features_size):
+                       source_units, stoplist_set, features_size, workers=1,
+                       memory_budget=None):
     """Generate matching units based on unit information
 
     Parameters
@@ -639,6 +1382,12 @@ def gen_hits2positions(search, conn, target_feature_matrix, target_breaks,
     features_size : int
         the total number of feature types for the class of features contained
         in ``units``
+    workers : int, optional
+        how many processes should work on source batches at once; see
+        ``tesserae.utils.parallel.resolve_workers()``
+    memory_budget : int, optional
+        how many bytes the products may take up at once; see
+        ``_gen_source_batches()``
 
     Notes
     -----
@@ -660,37 +1409,496 @@ def gen_hits2positions(search, conn, target_feature_matrix, target_breaks,
 
     Yields
     ------
-    dict [(int, int), 2d np.array of ints]
-        see ``_bin_hits_to_unit_indices()`` for details on what this dictionary
-        contains
+    tuple of 1d np.array of ints
+        ``(t_inds, s_inds, offsets, t_positions, s_positions)`` for one batch
+        of source units; see ``_bin_hits_to_unit_indices()`` for details;
+        batches are always yielded in source unit order, no matter how many
+        workers were used
 
     """
+    arrays, values = _target_matrix_arrays(target_feature_matrix,
+                                           target_breaks)
+    yield from _gen_source_batches(search, conn, _match_source_batch,
+                                   _merge_tile_hits, arrays, values,
+                                   source_units, stoplist_set, features_size,
+                                   workers, memory_budget)
+
+
+def _target_matrix_arrays(target_feature_matrix, target_breaks,
+                          self_search=False):
+    """Break the target matrix down into arrays that can be shared
+
+    Besides the position-level matrix itself, matching needs per unit feature
+    counts, which are used to find candidate unit pairs.
+
+    Parameters
+    ----------
+    self_search : bool, optional
+        whether the source units are the target units themselves; see
+        ``_match_source_batch()``
+
+    Returns
+    -------
+    arrays : dict [str, np.array]
+    values : dict [str, object]
+        see ``_setup_match_context()`` for how these are put back together
+    """
     # keep track of mapping between matrix row index and target unit index
     # in ``target_units``
-    row2t_unit_ind = np.array([
-        u_ind for u_ind in range(len(target_breaks) - 1)
-        for _ in range(target_breaks[u_ind + 1] - target_breaks[u_ind])
-    ])
-    stepsize = 500
-    for su_start in range(0, len(source_units), stepsize):
-        search.update_current_stage_value(su_start / len(source_units))
-        conn.update(search)
+    num_target_units = len(target_breaks) - 1
+    row2t_unit_ind = np.repeat(np.arange(num_target_units),
+                               np.diff(target_breaks))
+    coo = target_feature_matrix.tocoo()
+    unit_feature_counts = csr_matrix(
+        (np.ones(len(coo.row), dtype=np.int32),
+         (row2t_unit_ind[coo.row], coo.col)),
+        shape=(num_target_units, target_feature_matrix.shape[1]))
+    arrays = {
+        'target_data': target_feature_matrix.data,
+        'target_indices': target_feature_matrix.indices,
+        'target_indptr': target_feature_matrix.indptr,
+        'target_count_data': unit_feature_counts.data,
+        'target_count_indices': unit_feature_counts.indices,
+        'target_count_indptr': unit_feature_counts.indptr,
+        'target_breaks': np.asarray(target_breaks),
+        'row2t_unit_ind': row2t_unit_ind
+    }
+    values = {
+        'target_shape': target_feature_matrix.shape,
+        'target_count_shape': unit_feature_counts.shape,
+        'self_search': self_search
+    }
+    return arrays, values
+
+
+def _setup_match_context(context):
+    """Rebuild the target matrices from their shared arrays"""
+    context['target_feature_matrix'] = csr_matrix(
+        (context['target_data'], context['target_indices'],
+         context['target_indptr']),
+        shape=context['target_shape'])
+    context['target_unit_feature_counts'] = csr_matrix(
+        (context['target_count_data'], context['target_count_indices'],
+         context['target_count_indptr']),
+        shape=context['target_count_shape'])
+    return context
+
+
+def _estimate_source_hits(target_indices, features_size, source_units,
+                          stoplist_set):
+    """Bound how many hits every source unit can have against the target
+
+    A source position with feature f hits every target position with feature
+    f, so a source unit has at most as many hits as the target degrees of the
+    features of all its positions add up to.
+
+    Parameters
+    ----------
+    target_indices : 1d np.array of int
+        the feature (column) of every entry of the target matrix
+    features_size : int
+    source_units : list of dict or CompiledUnits
+    stoplist_set : set of int
+
+    Returns
+    -------
+    1d np.array of float
+        the most hits each source unit can have
+    """
+    target_degrees = np.bincount(target_indices, minlength=features_size)
+    breaks, _, feature_breaks, feature_inds = _flatten_units(source_units)
+    unit_starts = feature_breaks[breaks]
+    owners = np.repeat(np.arange(len(breaks) - 1), np.diff(unit_starts))
+    valid = (feature_inds >= 0) & ~np.isin(
+        feature_inds, np.fromiter(stoplist_set, dtype=np.int64,
+                                  count=len(stoplist_set)))
+    return np.bincount(owners[valid],
+                       weights=target_degrees[feature_inds[valid]],
+                       minlength=len(breaks) - 1)
+
+
+def _plan_batches(costs, max_cost):
+    """Cut consecutive items into batches whose costs stay within a budget
+
+    Every batch takes at least one item, even when that item alone goes over
+    ``max_cost``.
+
+    Returns
+    -------
+    list of int
+        batch i is made up of the items ``bounds[i]:bounds[i+1]``
+    """
+    totals = np.cumsum(costs)
+    bounds = [0]
+    while bounds[-1] < len(costs):
+        start = bounds[-1]
+        spent = totals[start - 1] if start else 0
+        stop = int(np.searchsorted(totals, spent + max_cost, side='right'))
+        bounds.append(max(stop, start + 1))
+    return bounds
+
+
+def _gen_source_batch_tasks(search, conn, source_units, stoplist_set,
+                            features_size, bounds, target_counts, max_hits,
+                            self_search=False):
+    """Cut the source units and the target units into tiles to be matched
+
+    Every batch of source units is matched against the target units a tile
+    at a time. Tiles are cut so that each is expected to have no more than
+    ``max_hits`` hits, counting every (target position, source position)
+    combination which shares a feature; a large target is thus never
+    multiplied by a source batch all at once. Since tiles do not depend on
+    one another, they can be handed out to different processes.
+
+    Progress is reported to ``search``, which may also be a list of Search
+    entities (as when several targets are matched at once).
+
+    Parameters
+    ----------
+    bounds : list of int
+        batch i is made up of the source units ``bounds[i]:bounds[i+1]``;
+        see ``_plan_batches()``
+    target_counts : csr_matrix
+        how many positions of every target unit (row) have every feature
+        (column)
+    max_hits : int
+    self_search : bool, optional
+        whether the source units are the target units themselves, in which
+        case a source batch is only matched against the target units after
+        its first unit
+
+    Yields
+    ------
+    su_start : int
+        index of the first source unit of the batch
+    feature_source_matrix : csr_matrix
+        see ``_construct_feature_unit_matrix()``
+    source_breaks : 1d np.array of int
+        see ``_construct_feature_unit_matrix()``
+    t_start, t_stop : int
+        the tile is made up of the target units ``t_start:t_stop``; the
+        tiles of a batch come one after the other, in target unit order
+    """
+    searches = search if isinstance(search, list) else [search]
+    num_target_units = target_counts.shape[0]
+    for su_start, su_stop in zip(bounds[:-1], bounds[1:]):
+        for status in searches:
+            status.update_current_stage_value(su_start / len(source_units))
+            conn.update(status)
         feature_source_matrix, source_breaks = _construct_feature_unit_matrix(
-            source_units[su_start:su_start + stepsize], stoplist_set,
-            features_size)
-        # for every position of each target unit, this matrix multiplication
-        # picks up which source unit positions shared at least one common
-        # feature
-        match_matrix = target_feature_matrix.dot(feature_source_matrix)
-        # this data structure keeps track of which target unit position matched
-        # with which source unit position
-        coo = match_matrix.tocoo()
-        yield _bin_hits_to_unit_indices(coo.row, coo.col, row2t_unit_ind,
-                                        target_breaks, source_breaks, su_start)
+            source_units[su_start:su_stop], stoplist_set, features_size)
+        t_first = min(su_start + 1, num_target_units) if self_search else 0
+        # a target unit hits every source position sharing one of its
+        # features
+        unit_hits = target_counts[t_first:].dot(
+            np.diff(feature_source_matrix.indptr))
+        tiles = _plan_batches(unit_hits, max_hits)
+        if len(tiles) < 2:
+            # even a batch without any target units left gets a task, so
+            # that every batch has a result
+            tiles = [0, 0]
+        for t_start, t_stop in zip(tiles[:-1], tiles[1:]):
+            yield (su_start, feature_source_matrix, source_breaks,
+                   t_first + t_start, t_first + t_stop)
+
+
+def _gen_source_batches(search, conn, func, merge, arrays, values,
+                        source_units, stoplist_set, features_size, workers,
+                        memory_budget=None):
+    """Run ``func`` on every tile of every source batch
+
+    Source units are batched so that a batch is expected to have about
+    ``BATCH_HITS`` hits, or fewer if its hits would not fit otherwise in the
+    share of ``memory_budget`` that each worker gets; see
+    ``_estimate_source_hits()``. Every batch is then matched against the
+    target a tile at a time; see ``_gen_source_batch_tasks()``. Tiles are
+    worked on by up to ``workers`` processes at once, and the results of the
+    tiles of a batch are put back together by ``merge``.
+
+    Parameters
+    ----------
+    func : (dict, tuple) -> object
+        module-level function taking the match context and a task from
+        ``_gen_source_batch_tasks()``
+    merge : list -> object
+        puts the results of ``func`` for the tiles of a batch, in target
+        unit order, back together into the result for the whole batch
+    arrays : dict [str, np.array]
+        read-only arrays needed by ``func``; when more than one worker is
+        used, these are placed in shared memory rather than being copied to
+        every task
+    values : dict [str, object]
+        small picklable values needed by ``func``
+    memory_budget : int, optional
+        how many bytes the products of all workers may take up at once;
+        defaults to ``MATCH_MEMORY_BUDGET``
+
+    Yields
+    ------
+    object
+        the merged result for every source batch, in source unit order
+    """
+    if memory_budget is None:
+        memory_budget = MATCH_MEMORY_BUDGET
+    workers = resolve_workers(workers)
+    max_hits = min(max(memory_budget // (BYTES_PER_HIT * workers), 1),
+                   BATCH_HITS)
+    bounds = _plan_batches(
+        _estimate_source_hits(arrays['target_indices'], features_size,
+                              source_units, stoplist_set), max_hits)
+    target_counts = csr_matrix(
+        (arrays['target_count_data'], arrays['target_count_indices'],
+         arrays['target_count_indptr']),
+        shape=values['target_count_shape'])
+    pending = collections.deque()
+
+    def gen_tasks():
+        for task in _gen_source_batch_tasks(search, conn, source_units,
+                                            stoplist_set, features_size,
+                                            bounds, target_counts, max_hits,
+                                            values['self_search']):
+            pending.append(task[0])
+            yield task
+
+    tasks = gen_tasks()
+    head = list(itertools.islice(tasks, 2))
+    tasks = itertools.chain(head, tasks)
+    # with a single task, there is nothing to gain from extra processes
+    if workers <= 1 or len(head) < 2:
+        context = _setup_match_context(dict(arrays, **values))
+        yield from _merge_tiles((func(context, task) for task in tasks),
+                                pending, merge)
+    else:
+        with SharedArrays(arrays, values) as shared:
+            yield from _merge_tiles(
+                imap_ordered(func, tasks, shared, workers,
+                             setup=_setup_match_context), pending, merge)
+
+
+def _merge_tiles(results, batch_starts, merge):
+    """Put the results of the tiles of every source batch back together
+
+    Parameters
+    ----------
+    results : iterable
+        the result of every tile, in task order
+    batch_starts : collections.deque of int
+        the first source unit of the batch of every task, in task order;
+        entries are taken off as their results come in
+    merge : list -> object
+        see ``_gen_source_batches()``
+    """
+    tiles = []
+    batch = None
+    for result in results:
+        su_start = batch_starts.popleft()
+        if tiles and su_start != batch:
+            yield merge(tiles)
+            tiles = []
+        batch = su_start
+        tiles.append(result)
+    if tiles:
+        yield merge(tiles)
+
+
+def _match_source_batch(context, task):
+    """Find the unit pairs of one tile of a source batch with 2+ matches
+
+    Candidates are found in two stages. First, a unit x unit product of
+    feature counts tells, for every pair of units, how many (target position,
+    source position, shared feature) combinations it has; pairs with fewer
+    than two cannot have two matched positions. Second, the position-level
+    product is only taken over the units which take part in at least one
+    surviving pair.
+
+    Only the target units of the tile take part in either product; see
+    ``_gen_source_batch_tasks()``. When a text is searched within itself
+    (``context['self_search']``), every source unit is furthermore only
+    paired with the target units after it, so that only the upper triangle
+    of the unit x unit product is kept.
+    """
+    su_start, feature_source_matrix, source_breaks, t_start, t_stop = task
+    num_source_units = len(source_breaks) - 1
+    col2s_unit_ind = np.repeat(np.arange(num_source_units),
+                               np.diff(source_breaks))
+    coo = feature_source_matrix.tocoo()
+    feature_unit_counts = csr_matrix(
+        (np.ones(len(coo.row), dtype=np.int32),
+         (coo.row, col2s_unit_ind[coo.col])),
+        shape=(feature_source_matrix.shape[0], num_source_units))
+    target_counts = context['target_unit_feature_counts'][t_start:t_stop]
+    pair_counts = target_counts.dot(feature_unit_counts).tocoo()
+    candidates = pair_counts.data >= 2
+    cand_t = pair_counts.row[candidates].astype(np.int64) + t_start
+    cand_s = pair_counts.col[candidates].astype(np.int64)
+    if context['self_search']:
+        later = cand_t > cand_s + su_start
+        cand_t = cand_t[later]
+        cand_s = cand_s[later]
+    row2t_unit_ind = context['row2t_unit_ind']
+    t_keep = np.zeros(len(context['target_breaks']) - 1, dtype=bool)
+    t_keep[cand_t] = True
+    s_keep = np.zeros(num_source_units, dtype=bool)
+    s_keep[cand_s] = True
+    kept_rows = np.flatnonzero(t_keep[row2t_unit_ind])
+    kept_cols = np.flatnonzero(s_keep[col2s_unit_ind])
+    # units without candidates need not be multiplied at all
+    rows, cols = _candidate_hits(
+        context['target_feature_matrix'][kept_rows],
+        feature_source_matrix[:, kept_cols], kept_rows, kept_cols,
+        row2t_unit_ind, col2s_unit_ind,
+        np.sort(cand_t * num_source_units + cand_s), num_source_units)
+    return _bin_hits_to_unit_indices(rows, cols, row2t_unit_ind,
+                                     context['target_breaks'], source_breaks,
+                                     su_start)
+
+
+def _merge_hits(tiles):
+    """Put the hits of the tiles of a source batch back together
+
+    The pairs of every tile are ordered by source unit, then by target unit,
+    and the tiles cover consecutive ranges of target units; a stable sort by
+    source unit alone thus restores the order of the whole batch.
+
+    Parameters
+    ----------
+    tiles : list of tuple of 1d np.array of int
+        ``(t_inds, s_inds, offsets, t_positions, s_positions)`` of every tile,
+        in target unit order; see ``_bin_hits_to_unit_indices()``
+
+    Returns
+    -------
+    hits : tuple of 1d np.array of int
+        the hits of the whole batch
+    new_index : 1d np.array of int
+        where the k-th pair of the tiles, counted across all of them, ends up
+        among the pairs of ``hits``
+    """
+    t_inds = np.concatenate([tile[0] for tile in tiles])
+    s_inds = np.concatenate([tile[1] for tile in tiles])
+    sizes = np.concatenate([np.diff(tile[2]) for tile in tiles])
+    t_positions = np.concatenate([tile[3] for tile in tiles])
+    s_positions = np.concatenate([tile[4] for tile in tiles])
+    starts = np.zeros(len(sizes), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=starts[1:])
+    order = np.argsort(s_inds, kind='stable')
+    _, hit_inds = _expand_segments(starts[order], sizes[order])
+    offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(sizes[order], out=offsets[1:])
+    new_index = np.empty(len(order), dtype=np.int64)
+    new_index[order] = np.arange(len(order))
+    return ((t_inds[order], s_inds[order], offsets, t_positions[hit_inds],
+             s_positions[hit_inds]), new_index)
+
+
+def _merge_tile_hits(tiles):
+    """Put the hits of the tiles of a source batch back together
+
+    See ``_merge_hits()``.
+    """
+    if len(tiles) == 1:
+        return tiles[0]
+    return _merge_hits(tiles)[0]
+
+
+def _merge_tile_scores(tiles):
+    """Put the scored hits of the tiles of a source batch back together
+
+    Parameters
+    ----------
+    tiles : list of tuple
+        ``(hits, scored)`` of every tile, in target unit order; see
+        ``_match_and_score_source_batch()``
+
+    Returns
+    -------
+    hits, scored : tuple of 1d np.array
+        as for a single tile, but for the whole batch
+    """
+    if len(tiles) == 1:
+        return tiles[0]
+    hits, new_index = _merge_hits([tile_hits for tile_hits, _ in tiles])
+    pair_starts = np.cumsum([0] + [len(tile_hits[0])
+                                   for tile_hits, _ in tiles])
+    kept = new_index[np.concatenate([
+        scored[0] + start for (_, scored), start in zip(tiles, pair_starts)
+    ])]
+    scores = np.concatenate([scored[1] for _, scored in tiles])
+    sizes = np.concatenate([np.diff(scored[2]) for _, scored in tiles])
+    feature_inds = np.concatenate([scored[3] for _, scored in tiles])
+    starts = np.zeros(len(sizes), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=starts[1:])
+    order = np.argsort(kept, kind='stable')
+    _, feature_order = _expand_segments(starts[order], sizes[order])
+    feature_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(sizes[order], out=feature_offsets[1:])
+    return hits, (kept[order], scores[order], feature_offsets,
+                  feature_inds[feature_order])
+
+
+def _candidate_hits(target_tile, source_matrix, tile_rows, kept_cols,
+                    row2t_unit_ind, col2s_unit_ind, cand_keys,
+                    num_source_units):
+    """Multiply a tile of target rows by the source batch
+
+    Parameters
+    ----------
+    target_tile : csr_matrix
+        position x feature rows of the target
+    source_matrix : csr_matrix
+        feature x position columns of the source batch
+    tile_rows, kept_cols : 1d np.array of int
+        the target row and source column that each row of ``target_tile``
+        and each column of ``source_matrix`` stand for
+    cand_keys : 1d np.array of int
+        ``target unit * num_source_units + source unit`` of every candidate
+        pair, in ascending order
+
+    Returns
+    -------
+    rows, cols : 1d np.array of int
+        the target rows and source columns of the hits which belong to
+        candidate pairs
+    """
+    match_matrix = target_tile.dot(source_matrix).tocoo()
+    rows = tile_rows[match_matrix.row]
+    cols = kept_cols[match_matrix.col]
+    # hits of pairs which are not candidates are thrown out before they are
+    # sorted into pairs
+    hit_keys = row2t_unit_ind[rows].astype(np.int64) * num_source_units + \
+        col2s_unit_ind[cols]
+    found = np.searchsorted(cand_keys, hit_keys)
+    found[found == len(cand_keys)] = 0
+    is_candidate = cand_keys[found] == hit_keys if len(cand_keys) else \
+        np.zeros(len(hit_keys), dtype=bool)
+    return rows[is_candidate], cols[is_candidate]
+
+
+def _match_and_score_source_batch(context, task):
+    """Find and score the unit pairs of one source batch
+
+    Returns
+    -------
+    hits : tuple of 1d np.array of int
+        see ``_match_source_batch()``
+    scored : tuple of 1d np.array
+        see ``_score_batch()``
+    """
+    hits = _match_source_batch(context, task)
+    scored = _score_batch(
+        hits,
+        (context['target_unit_breaks'], context['target_forms'],
+         context['target_feature_breaks'], context['target_feature_inds']),
+        (context['source_unit_breaks'], context['source_forms'],
+         context['source_feature_breaks'], context['source_feature_inds']),
+        context['target_inv_freqs'], context['source_inv_freqs'],
+        context['stoplist'], context['distance_basis'],
+        context['max_distance'], context['min_score'])
+    return hits, scored
 
 
 def _gen_matches(search, conn, target_units, source_units, stoplist_set,
-                 features_size):
+                 features_size, workers=1, memory_budget=None):
     """Generate match information where at least 2 positions matched
 
     Parameters
@@ -707,6 +1915,8 @@ def _gen_matches(search, conn, target_units, source_units, stoplist_set,
     features_size : int
         the total number of feature types for the class of features contained
         in ``units``
+    workers : int, optional
+        how many processes should work on source batches at once
 
     Notes
     -----
@@ -728,252 +1938,467 @@ def _gen_matches(search, conn, target_units, source_units, stoplist_set,
 
     Yields
     ------
-    target_index : int
-        index into ``target_units``
-    source_index : int
-        index into ``source_units``
-    positions : 2d np.array
-        the first column contains target positions; the second column has
-        corresponding source positions
+    tuple of 1d np.array of int
+        ``(t_inds, s_inds, offsets, t_positions, s_positions)`` for one batch
+        of source units; the k-th candidate pair is target unit ``t_inds[k]``
+        with source unit ``s_inds[k]``, and its matched positions are found in
+        ``t_positions[offsets[k]:offsets[k+1]]`` and
+        ``s_positions[offsets[k]:offsets[k+1]]``
     """
     target_feature_matrix, target_breaks = _construct_unit_feature_matrix(
         target_units, stoplist_set, features_size)
-    for hits2positions in gen_hits2positions(search, conn,
-                                             target_feature_matrix,
-                                             target_breaks, source_units,
-                                             stoplist_set, features_size):
-        overhits2positions = {
-            k: np.array(v)
-            for k, v in hits2positions.items() if len(v) >= 2
-        }
-        for (t_ind, s_ind), positions in overhits2positions.items():
-            yield (t_ind, s_ind, positions)
+    yield from gen_hits2positions(search, conn, target_feature_matrix,
+                                  target_breaks, source_units, stoplist_set,
+                                  features_size, workers, memory_budget)
 
 
 def _score(search, conn, target_units, source_units, features, stoplist,
-           distance_basis, max_distance, source_inv_frequencies_getter,
-           target_inv_frequencies_getter, tag_helper):
-    match_ents = []
-    numerator_sparse_rows = []
-    numerator_sparse_cols = []
-    numerator_sparse_data = []
-    denominators = []
+           distance_basis, max_distance, source_inv_freq_table,
+           target_inv_freq_table, tag_helper, workers=1, min_score=None,
+           spill_rows=None, memory_budget=None):
+    """Score unit pairs by the words they share
+
+    If ``target_units`` and ``source_units`` are the same object, the units
+    are searched within themselves: every unit is only paired with the units
+    that come after it.
+    """
+    target_inv_freqs = _gather_inverse_frequencies(
+        target_inv_freq_table, _flatten_units(target_units)[1])
+    if target_units is source_units and \
+            source_inv_freq_table is target_inv_freq_table:
+        source_inv_freqs = target_inv_freqs
+    else:
+        source_inv_freqs = _gather_inverse_frequencies(
+            source_inv_freq_table, _flatten_units(source_units)[1])
+    match_table = MatchTable(search.id, source_units, target_units, features,
+                             tag_helper, spill_rows)
+    for hits, scored in _gen_scored_batches(search, conn, target_units,
+                                            source_units, len(features),
+                                            stoplist, distance_basis,
+                                            max_distance, target_inv_freqs,
+                                            source_inv_freqs, workers,
+                                            min_score, memory_budget):
+        _append_scored(match_table, hits, scored)
+    return match_table
+
+
+def _score_stacked(searches, conn, all_target_units, source_units, features,
+                   stoplist, distance_basis, max_distance,
+                   source_inv_freq_table, target_inv_freq_tables, tag_helper,
+                   workers=1, min_score=None, spill_rows=None,
+                   memory_budget=None):
+    """Score one source against several targets in a single pass
+
+    The targets are stacked into one target matrix, and the scored pairs of
+    every source batch are then handed out to the target they belong to.
+    Since every pair is scored on its own, each target ends up with the same
+    matches, in the same order, as if it had been scored alone by
+    ``_score()``.
+
+    Returns
+    -------
+    list of tesserae.matchers.match_table.MatchTable
+        the matches against each target, the ones in ``all_target_units[i]``
+        belonging to ``searches[i]``
+    """
+    target_units = CompiledUnits.concatenate(all_target_units)
+    target_starts = np.zeros(len(all_target_units) + 1, dtype=np.int64)
+    np.cumsum([len(units) for units in all_target_units],
+              out=target_starts[1:])
+    target_inv_freqs = np.concatenate([
+        _gather_inverse_frequencies(table, _flatten_units(units)[1])
+        for table, units in zip(target_inv_freq_tables, all_target_units)
+    ])
+    source_inv_freqs = _gather_inverse_frequencies(
+        source_inv_freq_table, _flatten_units(source_units)[1])
+    match_tables = [
+        MatchTable(search.id, source_units, units, features, tag_helper,
+                   spill_rows)
+        for search, units in zip(searches, all_target_units)
+    ]
+    for hits, scored in _gen_scored_batches(searches, conn, target_units,
+                                            source_units, len(features),
+                                            stoplist, distance_basis,
+                                            max_distance, target_inv_freqs,
+                                            source_inv_freqs, workers,
+                                            min_score, memory_budget):
+        for i, target_hits, target_scored in _split_by_target(
+                hits, scored, target_starts):
+            _append_scored(match_tables[i], target_hits, target_scored)
+    return match_tables
+
+
+def _gen_scored_batches(search, conn, target_units, source_units,
+                        features_size, stoplist, distance_basis, max_distance,
+                        target_inv_freqs, source_inv_freqs, workers=1,
+                        min_score=None, memory_budget=None):
+    """Find and score the unit pairs of every source batch
+
+    Parameters
+    ----------
+    search : tesserae.db.entities.Search or list of Search
+        where progress is reported
+    target_inv_freqs, source_inv_freqs : 1d np.array of float
+        inverse frequency of every flattened position of each side; see
+        ``_gather_inverse_frequencies()``
+
+    Yields
+    ------
+    hits : tuple of 1d np.array of int
+        see ``_match_source_batch()``
+    scored : tuple of 1d np.array
+        see ``_score_batch()``
+    """
     stoplist_set = set(stoplist)
-    features_size = len(features)
-    search_id = search.id
-    for target_ind, source_ind, positions in _gen_matches(
-            search, conn, target_units, source_units, stoplist_set,
-            features_size):
-        target_unit = target_units[target_ind]
-        source_unit = source_units[source_ind]
-        target_forms = np.array(target_unit['forms'])
-        source_forms = np.array(source_unit['forms'])
-        t_positions = positions[:, 0]
-        s_positions = positions[:, 1]
-        if distance_basis == 'span':
-            # adjacent matched words have a distance of 2, etc.
-            target_distance = _get_distance_by_span(t_positions, target_forms)
-            source_distance = _get_distance_by_span(s_positions, source_forms)
-        else:
-            target_distance = _get_distance_by_least_frequency(
-                target_inv_frequencies_getter, t_positions, target_forms)
-            source_distance = _get_distance_by_least_frequency(
-                source_inv_frequencies_getter, s_positions, source_forms)
-        if source_distance <= 0 or target_distance <= 0:
-        # less than two matching tokens in one of the units
-            continue
-        distance = source_distance + target_distance
-        if distance <= max_distance:
-            target_features = target_unit['features']
-            source_features = source_unit['features']
-            match_features = set(
-                itertools.chain.from_iterable([
-                    set(target_features[t_pos]).intersection(
-                        set(source_features[s_pos]))
-                    for t_pos, s_pos in zip(t_positions, s_positions)
-                ]))
-            match_features -= stoplist_set
-            if match_features:
-                match_inv_frequencies = [
-                    target_inv_frequencies_getter(target_forms[pos])
-                    for pos in set(t_positions)
-                ]
-                match_inv_frequencies.extend([
-                    source_inv_frequencies_getter(source_forms[pos])
-                    for pos in set(s_positions)
-                ])
-                numerator_sparse_rows.extend([len(match_ents)] *
-                                            len(match_inv_frequencies))
-                numerator_sparse_cols.extend(
-                    [i for i in range(len(match_inv_frequencies))])
-                numerator_sparse_data.extend(match_inv_frequencies)
-                denominators.append(distance)
-                match_ents.append(
-                    Match(search_id=search_id,
-                        source_unit=source_unit['_id'],
-                        target_unit=target_unit['_id'],
-                        source_tag=tag_helper.get_display_tag(
-                            source_unit['text'], source_unit['tags']),
-                        target_tag=tag_helper.get_display_tag(
-                            target_unit['text'], target_unit['tags']),
-                        matched_features=[
-                            features[int(mf)].token for mf in match_features
-                        ],
-                        source_snippet=source_unit['snippet'],
-                        target_snippet=target_unit['snippet'],
-                        highlight=[
-                            (int(s_pos), int(t_pos))
-                            for s_pos, t_pos in zip(s_positions, t_positions)
-                        ]))
-    if match_ents:
-        numerators = csr_matrix(
-            (numerator_sparse_data, (numerator_sparse_rows,
-                                     numerator_sparse_cols))).sum(axis=-1).A1
-        scores = np.log(numerators) - np.log(denominators)
-        for match, score in zip(match_ents, scores):
-            match.score = score
-#    print('score matrix', scores)
-#    print(match_ents)
-    return match_ents
-    
+    stoplist = np.array(sorted(stoplist_set), dtype=np.int64)
+    target_arrays = _flatten_units(target_units)
+    source_arrays = _flatten_units(source_units)
+    target_feature_matrix, target_breaks = _construct_unit_feature_matrix(
+        target_units, stoplist_set, features_size)
+    arrays, values = _target_matrix_arrays(target_feature_matrix,
+                                           target_breaks,
+                                           target_units is source_units)
+    arrays.update({
+        'target_unit_breaks': target_arrays[0],
+        'target_forms': target_arrays[1],
+        'target_feature_breaks': target_arrays[2],
+        'target_feature_inds': target_arrays[3],
+        'source_unit_breaks': source_arrays[0],
+        'source_forms': source_arrays[1],
+        'source_feature_breaks': source_arrays[2],
+        'source_feature_inds': source_arrays[3],
+        'target_inv_freqs': target_inv_freqs,
+        'source_inv_freqs': source_inv_freqs,
+        'stoplist': stoplist
+    })
+    values.update({
+        'distance_basis': distance_basis,
+        'max_distance': max_distance,
+        'min_score': min_score
+    })
+    yield from _gen_source_batches(search, conn,
+                                   _match_and_score_source_batch,
+                                   _merge_tile_scores, arrays, values,
+                                   source_units, stoplist_set, features_size,
+                                   workers, memory_budget)
+
+
+def _split_by_target(hits, scored, target_starts):
+    """Hand out the scored pairs of stacked targets to their targets
+
+    Parameters
+    ----------
+    hits : tuple of 1d np.array of int
+        see ``_match_source_batch()``
+    scored : tuple of 1d np.array
+        see ``_score_batch()``
+    target_starts : 1d np.array of int
+        the units of target i are ``target_starts[i]:target_starts[i+1]`` of
+        the stacked target units
+
+    Yields
+    ------
+    i : int
+        which target
+    hits, scored : tuple of 1d np.array
+        the pairs of target i, with target unit indices counted from the
+        start of target i
+    """
+    kept, scores, feature_offsets, feature_inds = scored
+    t_inds = hits[0]
+    owners = np.searchsorted(target_starts, t_inds[kept], side='right') - 1
+    feature_segs = np.repeat(np.arange(len(kept)), np.diff(feature_offsets))
+    for i in np.unique(owners).tolist():
+        rows = np.flatnonzero(owners == i)
+        keep_feature, segs = _keep_segments(feature_segs, len(kept), rows)
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(segs, minlength=len(rows)), out=offsets[1:])
+        yield (i, (t_inds - target_starts[i],) + tuple(hits[1:]),
+               (kept[rows], scores[rows], offsets,
+                feature_inds[keep_feature]))
+
+
+def _append_scored(match_table, hits, scored):
+    """Add the accepted pairs of a scored batch to ``match_table``
+
+    Parameters
+    ----------
+    match_table : tesserae.matchers.match_table.MatchTable
+    hits : tuple of 1d np.array of int
+        see ``_match_source_batch()``
+    scored : tuple of 1d np.array
+        see ``_score_batch()``
+    """
+    kept, scores, feature_offsets, feature_inds = scored
+    t_inds, s_inds, offsets, t_positions, s_positions = hits
+    sizes = offsets[kept + 1] - offsets[kept]
+    _, hit_inds = _expand_segments(offsets[kept], sizes)
+    highlight_offsets = np.zeros(len(kept) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=highlight_offsets[1:])
+    match_table.append(s_inds[kept], t_inds[kept], scores, highlight_offsets,
+                       s_positions[hit_inds], t_positions[hit_inds],
+                       feature_offsets, feature_inds)
+
 
 def _score_sound(search, conn, target_units, source_units, features, stoplist,
-           distance_basis, max_distance, source_inv_frequencies_getter,
-           target_inv_frequencies_getter, tag_helper):
-    match_ents = []
-    numerator_sparse_rows = []
-    numerator_sparse_cols = []
-    numerator_sparse_data = []
-    denominators = []
+                 distance_basis, max_distance, source_inv_freq_table,
+                 target_inv_freq_table, tag_helper, workers=1, min_score=None,
+                 spill_rows=None, memory_budget=None):
+    """Score unit pairs by the sound features (trigrams) they share
+
+    Unlike ``_score()``, matched positions are counted in terms of the
+    flattened list of a unit's sound features rather than its words, and
+    distances are always computed by least frequency. See
+    ``_score_sound_batch()`` for the details. As with ``_score()``, passing
+    the same units on both sides searches them within themselves.
+    """
     stoplist_set = set(stoplist)
+    stoplist = np.array(sorted(stoplist_set), dtype=np.int64)
     features_size = len(features)
-    search_id = search.id
-    for target_ind, source_ind, positions in _gen_matches(
-            search, conn, target_units, source_units, stoplist_set,
-            features_size):
-        target_unit = target_units[target_ind]
-        source_unit = source_units[source_ind]
-        # the positions of the words in the sentence
-        # (needed for highlighting in the front end)
-        t_word_pos = positions[:, 0]
-        s_word_pos = positions[:, 1]       
-        target_sounds = []
-        source_sounds = []
-        # unpack indices of sound features from target_unit['features'] and source_unit['features']
-        # and append them to target_sounds and source_sounds, respectively, 
-        # in order of appearance in the text
-        for a in target_unit['features']:
-            for b in a:
-                target_sounds.append(b)
-        for a in source_unit['features']:
-            for b in a:
-                source_sounds.append(b)
-        t_positions = []
-        s_positions = []
-        # append to t_positions and s_positions 
-        # the positions in the text of the *matching sound features*.
-        # built differently from t_positions and s_positions in _score,
-        # where they record instead the positions in the text of *matching word forms*
-        for target in target_sounds:
-            for source in source_sounds:
-                if target == source:
-                    t_positions.append(target_sounds.index(target))
-                    s_positions.append(source_sounds.index(source))
-        # _get_distance_by_least_frequency expects these as 1d arrays
-        t_positions = np.array(t_positions)
-        s_positions = np.array(s_positions)
-        target_sounds = np.array(target_sounds)
-        source_sounds = np.array(source_sounds)
-        # get the shortest distance of a pair of the least frequent sound features
-        target_distance = _get_distance_by_least_frequency(
-                target_inv_frequencies_getter, t_positions, target_sounds)
-        source_distance = _get_distance_by_least_frequency(
-                source_inv_frequencies_getter, s_positions, source_sounds)
-#            target_distance = _get_sound_distance_by_least_frequency(
-#                    target_inv_frequencies_getter, t_positions, target_sounds)
-#        print('target', target_sounds, target_distance)
-#            source_distance = _get_sound_distance_by_least_frequency(
-#                    source_inv_frequencies_getter, s_positions, source_sounds)
-#        print('source', source_sounds, source_distance)
-        if source_distance <= 0 or target_distance <= 0:
-        # less than two matching tokens in one of the units
-            continue
-        # distance is both used to compare to max_distance below 
-        # and will become the denominator in the scoring formula
-        distance = source_distance + target_distance
-        # if distance > max_distance, then the matched sound features 
-        # are too far apart to make the lines 'sound alike'
-        if distance <= max_distance:
-            # now we are once again interested in 
-            # not just the least frequent sound features, 
-            # but in all the matching sound features
-            target_features = target_unit['features']
-            source_features = source_unit['features']
-            match_features = set(
-                itertools.chain.from_iterable([
-                    set(target_sounds).intersection(
-                        set(source_sounds))
-                ]))
-            match_features -= stoplist_set
-            if match_features:
-                match_inv_frequencies = [
-                    target_inv_frequencies_getter(target_sounds[pos])
-                    for pos in t_positions
-                ]
-                match_inv_frequencies.extend([
-                    source_inv_frequencies_getter(source_sounds[pos])
-                    for pos in s_positions
-                ])
-                numerator_sparse_rows.extend([len(match_ents)] *
-                                            len(match_inv_frequencies))
-                numerator_sparse_cols.extend(
-                    [i for i in range(len(match_inv_frequencies))])
-                numerator_sparse_data.extend(match_inv_frequencies)
-                denominators.append(distance)
-                # match_ents.highlight is not the positions of sound features
-                # in a line, but the positions of the words to which they belong
-                match_ents.append(
-                    Match(search_id=search_id,
-                        source_unit=source_unit['_id'],
-                        target_unit=target_unit['_id'],
-                        source_tag=tag_helper.get_display_tag(
-                            source_unit['text'], source_unit['tags']),
-                        target_tag=tag_helper.get_display_tag(
-                            target_unit['text'], target_unit['tags']),
-                        matched_features=[
-                            features[int(mf)].token for mf in match_features
-                        ],
-                        source_snippet=source_unit['snippet'],
-                        target_snippet=target_unit['snippet'],
-                        highlight=[
-                            (int(s_pos), int(t_pos))
-                            for s_pos, t_pos in zip(s_word_pos, t_word_pos)
-                        ]))
-                #in this version match_ents.highlight is an *array* of positions
-#               match_ents.append(
-#                    Match(search_id=search_id,
-#                        source_unit=source_unit['_id'],
-#                        target_unit=target_unit['_id'],
-#                        source_tag=tag_helper.get_display_tag(
-#                            source_unit['text'], source_unit['tags']),
-#                        target_tag=tag_helper.get_display_tag(
-#                            target_unit['text'], target_unit['tags']),
-#                        matched_features=[
-#                            features[int(mf)].token for mf in match_features
-#                        ],
-#                        source_snippet=source_unit['snippet'],
-#                        target_snippet=target_unit['snippet'],
-#                        highlight=positions
-#                    ))
-    if match_ents:
-        numerators = csr_matrix(
-            (numerator_sparse_data, (numerator_sparse_rows,
-                                     numerator_sparse_cols))).sum(axis=-1).A1
-        scores = np.log(numerators) - np.log(denominators)
-        for match, score in zip(match_ents, scores):
-            match.score = score
-#    print('score matrix', scores)
-#    print(match_ents)
-    return match_ents
-    
-    
+    target_arrays = _flatten_units(target_units)
+    source_arrays = _flatten_units(source_units)
+    # sound features are offset by one so that -1 can be looked up as well
+    num_values = int(max(target_arrays[3].max(initial=-1),
+                         source_arrays[3].max(initial=-1))) + 2
+    source_keys, source_counts, source_firsts = _index_unit_values(
+        source_arrays, num_values)
+    common_values = np.intersect1d(target_arrays[3], source_arrays[3])
+    target_feature_matrix, target_breaks = _construct_unit_feature_matrix(
+        target_units, stoplist_set, features_size)
+    arrays, values = _target_matrix_arrays(target_feature_matrix,
+                                           target_breaks,
+                                           target_units is source_units)
+    arrays.update({
+        'target_unit_breaks': target_arrays[0],
+        'target_feature_breaks': target_arrays[2],
+        'target_feature_inds': target_arrays[3],
+        'source_value_keys': source_keys,
+        'source_value_counts': source_counts,
+        'source_value_firsts': source_firsts,
+        'target_value_inv_freqs': _inverse_frequencies_by_value(
+            target_inv_freq_table, common_values, num_values),
+        'source_value_inv_freqs': _inverse_frequencies_by_value(
+            source_inv_freq_table, common_values, num_values),
+        'stoplist': stoplist
+    })
+    values.update({
+        'num_values': num_values,
+        'max_distance': max_distance,
+        'min_score': min_score
+    })
+    match_table = MatchTable(search.id, source_units, target_units, features,
+                             tag_helper, spill_rows)
+    for hits, scored in _gen_source_batches(search, conn,
+                                            _match_and_score_sound_batch,
+                                            _merge_tile_scores, arrays,
+                                            values, source_units,
+                                            stoplist_set, features_size,
+                                            workers, memory_budget):
+        _append_scored(match_table, hits, scored)
+    return match_table
+
+
+def _index_unit_values(unit_arrays, num_values):
+    """Index the distinct sound features of every unit
+
+    Parameters
+    ----------
+    unit_arrays : tuple of 1d np.array of int
+        flattened units; see ``_flatten_units()``
+    num_values : int
+        one more than the largest feature index, plus one
+
+    Returns
+    -------
+    keys : 1d np.array of int
+        ``unit * num_values + feature + 1`` for every distinct (unit, feature)
+        pair, in ascending order
+    counts : 1d np.array of int
+        how many times the feature appears in the flattened feature list of
+        the unit
+    firsts : 1d np.array of int
+        where the feature first appears in the flattened feature list of the
+        unit
+    """
+    unit_breaks, _, feature_breaks, feature_inds = unit_arrays
+    unit_starts = feature_breaks[unit_breaks]
+    owners = np.repeat(np.arange(len(unit_breaks) - 1),
+                       np.diff(unit_starts))
+    keys = owners * num_values + feature_inds + 1
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    is_new = np.ones(len(order), dtype=bool)
+    is_new[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    starts = np.flatnonzero(is_new)
+    counts = np.diff(np.append(starts, len(order)))
+    firsts = order[starts] - unit_starts[owners[order[starts]]]
+    return sorted_keys[starts], counts, firsts
+
+
+def _inverse_frequencies_by_value(inv_freqs, values, num_values):
+    """Look up inverse frequencies once, for use by feature index
+
+    Parameters
+    ----------
+    inv_freqs : 1d np.array of float
+        laid out as by ``tesserae.utils.freqcache.inverse_frequency_table()``
+    values : 1d np.array of int
+        the feature indices to look up
+    num_values : int
+        one more than the largest feature index, plus one
+
+    Returns
+    -------
+    1d np.array of float
+        the inverse frequency of feature ``f`` is found at ``f + 1``; features
+        which were not looked up, or which have no inverse frequency, are NaN
+    """
+    result = np.full(num_values, np.nan)
+    known = values < len(inv_freqs) - 1
+    result[values[known] + 1] = inv_freqs[values[known]]
+    return result
+
+
+def _score_sound_batch(hits, target_arrays, source_index, target_value_inv,
+                       source_value_inv, num_values, stoplist, max_distance,
+                       min_score=None):
+    """Score every candidate unit pair of a batch by shared sound features
+
+    For a pair of units, let T and S be the flattened lists of their sound
+    features. A feature found in both lists is matched at its first position
+    in each list, once for every combination of its occurrences in T and in
+    S. Every such combination contributes the feature's inverse frequency in
+    each text to the numerator, in the order in which the combinations come
+    up when walking through T and then through S. Distances are computed by
+    least frequency over the first positions of the matched features.
+
+    Parameters
+    ----------
+    hits : tuple of 1d np.array of int
+        see ``_score_batch()``
+    target_arrays : tuple of 1d np.array of int
+        the flattened target units; see ``_flatten_units()``
+    source_index : tuple of 1d np.array of int
+        the distinct features of the source units; see
+        ``_index_unit_values()``
+    target_value_inv, source_value_inv : 1d np.array of float
+        inverse frequencies by feature index; see
+        ``_inverse_frequencies_by_value()``
+    num_values : int
+    stoplist : 1d np.array of int
+        feature indices which may not count as matched features
+    max_distance : float
+    min_score : float, optional
+        if given, pairs which could not score at least this much are dropped
+        before their distances are computed
+
+    Returns
+    -------
+    tuple
+        see ``_score_batch()``
+    """
+    t_inds, s_inds = hits[0], hits[1]
+    t_breaks, _, t_feature_breaks, t_feature_inds = target_arrays
+    source_keys, source_counts, source_firsts = source_index
+    num_pairs = len(t_inds)
+    t_starts = t_feature_breaks[t_breaks[t_inds]]
+    t_sizes = t_feature_breaks[t_breaks[t_inds + 1]] - t_starts
+    # every entry of T, for every pair, in order
+    owners, entries = _expand_segments(t_starts, t_sizes)
+    values = t_feature_inds[entries]
+    t_local = entries - t_starts[owners]
+    keys = s_inds[owners] * num_values + values + 1
+    found = np.searchsorted(source_keys, keys)
+    found[found == len(source_keys)] = 0
+    shared = source_keys[found] == keys if len(source_keys) else \
+        np.zeros(len(keys), dtype=bool)
+    owners = owners[shared]
+    values = values[shared]
+    t_local = t_local[shared]
+    found = found[shared]
+    s_counts = source_counts[found]
+    t_inv = target_value_inv[values + 1]
+    s_inv = source_value_inv[values + 1]
+    if np.isnan(t_inv).any() or np.isnan(s_inv).any():
+        missing = values[np.isnan(t_inv) | np.isnan(s_inv)][0]
+        raise KeyError(int(missing))
+    # lay out the contributions of each pair (first those from T, then those
+    # from S) one after the other, to be added up with the same (pairwise)
+    # summation as a sparse matrix row sum
+    seg_ids = np.repeat(owners, s_counts)
+    order = np.argsort(np.concatenate([seg_ids, seg_ids]), kind='stable')
+    contributions = np.concatenate([np.repeat(t_inv, s_counts),
+                                    np.repeat(s_inv, s_counts)])[order]
+    sizes = 2 * np.bincount(seg_ids, minlength=num_pairs)
+    numerators = np.zeros(num_pairs)
+    nonempty = np.flatnonzero(sizes)
+    if len(nonempty):
+        starts = np.cumsum(sizes) - sizes
+        numerators[nonempty] = np.add.reduceat(contributions,
+                                               starts[nonempty])
+    reachable = np.ones(num_pairs, dtype=bool)
+    if min_score is not None:
+        # no pair can be closer than two units apart, so this is the best
+        # score each pair could get
+        with np.errstate(divide='ignore'):
+            upper_bounds = np.log(numerators) - np.log(2 * MIN_UNIT_DISTANCE)
+        reachable = upper_bounds >= min_score
+        survivors = reachable[owners]
+        owners = owners[survivors]
+        values = values[survivors]
+        t_local = t_local[survivors]
+        found = found[survivors]
+        t_inv = t_inv[survivors]
+        s_inv = s_inv[survivors]
+    # the first entry of every (pair, feature) is where the feature first
+    # appears in T
+    order = np.lexsort((t_local, values, owners))
+    owners = owners[order]
+    values = values[order]
+    is_new = np.ones(len(order), dtype=bool)
+    is_new[1:] = (owners[1:] != owners[:-1]) | (values[1:] != values[:-1])
+    firsts = order[is_new]
+    owners = owners[is_new]
+    values = values[is_new]
+    offsets = np.zeros(num_pairs + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owners, minlength=num_pairs), out=offsets[1:])
+    target_distances = _get_distances_by_least_frequency(
+        t_inv[firsts], t_local[firsts], values, offsets)
+    source_distances = _get_distances_by_least_frequency(
+        s_inv[firsts], source_firsts[found[firsts]], values, offsets)
+    distances = target_distances + source_distances
+    is_feature = ~np.isin(values, stoplist)
+    accepted = reachable & (target_distances > 0) & \
+        (source_distances > 0) & (distances <= max_distance) & \
+        (np.bincount(owners[is_feature], minlength=num_pairs) > 0)
+    kept = np.flatnonzero(accepted)
+    keep_feature, feature_segs = _keep_segments(owners[is_feature], num_pairs,
+                                                kept)
+    feature_offsets = np.zeros(len(kept) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(feature_segs, minlength=len(kept)),
+              out=feature_offsets[1:])
+    scores = np.log(numerators[kept]) - np.log(distances[kept])
+    return kept, scores, feature_offsets, values[is_feature][keep_feature]
+
+
+def _match_and_score_sound_batch(context, task):
+    """Find the unit pairs of one source batch and score them by sound
+
+    Returns
+    -------
+    hits : tuple of 1d np.array of int
+        see ``_match_source_batch()``
+    scored : tuple of 1d np.array
+        see ``_score_sound_batch()``
+    """
+    hits = _match_source_batch(context, task)
+    scored = _score_sound_batch(
+        hits,
+        (context['target_unit_breaks'], None,
+         context['target_feature_breaks'], context['target_feature_inds']),
+        (context['source_value_keys'], context['source_value_counts'],
+         context['source_value_firsts']),
+        context['target_value_inv_freqs'], context['source_value_inv_freqs'],
+        context['num_values'], context['stoplist'], context['max_distance'],
+        context['min_score'])
+    return hits, scored
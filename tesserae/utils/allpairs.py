@@ -0,0 +1,293 @@
+"""Functionality related to searching every text of a language against every
+other
+
+The text x text intertext graph of a language is made up of one regular
+search for every ordered pair of texts. Pairs are scheduled a row at a time:
+all of the pairs sharing a source make up a single one-against-corpus search
+(see ``tesserae.utils.search.submit_corpus_search``), so that the source is
+only prepared once and its targets are stacked together. Rows are handed to
+the workers of the JobQueue, those with the most pairs first, so that no
+worker is left with a long row at the end.
+
+The pairs of the job are stored a row at a time (see
+``tesserae.db.entities.AllPairsRow``), since a language with many texts has
+far too many pairs to fit in a single database entry.
+
+The all-pairs job has a Search of its own, which keeps track of its rows: it
+is done once every row is done, and failed if any row failed.
+
+Pairs which were already searched with the same parameters are looked up
+rather than searched again. Submitting the job again after a text was
+ingested thus only searches the new text against every other text (its row)
+and every other text against the new text (its column).
+"""
+import datetime
+import uuid
+
+import tesserae.matchers
+from tesserae.db.entities import AllPairsRow, Search, Text
+from tesserae.utils.search import CORPUS_SEARCH, NORMAL_SEARCH, \
+    check_cache, get_results_count, get_text_options, submit_corpus_search
+
+ALLPAIRS_SEARCH = 'allpairs'
+
+
+def submit_all_pairs(jobqueue, connection, results_id, matcher_type,
+                     language, unit_type, search_params):
+    """Submit jobs for searching every text of a language against every other
+
+    Parameters
+    ----------
+    jobqueue : tesserae.utils.coordinate.JobQueue
+    connection : TessMongoConnection
+    results_id : str
+        UUID to associate with the all-pairs job
+    matcher_type : str
+        the matcher to use; must be a key in tesserae.matchers.matcher_map
+        of a matcher which can ``match_corpus()``
+    language : str
+        the language whose texts are to be searched
+    unit_type : {'line', 'phrase'}
+        the units to search by; prose texts are always searched by phrase
+    search_params : dict
+        as for ``tesserae.utils.search.submit_search()``, but without
+        'source' and 'target'
+
+    Returns
+    -------
+    int
+        how many pairs had to be searched, as opposed to being found among
+        earlier results
+    """
+    matcher_class = tesserae.matchers.matcher_map[matcher_type]
+    texts = sorted(connection.find(Text.collection, language=language),
+                   key=lambda t: str(t.id))
+    options = [get_text_options(text, unit_type) for text in texts]
+    all_pairs_rows = []
+    rows = []
+    for i, source in enumerate(options):
+        all_pairs_row = AllPairsRow(all_pairs_id=results_id, index=i)
+        row = []
+        for target in options:
+            if target is source:
+                continue
+            parameters = matcher_class.paramify(
+                dict(search_params, source=source, target=target))
+            pair = {
+                'target': parameters['target'],
+                'results_id': check_cache(connection, parameters['source'],
+                                          parameters['target'],
+                                          parameters['method'])
+            }
+            if pair['results_id'] is None:
+                row.append((target, pair))
+            all_pairs_row.source = parameters['source']
+            all_pairs_row.pairs.append(pair)
+        all_pairs_rows.append(all_pairs_row)
+        if row:
+            rows.append((source, all_pairs_row, row))
+    # a row is worked through by a single worker, so the longest ones are
+    # started first
+    rows.sort(key=lambda r: -len(r[2]))
+    for _, all_pairs_row, _ in rows:
+        all_pairs_row.row_id = str(uuid.uuid4())
+    all_pairs_rows = [r for r in all_pairs_rows if r.pairs]
+    parameters = {
+        'language': language,
+        'units': unit_type,
+        'rows': [all_pairs_row.row_id for _, all_pairs_row, _ in rows]
+    }
+    if all_pairs_rows:
+        parameters['method'] = matcher_class.paramify(
+            dict(search_params, source=options[0],
+                 target=options[1]))['method']
+    results_status = Search(results_id=results_id,
+                            search_type=ALLPAIRS_SEARCH,
+                            status=Search.RUN if rows else Search.DONE,
+                            msg='',
+                            parameters=parameters)
+    results_status.add_new_stage('search rows')
+    if not rows:
+        results_status.update_current_stage_value(1.0)
+    # the job must be stored before any of its rows can finish
+    connection.insert(results_status)
+    row_queue = _RowQueue(jobqueue, results_id)
+    for source, all_pairs_row, row in rows:
+        pair_ids = submit_corpus_search(
+            row_queue, connection, all_pairs_row.row_id, matcher_type,
+            dict(search_params,
+                 source=source,
+                 targets=[target for target, _ in row]))
+        for (_, pair), pair_id in zip(row, pair_ids):
+            pair['results_id'] = pair_id
+    if all_pairs_rows:
+        connection.insert(all_pairs_rows)
+    return sum(len(row) for _, _, row in rows)
+
+
+class _RowQueue:
+    """Queues the rows of an all-pairs job
+
+    Jobs are handed on to the JobQueue, wrapped so that the status of the
+    all-pairs job is brought up to date whenever one of its rows finishes.
+    """
+
+    def __init__(self, jobqueue, results_id):
+        self.jobqueue = jobqueue
+        self.results_id = results_id
+        self.processes_per_job = jobqueue.processes_per_job
+        self.memory_per_job = jobqueue.memory_per_job
+
+    def queue_job(self, instructions, kwargs):
+        self.jobqueue.queue_job(
+            _run_row, {
+                'results_id': self.results_id,
+                'instructions': instructions,
+                'row_kwargs': kwargs
+            })
+
+
+def _run_row(connection, results_id, instructions, row_kwargs):
+    """Instructions for searching a row of an all-pairs job
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    results_id : str
+        UUID of the all-pairs job
+    instructions : (TessMongoConnection, ...) -> None
+        the instructions for searching the row
+    row_kwargs : dict
+        named values to provide to ``instructions``
+
+    """
+    try:
+        instructions(connection, **row_kwargs)
+    finally:
+        _update_all_pairs_status(connection, results_id)
+
+
+def _update_all_pairs_status(connection, results_id):
+    """Bring the status of an all-pairs job in line with that of its rows
+
+    The job is done once all of its rows are done, and failed once all of
+    them are finished and at least one of them failed.
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    results_id : str
+        UUID of the all-pairs job
+
+    """
+    found = connection.find(Search.collection, results_id=results_id,
+                            search_type=ALLPAIRS_SEARCH)
+    if not found:
+        return
+    results_status = found[0]
+    row_ids = results_status.parameters['rows']
+    # rows which were not submitted yet are not found, and so are counted
+    # as unfinished
+    row_statuses = connection.find(Search.collection, results_id=row_ids,
+                                   search_type=CORPUS_SEARCH)
+    finished = [
+        row for row in row_statuses
+        if row.status in (Search.DONE, Search.FAILED)
+    ]
+    results_status.update_current_stage_value(len(finished) / len(row_ids))
+    results_status.last_queried = datetime.datetime.utcnow()
+    if len(finished) == len(row_ids):
+        failed = [
+            row.results_id for row in finished if row.status == Search.FAILED
+        ]
+        if failed:
+            results_status.status = Search.FAILED
+            results_status.msg = 'Failed rows: {}'.format(', '.join(failed))
+        else:
+            results_status.status = Search.DONE
+            results_status.msg = 'Done'
+    connection.update(results_status)
+
+
+def get_all_pairs_summary(connection, results_id):
+    """Summarize the searches making up an all-pairs job
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    results_id : str
+        UUID of the all-pairs job
+
+    Returns
+    -------
+    list of dict
+        one dictionary per ordered pair of texts, with the keys 'source' and
+        'target' (the ObjectId string of each Text), 'results_id' (of the
+        search for the pair), 'status' (of that search) and 'matches' (how
+        many matches it found, or None if it is not done yet)
+
+    Raises
+    ------
+    ValueError
+        Raised when there is no all-pairs job with the given results_id
+    """
+    found = connection.find(Search.collection, results_id=results_id,
+                            search_type=ALLPAIRS_SEARCH)
+    if not found:
+        raise ValueError(f'No all-pairs job with results_id "{results_id}"')
+    summary = []
+    # rows are read from a cursor, so that only a batch of them is held at
+    # a time
+    cursor = connection.connection[AllPairsRow.collection].find(
+        {'all_pairs_id': results_id}, sort=[('index', 1)])
+    for doc in cursor:
+        summary.extend(
+            _summarize_row(connection, AllPairsRow.json_decode(doc)))
+    return summary
+
+
+def _summarize_row(connection, all_pairs_row):
+    """Summarize the searches for the pairs of one row of an all-pairs job
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    all_pairs_row : tesserae.db.entities.AllPairsRow
+
+    Returns
+    -------
+    list of dict
+        as for ``get_all_pairs_summary()``, for the pairs of the row
+    """
+    statuses = {
+        s.results_id: s
+        for s in connection.find(
+            Search.collection,
+            results_id=[p['results_id'] for p in all_pairs_row.pairs],
+            search_type=NORMAL_SEARCH)
+    }
+    # the row's search records how many matches each of its pairs found
+    counts = {}
+    if all_pairs_row.row_id is not None:
+        for row in connection.find(Search.collection,
+                                   results_id=all_pairs_row.row_id,
+                                   search_type=CORPUS_SEARCH):
+            for target in row.parameters['targets']:
+                if 'matches' in target:
+                    counts[target['results_id']] = target['matches']
+    summary = []
+    for pair in all_pairs_row.pairs:
+        status = statuses.get(pair['results_id'])
+        matches = counts.get(pair['results_id'])
+        if matches is None and status is not None and \
+                status.status == Search.DONE:
+            # the pair was searched before this job
+            matches = get_results_count(connection, status.id)
+        summary.append({
+            'source': all_pairs_row.source['object_id'],
+            'target': pair['target']['object_id'],
+            'results_id': pair['results_id'],
+            'status': status.status if status is not None else None,
+            'matches': matches
+        })
+    return summary
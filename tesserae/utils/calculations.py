@@ -4,7 +4,8 @@ from bson import ObjectId
 import numpy as np
 import pandas as pd
 from scipy.sparse import csr_matrix
-from tesserae.db.entities import Feature, Unit
+from tesserae.db.entities import Feature, FeatureCounts, Unit
+from tesserae.utils.unitcache import load_text_units
 
 def get_text_frequencies(connection,text,feature='lemmata'):
     result = connection.aggregate('tokens',[{'$match': {'text': ObjectId(text)}}, 
@@ -47,38 +48,90 @@ def get_corpus_frequencies(connection, feature, language):
     np.array
     """
     pipeline = [
-        # Get all database documents of the specified feature and language
-        # (from the "features" collection, as we later find out).
+        # Get the feature counts of every text of the specified feature and
+        # language (from the "feature_counts" collection).
         {'$match': {'feature': feature, 'language': language}},
-        # Transform each document.
+        # Pair up each feature index with its count in the text,
         {'$project': {
-            # Don't keep their database identifiers,
             '_id': False,
-            # but keep their indices.
-            'index': True,
-            # Also show their frequency,
-            'frequency': {
-                # which is calculated by summing over all the count values
-                # found in the sub-document obtained by checking the
-                # "frequencies" key in the original document.
-                '$reduce': {
-                    'input': {'$objectToArray': '$frequencies'},
-                    'initialValue': 0,
-                    'in': {'$sum': ['$$value', '$$this.v']}
-                }
-            }
+            'pairs': {'$zip': {'inputs': ['$indices', '$counts']}}
         }},
-        # Finally, sort those transformed documents by their index.
-        {'$sort': {'index': 1}}
+        # and take the pairs one at a time.
+        {'$unwind': '$pairs'},
+        # Then sum the counts of each feature index over all of the texts.
+        {'$group': {
+            '_id': {'$arrayElemAt': ['$pairs', 0]},
+            'frequency': {'$sum': {'$arrayElemAt': ['$pairs', 1]}}
+        }}
     ]
 
-    freqs = connection.aggregate(
-            Feature.collection, pipeline, encode=False)
-    freqs = list(freqs)
-    freqs = np.array([freq['frequency'] for freq in freqs])
+    counts = connection.aggregate(
+            FeatureCounts.collection, pipeline, encode=False)
+    # features not found in any text are counted as 0
+    freqs = np.zeros(
+        connection.connection[Feature.collection].count_documents(
+            {'feature': feature, 'language': language}))
+    for count in counts:
+        freqs[count['_id']] = count['frequency']
     return freqs / sum(freqs)
 
 
+def count_matching_tokens(connection, feature, text_id):
+    """Count, for each word type of a text, the tokens matching it
+
+    A token matches a word type when the token's word type shares at least
+    one feature type with it. Word types are identified by form index.
+
+    Parameters
+    ----------
+    connection : tesserae.db.mongodb.TessMongoConnection
+    feature : str
+        Feature category by which tokens are matched
+    text_id : bson.objectid.ObjectId
+        ObjectId of the text whose tokens are to be counted
+
+    Returns
+    -------
+    word_types : 1d np.array of int
+        the form index of every word type found in the line units of the
+        text, in ascending order
+    counts : 1d np.array of int
+        ``counts[i]`` is the number of tokens in the text matching
+        ``word_types[i]``
+    token_count : int
+        the number of tokens in the text
+    """
+    units = load_text_units(connection, text_id, 'line', feature)
+    forms = np.asarray(units.forms)
+    # use the form index as an identifier for each token's word type; the
+    # remapped indices serve as matrix rows
+    word_types, word_rows = np.unique(forms, return_inverse=True)
+    word_rows = word_rows.reshape(-1)
+    word_counts = np.bincount(word_rows, minlength=len(word_types))
+    feature_types, feature_cols = np.unique(np.asarray(units.feature_inds),
+                                            return_inverse=True)
+    # word_feature_matrix[i, j] == True when the word type of row i was
+    # associated with the feature type of column j; repeated (word, feature)
+    # pairs collapse into a single True
+    word_feature_matrix = csr_matrix(
+        (
+            np.ones(len(feature_cols), dtype=bool),
+            (np.repeat(word_rows, np.diff(units.feature_breaks)),
+             feature_cols.reshape(-1))
+        ),
+        shape=(len(word_types), len(feature_types))
+    )
+    # if matching_words_matrix[i, j] == True, then the word represented by
+    # row i shared at least one feature type with the word represented by
+    # row j
+    matching_words_matrix = word_feature_matrix.dot(
+        word_feature_matrix.transpose())
+    # weighting each matching word by the number of times it appeared gives
+    # the total number of tokens matching the word of each row
+    counts = matching_words_matrix.dot(word_counts)
+    return word_types, counts, len(forms)
+
+
 def get_feature_counts_by_text(connection, feature, text):
     """Get number of times instances of given feature type occur in a
     particular text
@@ -105,85 +158,9 @@ def get_feature_counts_by_text(connection, feature, text):
         value is the number of tokens in the text sharing at least one same
         feature type with the key word
     """
-    tindex2mtindex = {}
-    findex2mfindex = {}
-    word_counts = Counter()
-    word_feature_pairs = set()
-    unit_proj = {
-        '_id': False,
-        'tokens.features.form': True
-    }
-    if feature != 'form':
-        unit_proj['tokens.features.'+feature] = True
-    db_cursor = connection.connection[Unit.collection].find(
-        {'text': text.id, 'unit_type': 'line'},
-        unit_proj
-    )
-    for unit in db_cursor:
-        for token in unit['tokens']:
-            cur_features = token['features']
-            # use the form index as an identifier for this token's word
-            # type
-            cur_tindex = cur_features['form'][0]
-            if cur_tindex not in tindex2mtindex:
-                tindex2mtindex[cur_tindex] = len(tindex2mtindex)
-            mtindex = tindex2mtindex[cur_tindex]
-            # we want to count word types by matrix indices for faster
-            # lookup when we get to the stage of counting up word type
-            # occurrences
-            word_counts[mtindex] += 1
-            for cur_findex in cur_features[feature]:
-                if cur_findex not in findex2mfindex:
-                    findex2mfindex[cur_findex] = len(findex2mfindex)
-                mfindex = findex2mfindex[cur_findex]
-                # record when a word type is associated with a feature type
-                word_feature_pairs.add((mtindex, mfindex))
-    csr_rows = []
-    csr_cols = []
-    for mtindex, mfindex in word_feature_pairs:
-        csr_rows.append(mtindex)
-        csr_cols.append(mfindex)
-    word_feature_matrix = csr_matrix(
-        (
-            np.ones(len(csr_rows), dtype=bool),
-            (np.array(csr_rows), np.array(csr_cols))
-        ),
-        shape=(len(tindex2mtindex), len(findex2mfindex))
-    )
-    # if matching_words_matrix[i, j] == True, then the word represented by
-    # position i shared at least one feature type with the word represented
-    # by position j
-    matching_words_matrix = word_feature_matrix.dot(
-        word_feature_matrix.transpose())
-    # since only matching tokens remain, the column indices indicate
-    # which tokens match the token represented by row i; we need to
-    # count up how many times each word appeared; first, we change match
-    # indicators into the number of times the token indicated by the column was
-    # found
-    mtindices = []
-    mtcounts = []
-    for mtindex, count in word_counts.items():
-        mtindices.append(mtindex)
-        mtcounts.append(count)
-    count_matrix = matching_words_matrix.dot(
-        csr_matrix(
-            (
-                np.array(mtcounts),
-                (np.array(mtindices), np.zeros(len(mtindices)))
-            ),
-            shape=(matching_words_matrix.shape[0], 1)
-        )
-    )
-    # now, we can sum up each row to find the total number of times all
-    # associated tokens appeared with the token represented by the row
-    summed_rows = count_matrix.sum(axis=-1)
-    # finally, we re-map matrix indices to feature indices
-    mtindex2tindex = {
-        mtindex: tindex for tindex, mtindex in tindex2mtindex.items()
-    }
-    return {
-        mtindex2tindex[i]: freq for i, freq in enumerate(summed_rows.A1)
-    }
+    word_types, counts, _ = count_matching_tokens(connection, feature,
+                                                  text.id)
+    return dict(zip(word_types.tolist(), counts.tolist()))
 
 
 def get_inverse_text_frequencies(connection, feature, text_id):
@@ -211,94 +188,15 @@ def get_inverse_text_frequencies(connection, feature, text_id):
         value is the inverse of the average proportion of words in the text
         sharing at least one same feature type with the key word
     """
-    tindex2mtindex = {}
-    findex2mfindex = {}
-    word_counts = Counter()
-    word_feature_pairs = set()
-    text_token_count = 0
-    unit_proj = {
-        '_id': False,
-        'tokens.features.form': True
-    }
-    if feature != 'form':
-        unit_proj['tokens.features.'+feature] = True
-    db_cursor = connection.connection[Unit.collection].find(
-        {'text': text_id, 'unit_type': 'line'},
-        unit_proj
-    )
-    for unit in db_cursor:
-        text_token_count += len(unit['tokens'])
-        for token in unit['tokens']:
-            cur_features = token['features']
-            # use the form index as an identifier 
-            # for this token's word type
-            cur_tindex = cur_features['form'][0]
-            if cur_tindex not in tindex2mtindex:
-                tindex2mtindex[cur_tindex] = len(tindex2mtindex)
-            # mtindex is esseentially a counter
-            # for the number of unique forms seen
-            mtindex = tindex2mtindex[cur_tindex]
-            # we want to count word types by matrix indices for faster
-            # lookup when we get to the stage of counting up word type
-            # occurrences
-            word_counts[mtindex] += 1
-            for cur_findex in cur_features[feature]:
-                if cur_findex not in findex2mfindex:
-                    findex2mfindex[cur_findex] = len(findex2mfindex)
-                mfindex = findex2mfindex[cur_findex]
-                # record when a word type is associated with a feature type
-                word_feature_pairs.add((mtindex, mfindex))
-    csr_rows = []
-    csr_cols = []
-    for mtindex, mfindex in word_feature_pairs:
-        csr_rows.append(mtindex)
-        csr_cols.append(mfindex)
-    word_feature_matrix = csr_matrix(
-        (
-            np.ones(len(csr_rows), dtype=bool),
-            (np.array(csr_rows), np.array(csr_cols))
-        ),
-        shape=(len(tindex2mtindex), len(findex2mfindex))
-    )
-    # if matching_words_matrix[i, j] == True, then the word represented by
-    # position i shared at least one feature type with the word represented
-    # by position j
-    matching_words_matrix = word_feature_matrix.dot(
-        word_feature_matrix.transpose())
-    # since only matching tokens remain, the column indices indicate
-    # which tokens match the token represented by row i; we need to
-    # count up how many times each word appeared; first, we change match
-    # indicators into the number of times the token indicated by the column was
-    # found
-    mtindices = []
-    mtcounts = []
-    for mtindex, count in word_counts.items():
-        mtindices.append(mtindex)
-        mtcounts.append(count)
-    count_matrix = matching_words_matrix.dot(
-        csr_matrix(
-            (
-                np.array(mtcounts),
-                (np.array(mtindices), np.zeros(len(mtindices)))
-            ),
-            shape=(matching_words_matrix.shape[0], 1)
-        )
-    )
-    # now, we can sum up each row to find the total number of times all
-    # associated tokens appeared with the token represented by the row
-    summed_rows = count_matrix.sum(axis=-1)
-    # dividing total number of tokens by the sums gives us the inverse
+    word_types, counts, token_count = count_matching_tokens(
+        connection, feature, text_id)
+    # dividing total number of tokens by the counts gives us the inverse
     # frequencies
-    sparse_freqs = text_token_count / summed_rows
-    # finally, we re-map matrix indices to feature indices
-    mtindex2tindex = {
-        mtindex: tindex for tindex, mtindex in tindex2mtindex.items()
-    }
-    return {
-        mtindex2tindex[i]: freq for i, freq in enumerate(sparse_freqs.A1)
-    }
-    
-    
+    with np.errstate(divide='ignore'):
+        inv_freqs = token_count / counts
+    return dict(zip(word_types.tolist(), inv_freqs.tolist()))
+
+
 def get_sound_inverse_text_freq(connection, text_id):
     """Get the inverse frequencies of all the trigrams AKA sound features
     in a particular text.
@@ -14,10 +14,17 @@ class JobQueue:
         the workers this object has created
     queue : multiprocessing.Queue
         work queue which workers listen on
+    processes_per_job : int
+        how many processes a single job may use for its own work (e.g., to
+        match batches of source units at the same time during a search)
+    memory_per_job : int or None
+        how many bytes a single job may use for its sparse matrix products;
+        None leaves it to the job
 
     """
 
-    def __init__(self, num_workers, db_cred):
+    def __init__(self, num_workers, db_cred, processes_per_job=1,
+                 memory_per_job=None):
         """Store parameters to be used in initializing resources
 
         Parameters
@@ -27,10 +34,19 @@ class JobQueue:
         db_cred : dict
             credentials to access the database; arguments should be given for
             TessMongoConnection.__init__ in kwarg unpacking format
+        processes_per_job : int (default: 1)
+            how many processes a single job may use for its own work; 0 or
+            less means one process per available core
+        memory_per_job : int, optional
+            how many bytes a single job may use for its sparse matrix
+            products (see ``tesserae.matchers.sparse_encoding``); by
+            default, every job uses its own default
 
         """
         self.num_workers = num_workers
         self.db_cred = db_cred
+        self.processes_per_job = processes_per_job
+        self.memory_per_job = memory_per_job
 
         self.queue = multiprocessing.Queue()
         self.workers = []
@@ -2,12 +2,14 @@
 import os
 import shutil
 
-from tesserae.db.entities import (Feature, Match, MultiResult, Search, Token,
-                                  Unit)
+from tesserae.db.entities import Match, MultiResult, Search, Token, Unit
 from tesserae.utils.downloads import ResultsWriter, get_results_filename
+from tesserae.utils.freqcache import FrequencyCache, \
+    unregister_feature_counts, unregister_frequencies
 from tesserae.utils.multitext import (MULTITEXT_SEARCH, BigramWriter,
                                       unregister_bigrams)
 from tesserae.utils.search import NORMAL_SEARCH
+from tesserae.utils.unitcache import CompiledUnits, unregister_units
 
 
 def remove_results(connection, searches):
@@ -96,14 +98,11 @@ def remove_text(connection, text):
     }])
     remove_results(connection, searches)
 
-    connection.connection[Feature.collection].update_many(
-        {'frequencies.' + str_text_id: {
-            '$exists': True
-        }}, {'$unset': {
-            'frequencies.' + str_text_id: ""
-        }})
+    unregister_feature_counts(connection, text)
 
     unregister_bigrams(connection, text)
+    unregister_units(text)
+    unregister_frequencies(text)
 
     connection.delete(text)
 
@@ -122,5 +121,9 @@ def obliterate(connection):
     """
     if os.path.isdir(BigramWriter.BIGRAM_DB_DIR):
         shutil.rmtree(BigramWriter.BIGRAM_DB_DIR)
+    if os.path.isdir(CompiledUnits.CACHE_DIR):
+        shutil.rmtree(CompiledUnits.CACHE_DIR)
+    if os.path.isdir(FrequencyCache.CACHE_DIR):
+        shutil.rmtree(FrequencyCache.CACHE_DIR)
     for coll_name in connection.connection.list_collection_names():
         connection.connection.drop_collection(coll_name)
@@ -0,0 +1,947 @@
+"""Frequency data kept on disk, so that searches need not count it again
+
+Scoring by text frequencies needs the inverse frequency of every form of a
+text, by one score basis. Working that out means going through every token
+of the text, so it is done once per (text, score basis), when the text is
+ingested or given a new feature, and kept on disk as an array indexed by
+form. Later searches load the array instead of querying the database.
+
+Scoring by corpus frequencies and building stoplists need how often every
+feature of a type comes up in the texts of a language. The counts of each
+text are stored in the database as FeatureCounts entries when the text is
+ingested or given a new feature. They are also kept on disk per (language,
+feature) as a sparse texts x features matrix, with a row for every text, so
+that counts over the corpus or over any set of texts are sums of rows. The
+totals of every feature, the features ranked by their totals and the token
+of every feature are kept with the matrix, so that a corpus stoplist is a
+slice of the ranking. Each process keeps the counts it last loaded in memory
+for as long as the files on disk do not change.
+
+Storing the counts of a text, or removing the text, does not rewrite the
+matrix. The change is written to a small file of its own and folded into the
+matrix when it is read; every so many changes, they are folded into the
+stored matrix for good. Changes are made under a file lock, so that
+processes ingesting texts at the same time do not lose each other's changes.
+
+Classes
+-------
+FrequencyCache
+    Where frequency data is kept.
+
+Functions
+---------
+inverse_frequency_table
+    Lay out inverse frequencies as an array to be indexed by key.
+load_inverse_frequencies
+    Get the inverse frequencies of a text, working them out if necessary.
+register_frequencies
+    Work out and store the inverse frequencies of a newly ingested text.
+unregister_frequencies
+    Remove stored inverse frequencies of a text.
+load_count_matrix
+    Get the count of every feature of a type in every text of a language.
+load_stoplist_ranking
+    Get the features of a type ranked by how often they are found.
+load_stoplist
+    Get the most frequent features of a type in some texts.
+load_vocabulary
+    Get the token of every feature of a type.
+load_feature_counts
+    Get the count of every feature of a type in some texts.
+load_corpus_frequencies
+    Get the frequency of every feature of a type across a language.
+register_feature_counts
+    Store the feature counts of a text.
+unregister_feature_counts
+    Remove the stored feature counts of a text.
+migrate_feature_counts
+    Move feature counts stored in Feature entries to FeatureCounts entries.
+"""
+import collections
+import contextlib
+import fcntl
+import glob
+import os
+import tempfile
+
+from bson.objectid import ObjectId
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+
+from tesserae.db.entities import Feature, FeatureCounts, Text
+from tesserae.utils.calculations import get_inverse_text_frequencies, \
+    get_sound_inverse_text_freq
+
+# bump whenever the layout or the computation of the stored files changes
+FREQ_CACHE_VERSION = 3
+# how many stoplists for texts are remembered per (language, feature)
+STOPLIST_MEMO_SIZE = 256
+# how many changes to the corpus counts of a (language, feature) are kept
+# apart before they are folded into the stored count matrix
+CORPUS_DELTA_LIMIT = 64
+
+
+class FrequencyCache:
+    """Where frequency data is kept
+
+    Attributes
+    ----------
+    CACHE_DIR : str
+        where frequency data is stored
+    """
+
+    CACHE_DIR = os.path.join(os.path.expanduser('~'), 'tess_data',
+                             'frequencies')
+
+
+def inverse_frequency_table(inv_freqs):
+    """Lay out inverse frequencies as an array to be indexed by key
+
+    Parameters
+    ----------
+    inv_freqs : dict[int, float]
+        maps a form index (or a sound feature index) to its inverse frequency
+
+    Returns
+    -------
+    1d np.array of float
+        ``table[k]`` is the inverse frequency of ``k``; the last entry is
+        left over for -1, so that ``table[-1]`` looks it up as well. Keys
+        without an inverse frequency are NaN
+    """
+    keys = np.fromiter(inv_freqs.keys(), dtype=np.int64, count=len(inv_freqs))
+    table = np.full(int(keys.max(initial=-1)) + 2, np.nan)
+    table[keys] = np.fromiter(inv_freqs.values(), dtype=np.float64,
+                              count=len(inv_freqs))
+    return table
+
+
+def _create_freq_cache_path(text_id, score_basis):
+    """Create a path to the inverse frequencies for the specified options
+
+    The version of the layout is part of the file name, so that files left
+    over from an older version are never read.
+
+    Parameters
+    ----------
+    text_id : ObjectId or str
+        ObjectId of Text
+    score_basis : str
+        the type of feature the frequencies are counted by
+
+    Returns
+    -------
+    str
+    """
+    score_basis = score_basis.replace(' ', '_')
+    return str(
+        os.path.join(
+            FrequencyCache.CACHE_DIR,
+            f'{str(text_id)}_{score_basis}_v{FREQ_CACHE_VERSION}.npy'))
+
+
+def _compute_inverse_frequencies(connection, score_basis, text_id):
+    """Work out the inverse frequencies of a text from the database
+
+    Returns
+    -------
+    1d np.array of float
+        laid out as by ``inverse_frequency_table()``
+    """
+    if score_basis == 'sound':
+        return inverse_frequency_table(
+            get_sound_inverse_text_freq(connection, text_id))
+    return inverse_frequency_table(
+        get_inverse_text_frequencies(connection, score_basis, text_id))
+
+
+def _save_arrays(path, **arrays):
+    """Write arrays out to ``path``
+
+    A single array is written as a .npy file, several as a .npz file. The
+    file is written elsewhere first and then moved into place, so that
+    readers never see a partially written file.
+    """
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=parent, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as ofh:
+            if len(arrays) == 1:
+                np.save(ofh, *arrays.values())
+            else:
+                np.savez(ofh, **arrays)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_inverse_frequencies(connection, score_basis, text_id):
+    """Get the inverse frequencies of a text, working them out if necessary
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    score_basis : str
+        the type of feature to count frequencies by; with 'sound', every
+        sound feature is counted on its own (see
+        ``tesserae.utils.calculations.get_sound_inverse_text_freq()``),
+        otherwise words sharing a feature are counted together (see
+        ``tesserae.utils.calculations.get_inverse_text_frequencies()``)
+    text_id : ObjectId
+        ObjectId of the text whose frequencies are wanted
+
+    Returns
+    -------
+    1d np.array of float
+        the inverse frequency in the text of every form index (or of every
+        sound feature index); see ``inverse_frequency_table()``
+    """
+    path = _create_freq_cache_path(text_id, score_basis)
+    try:
+        return np.load(path)
+    except (OSError, ValueError):
+        pass
+    table = _compute_inverse_frequencies(connection, score_basis, text_id)
+    _save_arrays(path, table=table)
+    return table
+
+
+def register_frequencies(connection, text, score_bases=('form', 'lemmata')):
+    """Work out and store the inverse frequencies of a newly ingested text
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    text : tesserae.db.entities.Text
+        the text whose frequencies are to be stored
+    score_bases : iterable of str
+        the types of feature to count frequencies by
+    """
+    for score_basis in score_bases:
+        unregister_frequencies(text, score_basis)
+        load_inverse_frequencies(connection, score_basis, text.id)
+
+
+def unregister_frequencies(text, score_basis=None):
+    """Remove stored inverse frequencies of a text
+
+    Parameters
+    ----------
+    text : tesserae.db.entities.Text
+        the text whose stored frequencies are no longer valid
+    score_basis : str, optional
+        if given, only frequencies counted by this type of feature are
+        removed
+    """
+    if score_basis is None:
+        score_basis = '*'
+    pattern = _create_freq_cache_path(text.id, score_basis).replace(
+        f'_v{FREQ_CACHE_VERSION}.npy', '_v*.npy')
+    for path in glob.glob(pattern):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# path => (file stamp, corpus counts) as last loaded by this process
+_corpus_counts = {}
+
+
+def _create_corpus_cache_path(connection, language, feature):
+    """Create a path to the count matrix of a feature type
+
+    Counts are kept apart for every database, since each has a corpus of its
+    own.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    language : str
+    feature : str
+        the type of feature counted
+
+    Returns
+    -------
+    str
+    """
+    feature = feature.replace(' ', '_')
+    return str(
+        os.path.join(
+            FrequencyCache.CACHE_DIR, f'corpus_{connection.connection.name}_'
+            f'{language}_{feature}_v{FREQ_CACHE_VERSION}.npz'))
+
+
+def _create_corpus_delta_path(connection, language, feature, number):
+    """Create a path to a change to the count matrix of a feature type
+
+    Changes are kept in a directory of their own next to the matrix.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    language : str
+    feature : str
+        the type of feature counted
+    number : int
+        changes are numbered from 0, in the order they are made
+
+    Returns
+    -------
+    str
+    """
+    path = _create_corpus_cache_path(connection, language, feature)
+    return os.path.join(path[:-len('.npz')] + '_deltas', f'{number:09d}.npz')
+
+
+def _list_corpus_deltas(connection, language, feature):
+    """Get the paths to the changes to the count matrix of a feature type,
+    in the order they were made
+    """
+    path = _create_corpus_delta_path(connection, language, feature, 0)
+    return sorted(
+        glob.glob(os.path.join(os.path.dirname(path), '[0-9]' * 9 + '.npz')))
+
+
+@contextlib.contextmanager
+def _corpus_lock(connection, language, feature):
+    """Hold the lock on the stored corpus counts of a feature type
+
+    Only one process at a time may change the stored counts.
+    """
+    path = _create_corpus_cache_path(connection, language, feature)
+    path = path[:-len('.npz')] + '.lock'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _count_text_features(connection, language, feature):
+    """Gather the counts of every feature of a type in every text of a
+    language from the database
+
+    Returns
+    -------
+    matrix : scipy.sparse.csr_matrix of int
+        ``matrix[i, j]`` is how many times the feature with index j was
+        found in text i
+    texts : 1d np.array of str
+        the ObjectId string of the text of every row
+    tokens : 1d np.array of str
+        the token of the feature with index j
+    """
+    vocabulary = {
+        doc['index']: doc['token']
+        for doc in connection.connection[Feature.collection].find(
+            {'language': language, 'feature': feature},
+            {'_id': False, 'index': True, 'token': True})
+        if doc['index'] >= 0
+    }
+    db_cursor = connection.connection[FeatureCounts.collection].find(
+        {'language': language, 'feature': feature},
+        {'_id': False, 'text': True, 'indices': True, 'counts': True})
+    texts = []
+    indices = []
+    counts = []
+    for doc in db_cursor:
+        texts.append(str(doc['text']))
+        indices.append(np.array(doc['indices'], dtype=np.int64))
+        counts.append(np.array(doc['counts'], dtype=np.int64))
+    indptr = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(i) for i in indices], out=indptr[1:])
+    indices = np.concatenate(indices) if indices else \
+        np.zeros(0, dtype=np.int64)
+    counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+    size = max(max(vocabulary, default=-1), int(indices.max(initial=-1))) + 1
+    matrix = csr_matrix((counts, indices, indptr), shape=(len(texts), size))
+    # the stored indices need not be in order
+    matrix.sort_indices()
+    return matrix, np.array(texts, dtype=str), _extend_tokens(
+        np.zeros(0, dtype=str), size, vocabulary)
+
+
+def _extend_tokens(tokens, size, vocabulary):
+    """Make room for ``size`` tokens, filling in new ones from ``vocabulary``
+
+    Indices missing from ``vocabulary`` are given empty tokens.
+    """
+    if size <= len(tokens):
+        return tokens
+    return np.concatenate([
+        tokens,
+        np.array([vocabulary.get(i, '') for i in range(len(tokens), size)],
+                 dtype=str)
+    ])
+
+
+def _read_corpus_counts(connection, language, feature):
+    """Get the stored corpus counts of a feature type
+
+    Changes not yet folded into the stored count matrix are folded in here.
+    Counts already loaded by this process are used for as long as the files
+    they came from do not change.
+
+    Returns
+    -------
+    dict or None
+        None if no counts are stored; otherwise, see ``_load_corpus_counts()``
+    """
+    path = _create_corpus_cache_path(connection, language, feature)
+    while True:
+        # changes are listed before the matrix is read, since the matrix is
+        # rewritten before the changes folded into it are removed
+        deltas = _list_corpus_deltas(connection, language, feature)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino, tuple(deltas))
+        cached = _corpus_counts.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        try:
+            with np.load(path) as stored:
+                counts = {
+                    'matrix': csr_matrix(
+                        (stored['data'], stored['indices'],
+                         stored['indptr']),
+                        shape=tuple(stored['shape'])),
+                    'texts': stored['texts'],
+                    'totals': stored['totals'],
+                    'ranking': stored['ranking'],
+                    'tokens': stored['tokens']
+                }
+            if deltas:
+                counts['matrix'], counts['texts'], counts['tokens'] = \
+                    _apply_deltas(counts['matrix'], counts['texts'],
+                                  counts['tokens'],
+                                  [_load_delta(d) for d in deltas])
+                counts['totals'], counts['ranking'] = \
+                    _rank_features(counts['matrix'])
+        except FileNotFoundError:
+            # the changes were folded in while they were being read
+            continue
+        except (OSError, ValueError, KeyError):
+            return None
+        break
+    # the same arrays are handed to every caller
+    for name in ('texts', 'totals', 'ranking', 'tokens'):
+        counts[name].flags.writeable = False
+    # stoplists worked out from these counts, by (basis texts, n)
+    counts['stoplists'] = collections.OrderedDict()
+    _corpus_counts[path] = (stamp, counts)
+    return counts
+
+
+def _load_delta(path):
+    """Read a change to the count matrix of a feature type
+
+    Returns
+    -------
+    dict
+        with the keys 'text' (ObjectId string of the text changed),
+        'removed' (whether the text was taken away), 'indices' and 'counts'
+        (the new counts of the text) and 'tokens' (the token of each index)
+    """
+    with np.load(path) as stored:
+        return {
+            'text': str(stored['text']),
+            'removed': bool(stored['removed']),
+            'indices': stored['indices'],
+            'counts': stored['counts'],
+            'tokens': stored['tokens']
+        }
+
+
+def _apply_deltas(matrix, texts, tokens, deltas):
+    """Fold changes into a count matrix
+
+    Each change replaces the row of its text (or takes it away), so a text
+    changed more than once only keeps its last change, and folding in a
+    change which was already folded in changes nothing.
+
+    Returns
+    -------
+    matrix : scipy.sparse.csr_matrix of int
+    texts : 1d np.array of str
+    tokens : 1d np.array of str
+    """
+    rows = {}
+    vocabulary = {}
+    for delta in deltas:
+        # a text changed again moves to the end, as it was stored last
+        rows.pop(delta['text'], None)
+        rows[delta['text']] = None if delta['removed'] else delta
+        vocabulary.update(
+            zip(delta['indices'].tolist(), delta['tokens'].tolist()))
+    kept = ~np.isin(texts, list(rows))
+    matrix = matrix[np.flatnonzero(kept)]
+    texts = texts[kept]
+    added = [delta for delta in rows.values() if delta is not None]
+    # the matrix only ever grows, even when the text that made it grow is
+    # taken away again
+    size = max([matrix.shape[1]] +
+               [int(d['indices'].max(initial=-1)) + 1 for d in deltas])
+    matrix.resize((matrix.shape[0], size))
+    if added:
+        indptr = np.zeros(len(added) + 1, dtype=np.int64)
+        np.cumsum([len(d['indices']) for d in added], out=indptr[1:])
+        new_rows = csr_matrix(
+            (np.concatenate([d['counts'] for d in added]).astype(np.int64),
+             np.concatenate([d['indices'] for d in added]).astype(np.int64),
+             indptr),
+            shape=(len(added), size))
+        new_rows.sort_indices()
+        matrix = vstack([matrix, new_rows], format='csr', dtype=np.int64)
+        texts = np.concatenate(
+            [texts, np.array([d['text'] for d in added], dtype=str)])
+    return matrix, texts, _extend_tokens(tokens, size, vocabulary)
+
+
+def _rank_features(matrix):
+    """Work out the total of every feature and rank the features by them
+
+    Returns
+    -------
+    totals : 1d np.array of int
+    ranking : 1d np.array of int
+        feature indices from the largest to the smallest total; ties are
+        broken by feature index
+    """
+    totals = np.asarray(matrix.sum(axis=0), dtype=np.int64).reshape(-1)
+    return totals, np.argsort(-totals, kind='stable')
+
+
+def _write_corpus_counts(connection, language, feature, matrix, texts,
+                         tokens):
+    """Store the corpus counts of a feature type
+
+    The total of every feature and the ranking of the features by their
+    totals are worked out here, so that they are ready for every search.
+    Changes kept apart are removed, so the counts must include them; the
+    lock on the counts must be held.
+    """
+    totals, ranking = _rank_features(matrix)
+    _save_arrays(_create_corpus_cache_path(connection, language, feature),
+                 data=matrix.data,
+                 indices=matrix.indices,
+                 indptr=matrix.indptr,
+                 shape=np.array(matrix.shape, dtype=np.int64),
+                 texts=texts,
+                 totals=totals,
+                 ranking=ranking,
+                 tokens=tokens)
+    _remove_files(_list_corpus_deltas(connection, language, feature))
+
+
+def _load_corpus_counts(connection, language, feature):
+    """Get the corpus counts of a feature type, gathering them if necessary
+
+    The counts are only gathered from the database the first time they are
+    needed; after that, they are kept up to date by
+    ``register_feature_counts()`` and ``unregister_feature_counts()``.
+
+    Returns
+    -------
+    dict
+        with the keys 'matrix' (texts x features counts; see
+        ``load_count_matrix()``), 'texts' (the ObjectId string of the text
+        of every row), 'totals' (how many times each feature is found in the
+        corpus), 'ranking' (feature indices from the most to the least
+        frequent) and 'tokens' (the token of every feature index)
+    """
+    counts = _read_corpus_counts(connection, language, feature)
+    if counts is None:
+        with _corpus_lock(connection, language, feature):
+            # another process may have gathered them in the meantime
+            counts = _read_corpus_counts(connection, language, feature)
+            if counts is None:
+                _write_corpus_counts(connection, language, feature,
+                                     *_count_text_features(
+                                         connection, language, feature))
+                counts = _read_corpus_counts(connection, language, feature)
+    return counts
+
+
+def load_count_matrix(connection, feature, language):
+    """Get how many times every feature of a type is found in every text of a
+    language
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    feature : str
+        the type of feature whose counts are wanted
+    language : str
+
+    Returns
+    -------
+    matrix : scipy.sparse.csr_matrix of int
+        ``matrix[i, j]`` is how many times the feature with index j is found
+        in the text of row i; there is a column for every feature of the
+        type
+    texts : 1d np.array of str
+        the ObjectId string of the text of every row
+    """
+    counts = _load_corpus_counts(connection, language, feature)
+    return counts['matrix'], counts['texts']
+
+
+def load_stoplist_ranking(connection, feature, language):
+    """Get the features of a type ranked by how often they are found in the
+    corpus
+
+    The ranking is kept along with the corpus counts, so any number of the
+    most frequent features can be had by slicing.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    feature : str
+        the type of feature to rank
+    language : str
+
+    Returns
+    -------
+    1d np.array of int
+        every feature index, from the most to the least frequent; ties are
+        broken by feature index
+    """
+    return _load_corpus_counts(connection, language, feature)['ranking']
+
+
+def load_vocabulary(connection, feature, language):
+    """Get the token of every feature of a type
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    feature : str
+        the type of feature whose tokens are wanted
+    language : str
+
+    Returns
+    -------
+    1d np.array of str
+        the token of the feature with index i; it is empty if the token is
+        not known
+    """
+    return _load_corpus_counts(connection, language, feature)['tokens']
+
+
+def load_feature_counts(connection, feature, language, basis='corpus'):
+    """Get how many times every feature of a type is found in some texts
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    feature : str
+        the type of feature whose counts are wanted
+    language : str
+    basis : list of (ObjectId or str) or 'corpus'
+        the ObjectIds of the texts to count in; if 'corpus', every text of
+        the language is counted in. Texts without counts add nothing
+
+    Returns
+    -------
+    1d np.array of int
+        how many times the feature with index i is found in the texts; with
+        'corpus', the array is shared and must not be changed
+    """
+    counts = _load_corpus_counts(connection, language, feature)
+    if basis == 'corpus':
+        return counts['totals']
+    return _sum_text_counts(counts, basis)
+
+
+def _sum_text_counts(counts, basis):
+    """Sum the rows of the texts in ``basis``; see ``load_feature_counts()``
+    """
+    text_rows = {t: i for i, t in enumerate(counts['texts'].tolist())}
+    rows = [text_rows[str(t)] for t in basis if str(t) in text_rows]
+    return np.asarray(counts['matrix'][rows].sum(axis=0),
+                      dtype=np.int64).reshape(-1)
+
+
+def _most_frequent(totals, n):
+    """Get the indices of the ``n`` largest totals, largest first
+
+    Only the ``n`` largest are sorted. Ties are broken by index, as with a
+    stable sort of all of ``totals``.
+    """
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if n >= len(totals):
+        return np.argsort(-totals, kind='stable')
+    # the smallest total which makes it in
+    cutoff = totals[np.argpartition(-totals, n - 1)[n - 1]]
+    above = np.flatnonzero(totals > cutoff)
+    tied = np.flatnonzero(totals == cutoff)[:n - len(above)]
+    top = np.concatenate([above, tied])
+    return top[np.argsort(-totals[top], kind='stable')]
+
+
+def load_stoplist(connection, feature, language, n, basis='corpus'):
+    """Get the ``n`` most frequent features of a type
+
+    With the corpus as basis, the stoplist is a slice of the stored ranking.
+    Otherwise, the counts of the basis texts are summed and only the top
+    ``n`` are sorted. Stoplists for texts are remembered, for as long as the
+    stored counts do not change, so that asking again with the same texts
+    and ``n`` costs nothing.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    feature : str
+        the type of feature to consider
+    language : str
+    n : int
+        how many features to include
+    basis : list of (ObjectId or str) or 'corpus'
+        the ObjectIds of the texts to count in; if 'corpus', every text of
+        the language is counted in
+
+    Returns
+    -------
+    1d np.array of int
+        the indices of the ``n`` most frequent features, most frequent
+        first; ties are broken by feature index
+    """
+    counts = _load_corpus_counts(connection, language, feature)
+    if basis == 'corpus':
+        return counts['ranking'][:n]
+    memo = counts['stoplists']
+    key = (tuple(sorted(str(t) for t in basis)), n)
+    if key in memo:
+        memo.move_to_end(key)
+        return memo[key]
+    stoplist = _most_frequent(_sum_text_counts(counts, basis), n)
+    stoplist.flags.writeable = False
+    memo[key] = stoplist
+    if len(memo) > STOPLIST_MEMO_SIZE:
+        memo.popitem(last=False)
+    return stoplist
+
+
+def load_corpus_frequencies(connection, feature, language):
+    """Get the frequency of every feature of a type across a language
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    feature : str
+        the type of feature whose frequencies are wanted
+    language : str
+
+    Returns
+    -------
+    1d np.array of float
+        the frequency of every feature, by index, as with
+        ``tesserae.utils.calculations.get_corpus_frequencies()``
+    """
+    counts = load_feature_counts(connection, feature, language)
+    return counts / counts.sum()
+
+
+def _set_text_counts(connection, language, feature, text_id, deltas=None,
+                     vocabulary=None):
+    """Replace or take away the feature counts of a text
+
+    The change is written to a file of its own rather than to the count
+    matrix, and is folded into the matrix once enough changes have been
+    made. Nothing is done when no counts are stored yet, since they will
+    include the text once they are gathered.
+
+    Parameters
+    ----------
+    deltas : dict [int, int], optional
+        how many times the text has each feature index; if None, the row of
+        the text is only taken away
+    vocabulary : dict [int, str], optional
+        the tokens of the feature indices in ``deltas``, for any that are
+        new to the corpus
+    """
+    with _corpus_lock(connection, language, feature):
+        if not os.path.exists(
+                _create_corpus_cache_path(connection, language, feature)):
+            return
+        deltas = deltas if deltas is not None else {}
+        vocabulary = vocabulary if vocabulary is not None else {}
+        # changes are only ever removed all at once, so they are numbered
+        # from 0 without gaps
+        number = len(_list_corpus_deltas(connection, language, feature))
+        _save_arrays(
+            _create_corpus_delta_path(connection, language, feature, number),
+            text=np.array(str(text_id)),
+            removed=np.array(not deltas),
+            indices=np.fromiter(deltas.keys(), dtype=np.int64,
+                                count=len(deltas)),
+            counts=np.fromiter(deltas.values(), dtype=np.int64,
+                               count=len(deltas)),
+            tokens=np.array([vocabulary.get(i, '') for i in deltas],
+                            dtype=str))
+        if number + 1 >= CORPUS_DELTA_LIMIT:
+            counts = _read_corpus_counts(connection, language, feature)
+            if counts is not None:
+                _write_corpus_counts(connection, language, feature,
+                                     counts['matrix'], counts['texts'],
+                                     counts['tokens'])
+
+
+def register_feature_counts(connection, text, features):
+    """Store the feature counts of a text
+
+    The counts are stored in the database as FeatureCounts entries, one for
+    every type of feature, replacing any stored before for the same text and
+    type. The stored count matrices are brought up to date as well.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    text : tesserae.db.entities.Text
+        the text whose features were just counted
+    features : iterable of tesserae.db.entities.Feature
+        the features found in ``text``, with their frequencies in it; they
+        may be of several types
+    """
+    text_id = str(text.id)
+    by_type = {}
+    vocabularies = {}
+    for f in features:
+        count = f.frequencies.get(text_id, 0)
+        if f.index is not None and f.index >= 0 and count:
+            by_type.setdefault(f.feature, {})[f.index] = count
+            vocabularies.setdefault(f.feature, {})[f.index] = f.token
+    if not by_type:
+        return
+    connection.connection[FeatureCounts.collection].delete_many({
+        'text': text.id,
+        'feature': {
+            '$in': list(by_type)
+        }
+    })
+    connection.insert_nocheck([
+        FeatureCounts(text=text.id,
+                      language=text.language,
+                      feature=feature,
+                      indices=list(deltas),
+                      counts=list(deltas.values()))
+        for feature, deltas in by_type.items()
+    ])
+    for feature, deltas in by_type.items():
+        _set_text_counts(connection, text.language, feature, text_id,
+                         deltas, vocabularies[feature])
+
+
+def unregister_feature_counts(connection, text):
+    """Remove the stored feature counts of a text
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    text : tesserae.db.entities.Text
+        the text about to be removed
+    """
+    feature_counts = connection.connection[FeatureCounts.collection]
+    for feature in feature_counts.distinct('feature', {'text': text.id}):
+        _set_text_counts(connection, text.language, feature, text.id)
+    feature_counts.delete_many({'text': text.id})
+
+
+def migrate_feature_counts(connection):
+    """Move feature counts stored in Feature entries to FeatureCounts entries
+
+    Databases built before FeatureCounts existed keep the counts of every
+    text in the 'frequencies' of each Feature entry. These are gathered into
+    FeatureCounts entries, one per text and type of feature, and then taken
+    out of the Feature entries. Texts which already have FeatureCounts for a
+    type of feature keep them, and counts for texts no longer in the
+    database are dropped, so that the migration can safely be run again.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+
+    Returns
+    -------
+    int
+        how many FeatureCounts entries were created
+    """
+    features = connection.connection[Feature.collection]
+    feature_counts = connection.connection[FeatureCounts.collection]
+    old = {'frequencies': {'$exists': True}}
+    texts = {
+        str(doc['_id'])
+        for doc in connection.connection[Text.collection].find(
+            {}, {'_id': True})
+    }
+    created = 0
+    # one type of feature at a time, so that only its counts are held
+    groups = features.aggregate([{
+        '$match': old
+    }, {
+        '$group': {
+            '_id': {
+                'language': '$language',
+                'feature': '$feature'
+            }
+        }
+    }])
+    for group in [g['_id'] for g in groups]:
+        language, feature = group['language'], group['feature']
+        counted = {
+            str(t)
+            for t in feature_counts.distinct('text', {
+                'language': language,
+                'feature': feature
+            })
+        }
+        by_text = {}
+        for doc in features.find(dict(old, **group), {
+                '_id': False,
+                'index': True,
+                'frequencies': True
+        }):
+            index = doc.get('index')
+            if index is None or index < 0:
+                continue
+            for text_id, count in doc['frequencies'].items():
+                if count and text_id in texts and text_id not in counted:
+                    by_text.setdefault(text_id, {})[index] = count
+        if by_text:
+            connection.insert_nocheck([
+                FeatureCounts(text=ObjectId(text_id),
+                              language=language,
+                              feature=feature,
+                              indices=list(deltas),
+                              counts=list(deltas.values()))
+                for text_id, deltas in by_text.items()
+            ])
+            created += len(by_text)
+        features.update_many(dict(old, **group),
+                             {'$unset': {
+                                 'frequencies': ''
+                             }})
+        # stored corpus counts were gathered without the migrated texts
+        with _corpus_lock(connection, language, feature):
+            path = _create_corpus_cache_path(connection, language, feature)
+            _corpus_counts.pop(path, None)
+            _remove_files([path] +
+                          _list_corpus_deltas(connection, language, feature))
+    return created
@@ -1,3 +1,4 @@
+import itertools
 import time
 import traceback
 
@@ -10,9 +11,12 @@ from tesserae.tokenizers import tokenizer_map
 from tesserae.unitizer import Unitizer
 from tesserae.utils.coordinate import JobQueue
 from tesserae.utils.delete import remove_text
+from tesserae.utils.freqcache import register_feature_counts, \
+    register_frequencies
 from tesserae.utils.multitext import register_bigrams, MULTITEXT_SEARCH
 from tesserae.utils.search import NORMAL_SEARCH
 from tesserae.utils.tessfile import TessFile
+from tesserae.utils.unitcache import register_units, unregister_units
 
 
 class IngestQueue(JobQueue):
@@ -165,7 +169,6 @@ def _ingest_tessfile(connection, text, tessfile, enable_multitext=False):
         for f in connection.find(Feature.collection, language=text.language)
     }
     features_for_insert = []
-    features_for_update = []
 
     for f in features:
         if (f.feature, f.token) not in feature_cache:
@@ -173,9 +176,10 @@ def _ingest_tessfile(connection, text, tessfile, enable_multitext=False):
             feature_cache[(f.feature, f.token)] = f
         else:
             f.id = feature_cache[(f.feature, f.token)].id
-            features_for_update.append(f)
+    # features already in the database are left as they are; how often the
+    # text has them is stored on its own
     connection.insert(features_for_insert)
-    connection.update(features_for_update)
+    register_feature_counts(connection, text, features)
 
     unitizer = Unitizer()
     lines, phrases = unitizer.unitize(tokens, tags, tessfile.metadata)
@@ -188,6 +192,8 @@ def _ingest_tessfile(connection, text, tessfile, enable_multitext=False):
 
     connection.insert_nocheck(tokens)
     connection.insert_nocheck(lines + phrases)
+    register_units(connection, text)
+    register_frequencies(connection, text)
     if enable_multitext:
         register_bigrams(connection, text)
 
@@ -313,6 +319,9 @@ def _add_feature_for_normal_search(connection, text, feature):
                    form_oid_to_raw_features)
     _update_units(connection, text, feature, db_feature_cache,
                   form_oid_to_raw_features, oid_to_form)
+    # compiled units for this feature no longer match the database
+    unregister_units(text, feature)
+    register_frequencies(connection, text, [feature])
 
 
 def _get_relevant_tokens(connection, text_id):
@@ -396,7 +405,10 @@ def _update_features(connection, text, feature, tokens,
             tokens,
             form_oid_to_raw_features)
     connection.insert([f for f in token_to_features_for_insert.values()])
-    connection.update([f for f in token_to_features_for_update.values()])
+    register_feature_counts(
+        connection, text,
+        itertools.chain(token_to_features_for_insert.values(),
+                        token_to_features_for_update.values()))
     expected_size = len(token_to_features_for_insert) + \
         len(db_feature_cache)
     wait_limit = 20
@@ -15,7 +15,7 @@ import tesserae
 from tesserae.db.entities import \
     Feature, Match, MultiResult, Search, Text, Unit
 from tesserae.db.entities.text import TextStatus
-from tesserae.utils.calculations import get_inverse_text_frequencies
+from tesserae.utils.freqcache import load_inverse_frequencies
 from tesserae.utils.retrieve import TagHelper
 
 MULTITEXT_SEARCH = 'multitext'
@@ -170,11 +170,10 @@ def compute_inverse_frequencies(connection, feature_type, text_id):
     1d np.array
         index by form index to obtain corresponding inverse text frequency
     """
-    inv_freqs_dict = get_inverse_text_frequencies(connection, feature_type,
-                                                  text_id)
-    inverse_frequencies = np.zeros(max(inv_freqs_dict) + 1)
-    inverse_frequencies[[k for k in inv_freqs_dict.keys()]] = \
-        [v for v in inv_freqs_dict.values()]
+    # the stored table keeps a last entry for -1, which forms never are
+    inverse_frequencies = load_inverse_frequencies(connection, feature_type,
+                                                   text_id)[:-1].copy()
+    inverse_frequencies[np.isnan(inverse_frequencies)] = 0
     return inverse_frequencies
 
 
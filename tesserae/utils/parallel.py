@@ -0,0 +1,164 @@
+"""Helpers for spreading numpy work over several processes
+
+Large read-only arrays are placed in shared memory once, and every worker
+process attaches to them when it starts instead of receiving a pickled copy
+with each task.
+
+Classes
+-------
+SharedArrays
+    Holder of read-only arrays placed in shared memory.
+
+Functions
+---------
+resolve_workers
+    Turn a requested worker count into a usable one.
+imap_ordered
+    Run tasks in a process pool, yielding results in submission order.
+"""
+import collections
+import concurrent.futures
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# arrays attached to by the current worker process; see ``_attach``
+_shared_context = None
+_shared_blocks = []
+
+
+def resolve_workers(workers):
+    """Turn a requested worker count into a usable one
+
+    Parameters
+    ----------
+    workers : int or None
+        The number of processes requested. None or 1 means that work should be
+        done in the calling process; 0 or a negative number means that one
+        process per available core should be used.
+
+    Returns
+    -------
+    int
+        At least 1
+    """
+    if workers is None:
+        return 1
+    workers = int(workers)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+class SharedArrays:
+    """Read-only arrays placed in shared memory
+
+    Use as a context manager; the shared memory is released when the context
+    is left.
+
+    Parameters
+    ----------
+    arrays : dict [str, np.array]
+        The arrays to share
+    values : dict [str, object], optional
+        Small picklable values which should be handed to workers along with
+        the arrays
+
+    Attributes
+    ----------
+    spec : dict
+        Picklable description of the shared arrays, to be handed to
+        ``_attach``
+    """
+
+    def __init__(self, arrays, values=None):
+        self._blocks = []
+        self.spec = {'arrays': {}, 'values': dict(values or {})}
+        try:
+            for name, arr in arrays.items():
+                arr = np.ascontiguousarray(arr)
+                # zero-sized shared memory blocks are not allowed
+                block = shared_memory.SharedMemory(create=True,
+                                                   size=max(arr.nbytes, 1))
+                self._blocks.append(block)
+                view = np.ndarray(arr.shape, dtype=arr.dtype,
+                                  buffer=block.buf)
+                view[...] = arr
+                self.spec['arrays'][name] = (block.name, arr.shape,
+                                             arr.dtype.str)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _attach(spec, setup):
+    """Pool initializer: attach to shared arrays in a worker process"""
+    global _shared_context
+    context = dict(spec['values'])
+    for name, (block_name, shape, dtype) in spec['arrays'].items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared_blocks.append(block)
+        view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        view.flags.writeable = False
+        context[name] = view
+    _shared_context = setup(context) if setup is not None else context
+
+
+def _run_task(func, task):
+    return func(_shared_context, task)
+
+
+def imap_ordered(func, tasks, shared, workers, setup=None):
+    """Run tasks in a process pool, yielding results in submission order
+
+    Results are always produced in the order in which ``tasks`` generates its
+    items, no matter which worker finishes first, so that the output is the
+    same as when the tasks are run one after another.
+
+    Parameters
+    ----------
+    func : (dict, object) -> object
+        Module-level function run for every task; its first argument is the
+        context built from ``shared``, its second argument is the task
+    tasks : iterable
+        Picklable task descriptions
+    shared : SharedArrays
+        Arrays (and values) which every task needs
+    workers : int
+        Number of worker processes to use
+    setup : (dict) -> dict, optional
+        Module-level function run once per worker process to turn the
+        attached arrays into the context handed to ``func``
+
+    Yields
+    ------
+    object
+        The result of ``func`` for each task, in order
+    """
+    # keep a bounded number of tasks in flight so that results do not pile up
+    # in memory faster than the caller consumes them
+    max_pending = 2 * workers
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_attach,
+            initargs=(shared.spec, setup)) as executor:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(executor.submit(_run_task, func, task))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
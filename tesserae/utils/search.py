@@ -1,14 +1,19 @@
 """Helper functions for running Tesserae search"""
 import datetime
+import itertools
 import time
 import traceback
+import uuid
 
 import tesserae.matchers
 from natsort import natsorted
 from tesserae.db.entities import Match, Search, Text
+from tesserae.matchers.match_table import MatchTable
+from tesserae.matchers.text_options import TextOptions
 from tesserae.utils.downloads import ResultsWriter
 
 NORMAL_SEARCH = 'vanilla'
+CORPUS_SEARCH = 'corpus'
 
 
 def submit_search(jobqueue, connection, results_id, matcher_type,
@@ -25,11 +30,17 @@ def submit_search(jobqueue, connection, results_id, matcher_type,
         the matcher to use for search to perform; must be a key in
         tesserae.matchers.matcher_map
     search_params : dict
-        parameter names mapped to arguments to be used for the search
+        parameter names mapped to arguments to be used for the search; if
+        'workers' is not given, the search may use as many processes as
+        ``jobqueue.processes_per_job``, and if 'memory_budget' is not given,
+        the search keeps within ``jobqueue.memory_per_job``
 
     """
     parameters = tesserae.matchers.matcher_map[matcher_type].paramify(
         search_params)
+    search_params = dict(search_params)
+    search_params.setdefault('workers', jobqueue.processes_per_job)
+    search_params.setdefault('memory_budget', jobqueue.memory_per_job)
     results_status = Search(results_id=results_id,
                             search_type=NORMAL_SEARCH,
                             status=Search.INIT,
@@ -68,24 +79,15 @@ def _run_search(connection, results_status, matcher_type, search_params):
         results_status.last_queried = datetime.datetime.utcnow()
         results_status.add_new_stage('match and score')
         connection.update(results_status)
+        # matches are spilled to disk in sorted runs as they are found, then
+        # merged by score on their way out to storage
+        search_params = dict(search_params)
+        search_params.setdefault('spill_rows', MatchTable.SPILL_ROWS)
         matches = matcher.match(results_status, **search_params)
-        matches.sort(key=lambda m: m.score, reverse=True)
-        results_status.update_current_stage_value(1.0)
-
-        results_status.add_new_stage('save results')
-        connection.update(results_status)
-        stepsize = 5000
-        source = search_params['source'].text
-        target = search_params['target'].text
-        max_score = matches[0].score
-        with ResultsWriter(results_status, source, target,
-                           max_score) as writer:
-            for start in range(0, len(matches), stepsize):
-                results_status.update_current_stage_value(start / len(matches))
-                cur_slice = matches[start:start + stepsize]
-                writer.record_matches(cur_slice)
-                connection.update(results_status)
-                connection.insert_nocheck(cur_slice)
+        source = search_params['source']
+        target = search_params.get('target') or source
+        _save_matches(connection, results_status, matches, source.text,
+                      target.text)
 
         results_status.update_current_stage_value(1.0)
         results_status.status = Search.DONE
@@ -101,6 +103,239 @@ def _run_search(connection, results_status, matcher_type, search_params):
         connection.update(results_status)
 
 
+def submit_corpus_search(jobqueue, connection, results_id, matcher_type,
+                         search_params):
+    """Submit a job for searching one source against many targets
+
+    Every target gets a regular search of its own (with its own results_id,
+    progress and results, which can be retrieved like those of any other
+    search). They are grouped under a parent Search, whose parameters list
+    the targets along with their results_id and, once a target is done, how
+    many matches were found against it.
+
+    Parameters
+    ----------
+    jobqueue : tesserae.utils.coordinate.JobQueue
+    connection : TessMongoConnection
+    results_id : str
+        UUID to associate with the parent search
+    matcher_type : str
+        the matcher to use; must be a key in tesserae.matchers.matcher_map
+        of a matcher which can ``match_corpus()``
+    search_params : dict
+        as for ``submit_search()``, except that instead of 'target' there is
+        'targets': either a list of TextOptions, or the name of a language,
+        in which case every other text in that language is a target
+
+    Returns
+    -------
+    list of str
+        the results_id of the search against each target
+
+    Raises
+    ------
+    ValueError
+        Raised when the matcher cannot search a corpus, or when there is no
+        target
+    """
+    matcher_class = tesserae.matchers.matcher_map[matcher_type]
+    if not hasattr(matcher_class, 'match_corpus'):
+        raise ValueError(f'Matcher "{matcher_type}" cannot search a corpus')
+    search_params = dict(search_params)
+    targets = _resolve_targets(connection, search_params['source'],
+                               search_params.pop('targets'))
+    if not targets:
+        raise ValueError('No target texts to search')
+    search_params.setdefault('workers', jobqueue.processes_per_job)
+    search_params.setdefault('memory_budget', jobqueue.memory_per_job)
+    target_statuses = []
+    for target in targets:
+        target_statuses.append(
+            Search(results_id=str(uuid.uuid4()),
+                   search_type=NORMAL_SEARCH,
+                   status=Search.INIT,
+                   msg='',
+                   parameters=matcher_class.paramify(
+                       dict(search_params, target=target))))
+    parameters = dict(target_statuses[0].parameters)
+    del parameters['target']
+    parameters['targets'] = [
+        dict(status.parameters['target'], results_id=status.results_id)
+        for status in target_statuses
+    ]
+    results_status = Search(results_id=results_id,
+                            search_type=CORPUS_SEARCH,
+                            status=Search.INIT,
+                            msg='',
+                            parameters=parameters)
+    connection.insert(results_status)
+    connection.insert(target_statuses)
+    kwargs = {
+        'results_status': results_status,
+        'target_statuses': target_statuses,
+        'matcher_type': matcher_type,
+        'targets': targets,
+        'search_params': search_params
+    }
+    jobqueue.queue_job(_run_corpus_search, kwargs)
+    return [status.results_id for status in target_statuses]
+
+
+def _resolve_targets(connection, source, targets):
+    """Work out which units of which texts to search against
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    source : tesserae.matchers.text_options.TextOptions
+    targets : list of TextOptions or str
+        if a language is given, every text in it except the source is used,
+        by the source's unit type (or by phrase, for prose)
+
+    Returns
+    -------
+    list of TextOptions
+    """
+    if not isinstance(targets, str):
+        return list(targets)
+    texts = connection.find(Text.collection, language=targets)
+    return [
+        get_text_options(text, source.unit_type) for text in texts
+        if text.id != source.text.id
+    ]
+
+
+def get_text_options(text, unit_type):
+    """Choose the units by which to search a text
+
+    Parameters
+    ----------
+    text : tesserae.db.entities.Text
+    unit_type : {'line', 'phrase'}
+        the preferred unit type; prose texts are always searched by phrase
+
+    Returns
+    -------
+    tesserae.matchers.text_options.TextOptions
+    """
+    return TextOptions(text, 'phrase' if text.is_prose else unit_type)
+
+
+def _run_corpus_search(connection, results_status, target_statuses,
+                       matcher_type, targets, search_params):
+    """Instructions for searching one source against many targets
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    results_status : tesserae.db.entities.Search
+        Status keeper of the parent search
+    target_statuses : list of tesserae.db.entities.Search
+        Status keepers of the search against each target
+    matcher_type : str
+        the matcher to use for search to perform; must be a key in
+        tesserae.matchers.matcher_map
+    targets : list of tesserae.matchers.text_options.TextOptions
+    search_params : dict
+        parameter names mapped to arguments to be used for the search
+
+    """
+    start_time = time.time()
+    try:
+        matcher = tesserae.matchers.matcher_map[matcher_type](connection)
+        results_status.update_current_stage_value(1.0)
+
+        results_status.status = Search.RUN
+        results_status.last_queried = datetime.datetime.utcnow()
+        results_status.add_new_stage('match and score')
+        connection.update(results_status)
+        for status in target_statuses:
+            status.update_current_stage_value(1.0)
+            status.status = Search.RUN
+            status.last_queried = datetime.datetime.utcnow()
+            status.add_new_stage('match and score')
+            connection.update(status)
+        search_params = dict(search_params)
+        search_params.setdefault('spill_rows', MatchTable.SPILL_ROWS)
+        source = search_params['source']
+        results = matcher.match_corpus(target_statuses, targets=targets,
+                                       **search_params)
+        for i, (target, matches) in enumerate(results):
+            status = target_statuses[i]
+            count = _save_matches(connection, status, matches, source.text,
+                                  target.text)
+            results_status.parameters['targets'][i]['matches'] = count
+            status.update_current_stage_value(1.0)
+            status.status = Search.DONE
+            status.msg = 'Done in {} seconds'.format(time.time() -
+                                                     start_time)
+            status.last_queried = datetime.datetime.utcnow()
+            connection.update(status)
+            results_status.update_current_stage_value(
+                (i + 1) / len(target_statuses))
+            connection.update(results_status)
+
+        results_status.update_current_stage_value(1.0)
+        results_status.status = Search.DONE
+        results_status.msg = 'Done in {} seconds'.format(time.time() -
+                                                         start_time)
+        results_status.last_queried = datetime.datetime.utcnow()
+        connection.update(results_status)
+    # we want to catch all errors and log them into the Search entities
+    except:  # noqa: E722
+        msg = traceback.format_exc()
+        for status in [results_status] + target_statuses:
+            if status.status == Search.DONE:
+                continue
+            status.status = Search.FAILED
+            status.msg = msg
+            status.last_queried = datetime.datetime.utcnow()
+            connection.update(status)
+
+
+def _save_matches(connection, results_status, matches, source, target):
+    """Store the matches of a search, best first
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    results_status : tesserae.db.entities.Search
+        Status keeper of the search the matches belong to
+    matches : tesserae.matchers.match_table.MatchTable
+    source, target : tesserae.db.entities.Text
+
+    Returns
+    -------
+    int
+        how many matches were stored
+    """
+    try:
+        results_status.update_current_stage_value(1.0)
+
+        results_status.add_new_stage('save results')
+        connection.update(results_status)
+        stepsize = 5000
+        ordered = matches.iter_by_score()
+        # the best match comes first out of the merge
+        best = next(ordered, None)
+        max_score = 0.0
+        if best is not None:
+            max_score = best.score
+            ordered = itertools.chain([best], ordered)
+        with ResultsWriter(results_status, source, target,
+                           max_score) as writer:
+            for start in range(0, len(matches), stepsize):
+                results_status.update_current_stage_value(
+                    start / len(matches))
+                cur_slice = list(itertools.islice(ordered, stepsize))
+                writer.record_matches(cur_slice)
+                connection.update(results_status)
+                connection.insert_nocheck(cur_slice)
+    finally:
+        matches.close()
+    return len(matches)
+
+
 def check_cache(connection, source, target, method):
     """Check whether search results are already in the database
 
@@ -2,6 +2,7 @@
 import numpy as np
 
 from tesserae.db.entities import Entity, Feature
+from tesserae.utils.freqcache import load_stoplist, load_vocabulary
 
 
 def get_feature_indices(conn, language, feature_type, stopwords):
@@ -62,64 +63,11 @@ def create_stoplist(connection, n, feature, language, basis='corpus'):
     stoplist : 1d np.array of np.unit32
         The `n` most frequent tokens in the basis texts.
     """
-    pipeline = [
-        {
-            '$match': {
-                'feature': feature,
-                'language': language
-            }
-        },
-    ]
-
-    if basis == 'corpus':
-        pipeline.append({
-            '$project': {
-                '_id': False,
-                'index': True,
-                'token': True,
-                'frequency': {
-                    '$reduce': {
-                        'input': {
-                            '$objectToArray': '$frequencies'
-                        },
-                        'initialValue': 0,
-                        'in': {
-                            '$sum': ['$$value', '$$this.v']
-                        }
-                    }
-                }
-            }
-        })
-    else:
+    if basis != 'corpus':
         basis = [t.id if isinstance(t, Entity) else t for t in basis]
-        pipeline.extend([{
-            '$project': {
-                '_id': False,
-                'index': True,
-                'token': True,
-                'frequency': {
-                    '$sum': ['$frequencies.' + str(t_id) for t_id in basis]
-                }
-            }
-        }])
-
-    pipeline.extend([{
-        '$sort': {
-            'frequency': -1
-        }
-    }, {
-        '$limit': n
-    }, {
-        '$project': {
-            'token': True,
-            'index': True,
-            'frequency': True
-        }
-    }])
-
-    stoplist = connection.aggregate(Feature.collection, pipeline, encode=False)
-    stoplist = list(stoplist)
-    return np.array([s['index'] for s in stoplist], dtype=np.uint32)
+    # ties are broken by feature index
+    return load_stoplist(connection, feature, language, n,
+                         basis).astype(np.uint32)
 
 
 def get_stoplist_indices(connection, stopwords, feature=None, language=None):
@@ -181,9 +129,20 @@ def get_stoplist_tokens(connection, stopword_indices, feature, language):
     stoplist : list of str
         The `n` most frequent tokens in the basis texts.
     """
-    results = connection.find(Feature.collection,
-                              index=[int(i) for i in stopword_indices],
-                              language=language,
-                              feature=feature)
-    results = {f.index: f.token for f in results}
-    return [results[i] for i in stopword_indices]
+    vocabulary = load_vocabulary(connection, feature, language)
+    results = {
+        i: str(vocabulary[i])
+        for i in (int(i) for i in stopword_indices)
+        if i < len(vocabulary) and vocabulary[i]
+    }
+    missing = [int(i) for i in stopword_indices if int(i) not in results]
+    if missing:
+        # tokens not known to the vocabulary come from the database
+        results.update({
+            f.index: f.token
+            for f in connection.find(Feature.collection,
+                                     index=missing,
+                                     language=language,
+                                     feature=feature)
+        })
+    return [results[int(i)] for i in stopword_indices]
@@ -0,0 +1,475 @@
+"""Compiled, on-disk copies of unit data for matching
+
+Searches need every unit of a text with its token forms and the features of
+one feature type. Gathering that from the database means flattening every
+token of every unit, so the result is compiled once per (text, unit type,
+feature) into flat arrays and kept on disk. Later searches memory-map the
+arrays instead of querying the database.
+
+Classes
+-------
+CompiledUnits
+    Units of a text laid out as flat arrays.
+
+Functions
+---------
+load_units
+    Get compiled units, building and storing them if necessary.
+load_text_units
+    Get compiled units by the ObjectId of their Text.
+register_units
+    Compile and store unit data for a newly ingested text.
+unregister_units
+    Remove stored unit data for a text.
+"""
+import glob
+import json
+import os
+import shutil
+import tempfile
+
+from bson.objectid import ObjectId
+import numpy as np
+
+from tesserae.db.entities import Unit
+
+# bump whenever the layout of the stored files changes
+UNIT_CACHE_VERSION = 1
+
+_ARRAY_NAMES = ('unit_ids', 'text_ids', 'indices', 'breaks', 'forms',
+                'feature_breaks', 'feature_inds')
+
+
+class CompiledUnits:
+    """Units of a text laid out as flat arrays
+
+    Behaves like the list of unit dictionaries produced by the database query
+    (see ``_query_units``): indexing with an int gives a dictionary for that
+    unit, and slicing gives another CompiledUnits. Matching code which only
+    needs the flat layout can use ``arrays`` directly.
+
+    Parameters
+    ----------
+    unit_ids : 2d np.array of uint8
+        the ObjectId bytes of each unit, one row per unit
+    text_ids : 2d np.array of uint8
+        the ObjectId bytes of the Text of each unit, one row per unit
+    indices : 1d np.array of int
+        the index of each unit within its text
+    tags : list of list of str
+        the tags of each unit
+    snippets : list of str
+        the snippet of each unit
+    breaks : 1d np.array of int
+        the positions ``breaks[i]:breaks[i+1]`` belong to unit i
+    forms : 1d np.array of int
+        the form index of the token at every position
+    feature_breaks : 1d np.array of int
+        ``feature_inds[feature_breaks[p]:feature_breaks[p+1]]`` are the
+        features of position p
+    feature_inds : 1d np.array of int
+        the feature indices of every position, one after the other
+
+    Attributes
+    ----------
+    CACHE_DIR : str
+        where compiled units are stored
+    """
+
+    CACHE_DIR = os.path.join(os.path.expanduser('~'), 'tess_data', 'units')
+
+    def __init__(self, unit_ids, text_ids, indices, tags, snippets, breaks,
+                 forms, feature_breaks, feature_inds):
+        self.unit_ids = unit_ids
+        self.text_ids = text_ids
+        self.indices = indices
+        self.tags = tags
+        self.snippets = snippets
+        self.breaks = breaks
+        self.forms = forms
+        self.feature_breaks = feature_breaks
+        self.feature_inds = feature_inds
+
+    @property
+    def arrays(self):
+        """(breaks, forms, feature_breaks, feature_inds)"""
+        return self.breaks, self.forms, self.feature_breaks, self.feature_inds
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError('CompiledUnits only supports contiguous '
+                                 'slices')
+            return self._subset(start, max(start, stop))
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('CompiledUnits index out of range')
+        start, stop = self.breaks[key], self.breaks[key + 1]
+        feature_breaks = self.feature_breaks[start:stop + 1]
+        feature_inds = self.feature_inds[
+            feature_breaks[0]:feature_breaks[-1]].tolist()
+        feature_breaks = (feature_breaks - feature_breaks[0]).tolist()
+        return {
+            '_id': ObjectId(self.unit_ids[key].tobytes()),
+            'text': ObjectId(self.text_ids[key].tobytes()),
+            'index': int(self.indices[key]),
+            'snippet': self.snippets[key],
+            'tags': self.tags[key],
+            'forms': self.forms[start:stop].tolist(),
+            'features': [
+                feature_inds[a:b]
+                for a, b in zip(feature_breaks[:-1], feature_breaks[1:])
+            ]
+        }
+
+    def column(self, key):
+        """Collect one piece of information from every unit
+
+        Parameters
+        ----------
+        key : {'_id', 'text', 'index', 'snippet', 'tags'}
+
+        Returns
+        -------
+        list
+        """
+        if key == '_id':
+            return _to_object_ids(self.unit_ids)
+        if key == 'text':
+            return _to_object_ids(self.text_ids)
+        if key == 'index':
+            return self.indices.tolist()
+        if key == 'snippet':
+            return list(self.snippets)
+        if key == 'tags':
+            return list(self.tags)
+        raise KeyError(key)
+
+    def _subset(self, start, stop):
+        pos_start, pos_stop = self.breaks[start], self.breaks[stop]
+        feat_start = self.feature_breaks[pos_start]
+        feat_stop = self.feature_breaks[pos_stop]
+        return CompiledUnits(
+            self.unit_ids[start:stop], self.text_ids[start:stop],
+            self.indices[start:stop], self.tags[start:stop],
+            self.snippets[start:stop],
+            self.breaks[start:stop + 1] - pos_start,
+            self.forms[pos_start:pos_stop],
+            self.feature_breaks[pos_start:pos_stop + 1] - feat_start,
+            self.feature_inds[feat_start:feat_stop])
+
+    @classmethod
+    def concatenate(cls, parts):
+        """Stack compiled units one after the other
+
+        Parameters
+        ----------
+        parts : list of CompiledUnits
+
+        Returns
+        -------
+        CompiledUnits
+            the units of ``parts[0]``, followed by those of ``parts[1]``, and
+            so on
+        """
+        def _join_breaks(breaks):
+            shifted = [breaks[0]]
+            for b in breaks[1:]:
+                shifted.append(b[1:] + shifted[-1][-1])
+            return np.concatenate(shifted)
+
+        return cls(
+            np.concatenate([p.unit_ids for p in parts]),
+            np.concatenate([p.text_ids for p in parts]),
+            np.concatenate([p.indices for p in parts]),
+            [t for p in parts for t in p.tags],
+            [s for p in parts for s in p.snippets],
+            _join_breaks([p.breaks for p in parts]),
+            np.concatenate([p.forms for p in parts]),
+            _join_breaks([p.feature_breaks for p in parts]),
+            np.concatenate([p.feature_inds for p in parts]))
+
+    @classmethod
+    def from_unit_dicts(cls, units):
+        """Compile a list of unit dictionaries
+
+        Parameters
+        ----------
+        units : list of dict
+            see ``_query_units`` for the expected keys
+
+        Returns
+        -------
+        CompiledUnits
+
+        Notes
+        -----
+        A token without information on the feature type (as can happen with
+        punctuation when a feature was added after ingestion) is given no
+        features, so that features stay aligned with forms.
+        """
+        units = list(units)
+        unit_ids = np.array([u['_id'].binary for u in units],
+                            dtype='S12').view(np.uint8).reshape(-1, 12)
+        text_ids = np.array([u['text'].binary for u in units],
+                            dtype='S12').view(np.uint8).reshape(-1, 12)
+        indices = np.array([u['index'] for u in units], dtype=np.int64)
+        unit_sizes = np.array([len(u['forms']) for u in units],
+                              dtype=np.int64)
+        breaks = np.zeros(len(units) + 1, dtype=np.int64)
+        np.cumsum(unit_sizes, out=breaks[1:])
+        forms = np.fromiter((f for u in units for f in u['forms']),
+                            dtype=np.int64,
+                            count=breaks[-1])
+        position_features = []
+        for u in units:
+            unit_features = u.get('features', [])
+            position_features.extend(
+                unit_features[i] if i < len(unit_features) else []
+                for i in range(len(u['forms'])))
+        feature_breaks = np.zeros(len(position_features) + 1, dtype=np.int64)
+        np.cumsum([len(f) for f in position_features],
+                  out=feature_breaks[1:])
+        feature_inds = np.fromiter(
+            (f for feats in position_features for f in feats),
+            dtype=np.int64,
+            count=feature_breaks[-1])
+        return cls(unit_ids, text_ids, indices,
+                   [list(u['tags']) for u in units],
+                   [u['snippet'] for u in units], breaks, forms,
+                   feature_breaks, feature_inds)
+
+    def save(self, path):
+        """Write out to the directory at ``path``
+
+        The directory is written elsewhere first and then moved into place,
+        so that readers never see a partially written directory.
+        """
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+        try:
+            for name in _ARRAY_NAMES:
+                np.save(os.path.join(tmp_path, f'{name}.npy'),
+                        np.ascontiguousarray(getattr(self, name)))
+            with open(os.path.join(tmp_path, 'meta.json'), 'w',
+                      encoding='utf-8') as ofh:
+                json.dump(
+                    {
+                        'version': UNIT_CACHE_VERSION,
+                        'tags': self.tags,
+                        'snippets': self.snippets
+                    }, ofh)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmp_path, path)
+        except OSError:
+            # somebody else may have just stored the same data
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+
+    @classmethod
+    def load(cls, path):
+        """Read from the directory at ``path``
+
+        Arrays are memory-mapped rather than read into memory.
+
+        Returns
+        -------
+        CompiledUnits or None
+            None if nothing usable was stored at ``path``
+        """
+        try:
+            with open(os.path.join(path, 'meta.json'), 'r',
+                      encoding='utf-8') as ifh:
+                meta = json.load(ifh)
+            if meta.get('version') != UNIT_CACHE_VERSION:
+                return None
+            # plain ndarray views on the maps avoid np.memmap overhead in
+            # later computations
+            arrays = {
+                name: np.load(os.path.join(path, f'{name}.npy'),
+                              mmap_mode='r').view(np.ndarray)
+                for name in _ARRAY_NAMES
+            }
+        except (OSError, ValueError):
+            return None
+        return cls(tags=meta['tags'], snippets=meta['snippets'], **arrays)
+
+
+def _to_object_ids(id_bytes):
+    """Convert rows of ObjectId bytes into ObjectIds"""
+    raw = np.ascontiguousarray(id_bytes).tobytes()
+    return [ObjectId(raw[i:i + 12]) for i in range(0, len(raw), 12)]
+
+
+def _create_unit_cache_path(text_id, unit_type, feature):
+    """Create a path to the compiled units for the specified options
+
+    Parameters
+    ----------
+    text_id : ObjectId
+        ObjectId of Text
+    unit_type : {'line', 'phrase'}
+        the type of Unit
+    feature : str
+        the type of feature compiled with the units
+
+    Returns
+    -------
+    str
+    """
+    feature = feature.replace(' ', '_')
+    return str(
+        os.path.join(CompiledUnits.CACHE_DIR,
+                     f'{str(text_id)}_{unit_type}_{feature}'))
+
+
+def _query_units(connection, text_id, unit_type, feature):
+    """Get unit information for matching from the database
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    text_id : ObjectId
+        ObjectId of the Text whose units are wanted
+    unit_type : {'line', 'phrase'}
+    feature : str
+        the type of feature to retrieve along with the forms
+
+    Returns
+    -------
+    list of dict
+        each dictionary has the keys '_id', 'text', 'index', 'snippet',
+        'tags', 'forms' (the form index at each position) and 'features' (for
+        each position, the list of feature indices found there)
+    """
+    return [
+        u for u in connection.aggregate(
+            Unit.collection,
+            [
+                {
+                    '$match': {
+                        'text': text_id,
+                        'unit_type': unit_type
+                    }
+                },
+                {
+                    '$project': {
+                        '_id': True,
+                        'text': True,
+                        'index': True,
+                        'snippet': True,
+                        'tags': True,
+                        'forms': {
+                            # flatten list of lists of ints into list of ints
+                            # https://docs.mongodb.com/manual/reference/operator/aggregation/reduce/
+                            '$reduce': {
+                                'input': '$tokens.features.form',
+                                'initialValue': [],
+                                'in': {
+                                    '$concatArrays': ['$$value', '$$this']
+                                }
+                            }
+                        },
+                        'features': '$tokens.features.' + feature,
+                    }
+                }
+            ],
+            encode=False)
+    ]
+
+
+def load_units(connection, text, unit_type, feature):
+    """Get compiled units, building and storing them if necessary
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    text : tesserae.db.entities.Text
+        the text whose units are wanted
+    unit_type : {'line', 'phrase'}
+    feature : str
+        the type of feature to compile along with the forms
+
+    Returns
+    -------
+    CompiledUnits
+    """
+    return load_text_units(connection, text.id, unit_type, feature)
+
+
+def load_text_units(connection, text_id, unit_type, feature):
+    """Get compiled units by the ObjectId of their Text
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    text_id : ObjectId
+        ObjectId of the Text whose units are wanted
+    unit_type : {'line', 'phrase'}
+    feature : str
+        the type of feature to compile along with the forms
+
+    Returns
+    -------
+    CompiledUnits
+    """
+    path = _create_unit_cache_path(text_id, unit_type, feature)
+    units = CompiledUnits.load(path)
+    if units is None:
+        units = CompiledUnits.from_unit_dicts(
+            _query_units(connection, text_id, unit_type, feature))
+        units.save(path)
+    return units
+
+
+def register_units(connection, text, features=('form', 'lemmata')):
+    """Compile and store unit data for a newly ingested text
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    text : tesserae.db.entities.Text
+        the text whose units are to be compiled
+    features : iterable of str
+        the feature types to compile units for
+    """
+    unregister_units(text)
+    unit_types = ['phrase']
+    if not text.is_prose:
+        unit_types.append('line')
+    for unit_type in unit_types:
+        for feature in features:
+            load_units(connection, text, unit_type, feature)
+
+
+def unregister_units(text, feature=None):
+    """Remove stored unit data for a text
+
+    Parameters
+    ----------
+    text : tesserae.db.entities.Text
+        the text whose compiled units are no longer valid
+    feature : str, optional
+        if given, only compiled units for this feature type are removed
+    """
+    if feature is None:
+        paths = glob.glob(_create_unit_cache_path(text.id, '*', '*'))
+    else:
+        paths = [
+            _create_unit_cache_path(text.id, unit_type, feature)
+            for unit_type in ('line', 'phrase')
+        ]
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
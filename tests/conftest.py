@@ -14,13 +14,22 @@ from tesserae.db.entities import Feature, Text
 from tesserae.utils import ingest_text
 from tesserae.utils.delete import obliterate
 from tesserae.utils.downloads import ResultsWriter
+from tesserae.utils.freqcache import FrequencyCache
+from tesserae.matchers.match_table import MatchTable
 from tesserae.utils.multitext import BigramWriter
 from tesserae.utils.search import PageOptions, get_results
+from tesserae.utils.unitcache import CompiledUnits
 
 # Make sure that bigram databases are written out to a temporary location
 BigramWriter.BIGRAM_DB_DIR = tempfile.mkdtemp()
 # Make sure that results are written out to a temporary location
 ResultsWriter.RESULTS_DIR = tempfile.mkdtemp()
+# Make sure that compiled units are written out to a temporary location
+CompiledUnits.CACHE_DIR = tempfile.mkdtemp()
+# Make sure that stored frequencies are written out to a temporary location
+FrequencyCache.CACHE_DIR = tempfile.mkdtemp()
+# Make sure that spilled search results are written out to a temporary location
+MatchTable.SPILL_DIR = tempfile.mkdtemp()
 
 
 def pytest_addoption(parser):
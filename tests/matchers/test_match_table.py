@@ -0,0 +1,127 @@
+import numpy as np
+from bson.objectid import ObjectId
+
+from tesserae.db.entities import Feature
+from tesserae.matchers.match_table import MatchTable
+
+
+class _Tags:
+    def __init__(self):
+        self.calls = 0
+
+    def get_display_tag(self, text_id, unit_tags):
+        self.calls += 1
+        return f'tag {unit_tags[0]}'
+
+
+def _make_units(count):
+    text_id = ObjectId()
+    return [{
+        '_id': ObjectId(),
+        'text': text_id,
+        'tags': [f'1.{i}'],
+        'snippet': f'snippet {i}'
+    } for i in range(count)]
+
+
+def _make_table():
+    source_units = _make_units(3)
+    target_units = _make_units(2)
+    features = [Feature(token=t, index=i) for i, t in enumerate('abcd')]
+    table = MatchTable(ObjectId(), source_units, target_units, features,
+                       _Tags())
+    table.append(np.array([0, 2]), np.array([1, 0]), np.array([1.5, 3.0]),
+                 np.array([0, 2, 4]), np.array([0, 1, 2, 3]),
+                 np.array([4, 5, 6, 7]), np.array([0, 1, 3]),
+                 np.array([3, 0, 2]))
+    table.append_rows([1], [1], [2.0], [[(5, 6), (7, 8)]], [[1, 2]])
+    return table, source_units, target_units
+
+
+def test_materialize():
+    table, source_units, target_units = _make_table()
+    assert len(table) == 3
+    match = table[1]
+    assert match.search_id == table.search_id
+    assert match.source_unit == source_units[2]['_id']
+    assert match.target_unit == target_units[0]['_id']
+    assert match.source_tag == 'tag 1.2'
+    assert match.target_tag == 'tag 1.0'
+    assert match.source_snippet == 'snippet 2'
+    assert match.target_snippet == 'snippet 0'
+    assert match.matched_features == ['a', 'c']
+    assert match.highlight == [(2, 6), (3, 7)]
+    assert match.score == 3.0
+    last = table[-1]
+    assert last.highlight == [(5, 6), (7, 8)]
+    assert last.matched_features == ['b', 'c']
+    assert [m.score for m in table] == [1.5, 3.0, 2.0]
+    assert [m.score for m in table[1:]] == [3.0, 2.0]
+
+
+def test_tags_rendered_once_per_unit():
+    source_units = _make_units(3)
+    tags = _Tags()
+    table = MatchTable(ObjectId(), source_units, source_units, [], tags)
+    assert tags.calls == 3
+    table.append_rows([0, 0, 1, 1], [1, 2, 2, 2], [1.0, 2.0, 3.0, 4.0],
+                      [[]] * 4, [[]] * 4)
+    assert [(m.source_tag, m.target_tag) for m in table] == \
+        [('tag 1.0', 'tag 1.1'), ('tag 1.0', 'tag 1.2'),
+         ('tag 1.1', 'tag 1.2'), ('tag 1.1', 'tag 1.2')]
+    assert tags.calls == 3
+
+
+def test_sort_and_filter():
+    table, _, _ = _make_table()
+    table.sort_by_score()
+    assert table.scores.tolist() == [3.0, 2.0, 1.5]
+    assert [m.highlight for m in table] == [[(2, 6), (3, 7)],
+                                            [(5, 6), (7, 8)],
+                                            [(0, 4), (1, 5)]]
+    table.filter_by_score(2.0)
+    assert len(table) == 2
+    assert [m.matched_features for m in table] == [['a', 'c'], ['b', 'c']]
+
+
+def test_empty():
+    table = MatchTable(ObjectId(), [], [], [], _Tags())
+    table.sort_by_score()
+    assert len(table) == 0
+    assert list(table) == []
+    assert table[0:10] == []
+
+
+def test_spill():
+    source_units = _make_units(4)
+    target_units = _make_units(4)
+    features = [Feature(token=t, index=i) for i, t in enumerate('abcd')]
+    search_id = ObjectId()
+    rng = np.random.default_rng(0)
+    tables = [
+        MatchTable(search_id, source_units, target_units, features, _Tags(),
+                   spill_rows=spill_rows) for spill_rows in (None, 5)
+    ]
+    size = 3
+    for _ in range(6):
+        source_inds = rng.integers(0, 4, size=size)
+        target_inds = rng.integers(0, 4, size=size)
+        scores = rng.integers(0, 4, size=size).astype(float)
+        positions = rng.integers(0, 10, size=2 * size)
+        for table in tables:
+            table.append(source_inds, target_inds, scores,
+                         np.arange(0, 2 * size + 1, 2), positions,
+                         positions[::-1].copy(), np.arange(size + 1),
+                         positions[:size] % 4)
+    in_memory, spilled = tables
+    assert spilled._runs
+    in_memory.sort_by_score()
+    expected = [m.__dict__ for m in in_memory]
+    assert [m.__dict__ for m in spilled.iter_by_score()] == expected
+    in_memory.filter_by_score(2.0)
+    spilled.filter_by_score(2.0)
+    assert len(spilled) == len(in_memory)
+    assert [m.__dict__ for m in spilled.iter_by_score()] == \
+        [m.__dict__ for m in in_memory]
+    spilled.close()
+    assert not spilled._runs
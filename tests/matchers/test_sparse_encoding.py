@@ -2,7 +2,8 @@ import uuid
 
 import numpy as np
 import pytest
-from tesserae.db import Feature, Search, TessMongoConnection, Text
+from tesserae.db import Feature, Search, TessMongoConnection, Text, Unit
+from tesserae.matchers import sparse_encoding
 from tesserae.matchers.sparse_encoding import SparseMatrixSearch, _get_units
 from tesserae.matchers.text_options import TextOptions
 from tesserae.tokenizers import LatinTokenizer
@@ -49,6 +50,122 @@ def test_mini_latin_search_text_freqs(minipop, mini_latin_metadata, v3checker):
                                    'mini_latin_results.tab')
 
 
+def test_mini_latin_search_min_score(minipop, mini_latin_metadata):
+    texts = minipop.find(Text.collection,
+                         title=[m['title'] for m in mini_latin_metadata])
+    matcher = SparseMatrixSearch(minipop)
+
+    def _run(min_score):
+        matches = matcher.match(Search(results_id=uuid.uuid4()),
+                                TextOptions(texts[0], 'line'),
+                                TextOptions(texts[1], 'line'),
+                                'lemmata',
+                                stopwords=['et', 'neque', 'qui'],
+                                stopword_basis='texts',
+                                score_basis='lemmata',
+                                freq_basis='texts',
+                                max_distance=999,
+                                distance_basis='frequency',
+                                min_score=min_score)
+        return sorted((m.source_unit, m.target_unit, m.score)
+                      for m in matches)
+
+    everything = _run(0)
+    threshold = np.median([score for _, _, score in everything])
+    expected = [m for m in everything if m[2] >= threshold]
+    assert expected
+    assert _run(threshold) == expected
+
+
+def test_mini_latin_search_workers(minipop, mini_latin_metadata, v3checker):
+    texts = minipop.find(Text.collection,
+                         title=[m['title'] for m in mini_latin_metadata])
+    results_id = uuid.uuid4()
+    search_result = Search(results_id=results_id)
+    minipop.insert(search_result)
+    matcher = SparseMatrixSearch(minipop)
+    v5_matches = matcher.match(search_result,
+                               TextOptions(texts[0], 'line'),
+                               TextOptions(texts[1], 'line'),
+                               'lemmata',
+                               stopwords=['et', 'neque', 'qui'],
+                               stopword_basis='texts',
+                               score_basis='lemmata',
+                               freq_basis='texts',
+                               max_distance=10,
+                               distance_basis='frequency',
+                               min_score=0,
+                               workers=2,
+                               # make sure that there are several source
+                               # batches to spread out, and that targets are
+                               # tiled as well
+                               memory_budget=sparse_encoding.BYTES_PER_HIT *
+                               2 * 20)
+    minipop.insert_nocheck(v5_matches)
+    search_result.status = Search.DONE
+    minipop.update(search_result)
+    v3checker.check_search_results(minipop, search_result.id, texts[0].path,
+                                   'mini_latin_results.tab')
+
+
+def test_mini_latin_match_corpus(minipop, mini_latin_metadata, monkeypatch):
+    # make sure that both targets are stacked into a single block
+    monkeypatch.setattr(sparse_encoding, 'CORPUS_BLOCK_POSITIONS', 10**9)
+    texts = minipop.find(Text.collection,
+                         title=[m['title'] for m in mini_latin_metadata])
+    matcher = SparseMatrixSearch(minipop)
+    options = {
+        'feature': 'lemmata',
+        'stopwords': ['et', 'neque', 'qui'],
+        'stopword_basis': 'texts',
+        'score_basis': 'lemmata',
+        'freq_basis': 'texts',
+        'max_distance': 10,
+        'distance_basis': 'frequency',
+        'min_score': 0
+    }
+
+    def _tuplize(matches):
+        return [(m.source_unit, m.target_unit, m.score, m.matched_features,
+                 m.highlight) for m in matches]
+
+    source = TextOptions(texts[0], 'line')
+    targets = [TextOptions(texts[1], 'line'), TextOptions(texts[1], 'phrase')]
+    searches = [Search(results_id=uuid.uuid4()) for _ in targets]
+    results = list(matcher.match_corpus(searches, source, targets, **options))
+    assert [target for target, _ in results] == targets
+    for search, target, (_, matches) in zip(searches, targets, results):
+        assert all(m.search_id == search.id for m in matches)
+        expected = matcher.match(search, source, target, **options)
+        assert _tuplize(matches) == _tuplize(expected)
+
+
+def test_mini_latin_self_search(minipop, mini_latin_metadata):
+    texts = minipop.find(Text.collection,
+                         title=[m['title'] for m in mini_latin_metadata])
+    unit_indices = {
+        u.id: u.index
+        for u in minipop.find(Unit.collection, text=texts[0].id,
+                              unit_type='line')
+    }
+    matcher = SparseMatrixSearch(minipop)
+    matches = matcher.match(Search(results_id=uuid.uuid4()),
+                            TextOptions(texts[0], 'line'),
+                            None,
+                            'lemmata',
+                            stopwords=['et', 'neque', 'qui'],
+                            stopword_basis='texts',
+                            score_basis='lemmata',
+                            freq_basis='texts',
+                            max_distance=10,
+                            distance_basis='frequency',
+                            min_score=0)
+    assert len(matches) > 0
+    # every pair is found once, with the later unit as the target
+    for m in matches:
+        assert unit_indices[m.target_unit] > unit_indices[m.source_unit]
+
+
 def test_mini_greek_search_text_freqs(minipop, mini_greek_metadata, v3checker):
     texts = minipop.find(Text.collection,
                          title=[m['title'] for m in mini_greek_metadata])
@@ -507,3 +624,120 @@ def test_english(engpop, eng_metadata, v3checker):
     engpop.update(search_result)
     v3checker.check_search_results(engpop, search_result.id, texts[0].path,
                                    'eng_time.tab')
+
+
+def _random_segments(rng, num_segments, unit_size=12):
+    """Make up matched positions for units of made up forms"""
+    all_forms = []
+    all_positions = []
+    offsets = [0]
+    for _ in range(num_segments):
+        forms = rng.integers(0, 6, size=unit_size)
+        positions = rng.integers(0, unit_size, size=rng.integers(0, 20))
+        all_forms.append(forms)
+        all_positions.append(positions)
+        offsets.append(offsets[-1] + len(positions))
+    return all_forms, all_positions, np.array(offsets)
+
+
+def test_distances_by_least_frequency():
+    rng = np.random.default_rng(0)
+    # few distinct inverse frequencies, so that there are plenty of ties
+    inv_freqs = rng.integers(1, 4, size=6).astype(float)
+    all_forms, all_positions, offsets = _random_segments(rng, 2000)
+    expected = [
+        sparse_encoding._get_distance_by_least_frequency(
+            inv_freqs, positions, forms)
+        for forms, positions in zip(all_forms, all_positions)
+    ]
+    positions = np.concatenate(all_positions)
+    matched_forms = np.concatenate([
+        forms[positions] for forms, positions in zip(all_forms, all_positions)
+    ])
+    distances = sparse_encoding._get_distances_by_least_frequency(
+        inv_freqs[matched_forms], positions, matched_forms, offsets)
+    assert distances.tolist() == expected
+
+
+def test_distances_by_span():
+    rng = np.random.default_rng(1)
+    all_forms, all_positions, offsets = _random_segments(rng, 2000)
+    expected = [
+        sparse_encoding._get_distance_by_span(positions, forms)
+        for forms, positions in zip(all_forms, all_positions)
+    ]
+    positions = np.concatenate(all_positions)
+    matched_forms = np.concatenate([
+        forms[positions] for forms, positions in zip(all_forms, all_positions)
+    ])
+    distances = sparse_encoding._get_distances_by_span(
+        positions, matched_forms, offsets)
+    assert distances.tolist() == expected
+
+
+def test_merge_tiles():
+    # the first tile covers target units 0 and 1, the second target unit 2
+    first = (np.array([0, 1, 0]), np.array([0, 0, 1]), np.array([0, 2, 4, 6]),
+             np.array([0, 1, 2, 3, 4, 5]), np.array([10, 11, 12, 13, 14, 15]))
+    second = (np.array([2, 2]), np.array([0, 1]), np.array([0, 2, 5]),
+              np.array([6, 7, 8, 9, 10]), np.array([16, 17, 18, 19, 20]))
+    t_inds, s_inds, offsets, t_positions, s_positions = \
+        sparse_encoding._merge_tile_hits([first, second])
+    assert list(zip(t_inds.tolist(), s_inds.tolist())) == \
+        [(0, 0), (1, 0), (2, 0), (0, 1), (2, 1)]
+    assert offsets.tolist() == [0, 2, 4, 6, 8, 11]
+    assert t_positions.tolist() == [0, 1, 2, 3, 6, 7, 4, 5, 8, 9, 10]
+    assert s_positions.tolist() == \
+        [10, 11, 12, 13, 16, 17, 14, 15, 18, 19, 20]
+    first_scored = (np.array([0, 2]), np.array([1.0, 3.0]), np.array([0, 1, 3]),
+                    np.array([5, 6, 7]))
+    second_scored = (np.array([0, 1]), np.array([2.0, 4.0]),
+                     np.array([0, 2, 3]), np.array([8, 9, 10]))
+    _, (kept, scores, feature_offsets, feature_inds) = \
+        sparse_encoding._merge_tile_scores([(first, first_scored),
+                                            (second, second_scored)])
+    assert kept.tolist() == [0, 2, 3, 4]
+    assert scores.tolist() == [1.0, 2.0, 3.0, 4.0]
+    assert feature_offsets.tolist() == [0, 1, 3, 5, 6]
+    assert feature_inds.tolist() == [5, 8, 9, 6, 7, 10]
+
+
+def test_latin_sound_max_feature_share(minipop, mini_latin_metadata):
+    texts = minipop.find(Text.collection,
+                         title=[m['title'] for m in mini_latin_metadata])
+    matcher = SparseMatrixSearch(minipop)
+
+    def _run(max_feature_share):
+        matches = matcher.match(Search(results_id=uuid.uuid4()),
+                                TextOptions(texts[0], 'line'),
+                                TextOptions(texts[1], 'line'),
+                                'sound',
+                                stopwords=[],
+                                stopword_basis='texts',
+                                score_basis='sound',
+                                freq_basis='texts',
+                                max_distance=999,
+                                distance_basis='frequency',
+                                min_score=0,
+                                max_feature_share=max_feature_share)
+        return sorted((m.source_unit, m.target_unit, m.score,
+                       tuple(m.matched_features)) for m in matches)
+
+    # no feature can be found in more than all of the units
+    assert _run(1.0) == _run(None)
+    units = [
+        _get_units(minipop, TextOptions(text, 'line'), 'sound')
+        for text in texts[:2]
+    ]
+    features_size = minipop.connection[Feature.collection].count_documents(
+        {'language': 'latin', 'feature': 'sound'})
+    capped = sparse_encoding._cap_features([], units, features_size, 0.05)
+    assert capped
+    capped_tokens = set(get_stoplist_tokens(minipop, capped, 'sound',
+                                            'latin'))
+    matches = _run(0.05)
+    assert matches
+    for match in matches:
+        assert not capped_tokens & set(match[3])
+    with pytest.raises(ValueError):
+        _run(0)
@@ -0,0 +1,90 @@
+import uuid
+
+from tesserae.db.entities import AllPairsRow, Search
+from tesserae.matchers.sparse_encoding import SparseMatrixSearch
+from tesserae.utils.allpairs import get_all_pairs_summary, submit_all_pairs
+from tesserae.utils.search import get_results_count
+
+
+class _InlineQueue:
+    """Runs jobs as soon as they are queued"""
+    processes_per_job = 1
+    memory_per_job = None
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.jobs = 0
+
+    def queue_job(self, instructions, kwargs):
+        self.jobs += 1
+        instructions(self.connection, **kwargs)
+
+
+_SEARCH_PARAMS = {
+    'feature': 'lemmata',
+    'stopwords': ['et', 'neque', 'qui'],
+    'stopword_basis': 'corpus',
+    'score_basis': 'lemmata',
+    'freq_basis': 'texts',
+    'max_distance': 10,
+    'distance_basis': 'frequency',
+    'min_score': 0
+}
+
+
+def _get_status(connection, results_id):
+    return connection.find(Search.collection, results_id=results_id)[0]
+
+
+def test_failed_all_pairs(minipop, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('search failed')
+
+    monkeypatch.setattr(SparseMatrixSearch, 'match_corpus', fail)
+    jobqueue = _InlineQueue(minipop)
+    results_id = str(uuid.uuid4())
+    assert submit_all_pairs(jobqueue, minipop, results_id, 'original',
+                            'latin', 'line', _SEARCH_PARAMS) == 2
+    status = _get_status(minipop, results_id)
+    assert status.status == Search.FAILED
+    for row_id in status.parameters['rows']:
+        assert row_id in status.msg
+    for pair in get_all_pairs_summary(minipop, results_id):
+        assert pair['status'] == Search.FAILED
+        assert pair['matches'] is None
+
+
+def test_latin_all_pairs(minipop):
+    jobqueue = _InlineQueue(minipop)
+    results_id = str(uuid.uuid4())
+    searched = submit_all_pairs(jobqueue, minipop, results_id, 'original',
+                                'latin', 'line', _SEARCH_PARAMS)
+    # one row for each of the two texts
+    assert searched == 2
+    assert jobqueue.jobs == 2
+    status = _get_status(minipop, results_id)
+    assert status.status == Search.DONE
+    assert status.progress[-1]['value'] == 1.0
+    # the pairs are kept a row at a time, apart from the job's Search
+    rows = minipop.find(AllPairsRow.collection, all_pairs_id=results_id)
+    assert sorted(row.index for row in rows) == [0, 1]
+    assert all(len(row.pairs) == 1 for row in rows)
+    summary = get_all_pairs_summary(minipop, results_id)
+    assert len(summary) == 2
+    assert {(p['source'], p['target']) for p in summary} == \
+        {(summary[0]['source'], summary[0]['target']),
+         (summary[0]['target'], summary[0]['source'])}
+    for pair in summary:
+        assert pair['status'] == Search.DONE
+        search = minipop.find(Search.collection,
+                              results_id=pair['results_id'])[0]
+        assert pair['matches'] == get_results_count(minipop, search.id)
+        assert pair['matches'] > 0
+
+    # everything is already known, so nothing is searched again
+    again_id = str(uuid.uuid4())
+    assert submit_all_pairs(jobqueue, minipop, again_id, 'original', 'latin',
+                            'line', _SEARCH_PARAMS) == 0
+    assert jobqueue.jobs == 2
+    assert _get_status(minipop, again_id).status == Search.DONE
+    assert get_all_pairs_summary(minipop, again_id) == summary
@@ -1,7 +1,7 @@
 import pytest
 
 from tesserae.db import TessMongoConnection
-from tesserae.db.entities import Feature, Text, Token, Unit
+from tesserae.db.entities import FeatureCounts, Text, Token, Unit
 from tesserae.utils import ingest_text, remove_text
 
 
@@ -31,5 +31,5 @@ def test_remove(removedb, mini_latin_metadata):
     units = removedb.find(Unit.collection)
     assert all([u.text != text_id for u in units])
 
-    features = removedb.find(Feature.collection)
-    assert all([str(text_id) not in f.frequencies for f in features])
+    assert not removedb.find(FeatureCounts.collection, text=text_id)
+    assert removedb.find(FeatureCounts.collection, text=texts[1].id)
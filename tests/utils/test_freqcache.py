@@ -0,0 +1,216 @@
+import glob
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from tesserae.db import TessMongoConnection
+from tesserae.db.entities import Feature, FeatureCounts, Text
+from tesserae.utils import freqcache, ingest_text, remove_text
+from tesserae.utils.calculations import get_corpus_frequencies, \
+    get_inverse_text_frequencies, get_sound_inverse_text_freq
+from tesserae.utils.freqcache import _create_corpus_cache_path, \
+    _create_freq_cache_path, inverse_frequency_table, \
+    load_corpus_frequencies, load_feature_counts, load_inverse_frequencies, \
+    _list_corpus_deltas, load_stoplist, load_stoplist_ranking, \
+    migrate_feature_counts, unregister_frequencies
+from tesserae.utils.stopwords import create_stoplist, get_stoplist_tokens
+
+
+@pytest.fixture
+def freqcachedb(mini_latin_metadata):
+    conn = TessMongoConnection('localhost', 27017, None, None, 'freqcachedb')
+    for metadata in mini_latin_metadata:
+        text = Text.json_decode(metadata)
+        ingest_text(conn, text)
+    yield conn
+    for coll_name in conn.connection.list_collection_names():
+        conn.connection.drop_collection(coll_name)
+    # the next test starts over with a database of the same name
+    for path in glob.glob(_create_corpus_cache_path(conn, '*', '*')):
+        os.remove(path)
+        shutil.rmtree(path[:-len('.npz')] + '_deltas', ignore_errors=True)
+
+
+def test_inverse_frequency_table():
+    table = inverse_frequency_table({0: 2.0, 3: 4.0, -1: 8.0})
+    assert len(table) == 5
+    assert table[0] == 2.0
+    assert table[3] == 4.0
+    assert table[-1] == 8.0
+    assert np.isnan(table[1:3]).all()
+
+
+def test_registered_at_ingest(freqcachedb):
+    for text in freqcachedb.find(Text.collection):
+        for score_basis in ['form', 'lemmata']:
+            assert os.path.isfile(
+                _create_freq_cache_path(text.id, score_basis))
+
+
+def test_load_matches_computation(freqcachedb):
+    text = freqcachedb.find(Text.collection)[0]
+    expected = get_inverse_text_frequencies(freqcachedb, 'lemmata', text.id)
+    table = load_inverse_frequencies(freqcachedb, 'lemmata', text.id)
+    assert np.count_nonzero(~np.isnan(table)) == len(expected)
+    for form_index, inv_freq in expected.items():
+        assert table[form_index] == inv_freq
+
+
+def test_sound_built_on_first_use(freqcachedb):
+    text = freqcachedb.find(Text.collection)[0]
+    path = _create_freq_cache_path(text.id, 'sound')
+    assert not os.path.isfile(path)
+    table = load_inverse_frequencies(freqcachedb, 'sound', text.id)
+    assert os.path.isfile(path)
+    expected = get_sound_inverse_text_freq(freqcachedb, text.id)
+    for sound_index, inv_freq in expected.items():
+        assert table[sound_index] == inv_freq
+
+
+def test_unregister_frequencies(freqcachedb):
+    text = freqcachedb.find(Text.collection)[0]
+    unregister_frequencies(text, 'lemmata')
+    assert not os.path.isfile(_create_freq_cache_path(text.id, 'lemmata'))
+    assert os.path.isfile(_create_freq_cache_path(text.id, 'form'))
+    remove_text(freqcachedb, text)
+    assert not os.path.isfile(_create_freq_cache_path(text.id, 'form'))
+
+
+def test_corpus_frequencies_kept_up_to_date(freqcachedb, mini_latin_metadata):
+    def _check():
+        expected = get_corpus_frequencies(freqcachedb, 'lemmata', 'latin')
+        found = load_corpus_frequencies(freqcachedb, 'lemmata', 'latin')
+        assert np.allclose(found, expected)
+
+    _check()
+    assert os.path.isfile(
+        _create_corpus_cache_path(freqcachedb, 'latin', 'lemmata'))
+    text = freqcachedb.find(Text.collection,
+                            title=mini_latin_metadata[0]['title'])[0]
+    remove_text(freqcachedb, text)
+    _check()
+    ingest_text(freqcachedb, Text.json_decode(mini_latin_metadata[0]))
+    _check()
+
+
+def test_corpus_count_changes_folded_in(freqcachedb, mini_latin_metadata,
+                                        monkeypatch):
+    monkeypatch.setattr(freqcache, 'CORPUS_DELTA_LIMIT', 2)
+
+    def _check(num_deltas):
+        assert len(_list_corpus_deltas(freqcachedb, 'latin',
+                                       'lemmata')) == num_deltas
+        expected = get_corpus_frequencies(freqcachedb, 'lemmata', 'latin')
+        found = load_corpus_frequencies(freqcachedb, 'lemmata', 'latin')
+        assert np.allclose(found, expected)
+
+    _check(0)
+    path = _create_corpus_cache_path(freqcachedb, 'latin', 'lemmata')
+    stamp = os.stat(path).st_mtime_ns
+    text = freqcachedb.find(Text.collection,
+                            title=mini_latin_metadata[0]['title'])[0]
+    remove_text(freqcachedb, text)
+    # the change is kept apart from the stored counts
+    _check(1)
+    assert os.stat(path).st_mtime_ns == stamp
+    ingest_text(freqcachedb, Text.json_decode(mini_latin_metadata[0]))
+    # and folded into them once there are enough changes
+    _check(0)
+
+
+def test_feature_counts_by_basis(freqcachedb):
+    texts = freqcachedb.find(Text.collection)
+    size = len(
+        freqcachedb.find(Feature.collection, language='latin',
+                         feature='lemmata'))
+    for basis in ([texts[0].id], [t.id for t in texts], []):
+        expected = np.zeros(size, dtype=int)
+        for counts in freqcachedb.find(FeatureCounts.collection,
+                                       text=basis,
+                                       feature='lemmata'):
+            expected[counts.indices] += counts.counts
+        found = load_feature_counts(freqcachedb, 'lemmata', 'latin', basis)
+        assert found.tolist() == expected.tolist()
+
+
+def test_migrate_feature_counts(freqcachedb):
+    def _get_counts(text):
+        return {
+            counts.feature: dict(zip(counts.indices, counts.counts))
+            for counts in freqcachedb.find(FeatureCounts.collection,
+                                           text=text.id)
+        }
+
+    text = freqcachedb.find(Text.collection)[0]
+    expected = _get_counts(text)
+    corpus_counts = load_feature_counts(freqcachedb, 'lemmata',
+                                        'latin').tolist()
+    # lay the counts of the text out as older databases did
+    freqcachedb.connection[FeatureCounts.collection].delete_many(
+        {'text': text.id})
+    features = freqcachedb.connection[Feature.collection]
+    for feature, counts in expected.items():
+        for index, count in counts.items():
+            features.update_one(
+                {
+                    'language': text.language,
+                    'feature': feature,
+                    'index': index
+                }, {'$set': {
+                    f'frequencies.{text.id}': count
+                }})
+
+    assert migrate_feature_counts(freqcachedb) == len(expected)
+    assert _get_counts(text) == expected
+    assert features.count_documents({'frequencies': {'$exists': True}}) == 0
+    assert load_feature_counts(freqcachedb, 'lemmata',
+                               'latin').tolist() == corpus_counts
+    # running it again finds nothing left to move
+    assert migrate_feature_counts(freqcachedb) == 0
+    assert _get_counts(text) == expected
+
+
+def test_stoplist_ranking(freqcachedb, mini_latin_metadata):
+    def _check():
+        expected = get_corpus_frequencies(freqcachedb, 'lemmata', 'latin')
+        ranking = load_stoplist_ranking(freqcachedb, 'lemmata', 'latin')
+        assert ranking.tolist() == \
+            np.argsort(-expected, kind='stable').tolist()
+        stoplist = create_stoplist(freqcachedb, 10, 'lemmata', 'latin')
+        assert stoplist.tolist() == ranking[:10].tolist()
+        tokens = {
+            f.index: f.token
+            for f in freqcachedb.find(Feature.collection,
+                                      language='latin',
+                                      feature='lemmata')
+        }
+        assert get_stoplist_tokens(freqcachedb, stoplist, 'lemmata',
+                                   'latin') == [tokens[i] for i in stoplist]
+
+    _check()
+    text = freqcachedb.find(Text.collection,
+                            title=mini_latin_metadata[0]['title'])[0]
+    remove_text(freqcachedb, text)
+    _check()
+    ingest_text(freqcachedb, Text.json_decode(mini_latin_metadata[0]))
+    _check()
+
+
+def test_texts_stoplist(freqcachedb):
+    texts = freqcachedb.find(Text.collection)
+    for basis in ([texts[0]], texts):
+        counts = load_feature_counts(freqcachedb, 'lemmata', 'latin',
+                                     [t.id for t in basis])
+        for n in (1, 10, len(counts) + 1):
+            expected = np.argsort(-counts, kind='stable')[:n]
+            stoplist = create_stoplist(freqcachedb, n, 'lemmata', 'latin',
+                                       basis=basis)
+            assert stoplist.tolist() == expected.tolist()
+            # asking again is answered from memory
+            found = load_stoplist(freqcachedb, 'lemmata', 'latin', n,
+                                  [t.id for t in reversed(basis)])
+            assert found is load_stoplist(freqcachedb, 'lemmata', 'latin', n,
+                                          [t.id for t in basis])
+            assert found.tolist() == expected.tolist()
@@ -1,7 +1,22 @@
-from tesserae.db.entities import Feature, Text, Token, Unit
+from tesserae.db.entities import Feature, FeatureCounts, Text, Token, Unit
 from tesserae.utils.ingest import add_feature
 
 
+def _get_text_counts(connection, text, feature, db_features):
+    """Map feature tokens to how many times they are found in a text"""
+    index_to_token = {f.index: token for token, f in db_features.items()}
+    found = connection.find(FeatureCounts.collection,
+                            text=text.id,
+                            feature=feature)
+    assert len(found) <= 1
+    if not found:
+        return {}
+    return {
+        index_to_token[index]: count
+        for index, count in zip(found[0].indices, found[0].counts)
+    }
+
+
 def test_add_feature(minipop):
     texts = minipop.find(Text.collection)
     feature = 'test'
@@ -27,19 +42,16 @@ def test_add_feature(minipop):
         assert not tokens_in_test_not_in_sound
 
         # make sure frequencies for this text in test are the same in sound
+        test_counts = _get_text_counts(minipop, text, feature,
+                                       db_test_features)
+        assert test_counts
+        sound_counts = _get_text_counts(minipop, text, 'sound',
+                                        db_sound_features)
         discrepancies = []
-        text_id_str = str(text.id)
-        for token, f in db_test_features.items():
-            if text_id_str not in f.frequencies:
-                continue
-            freq = f.frequencies[text_id_str]
-            other_f = db_sound_features[token]
-            if text_id_str in other_f.frequencies:
-                other_freq = other_f.frequencies[text_id_str]
-                if freq != other_freq:
-                    discrepancies.append((token, freq, other_freq))
-            else:
-                discrepancies.append((token, freq, 0))
+        for token, freq in test_counts.items():
+            other_freq = sound_counts.get(token, 0)
+            if freq != other_freq:
+                discrepancies.append((token, freq, other_freq))
         assert not discrepancies
 
         # make sure both test and sound features are stored in the text's units
@@ -0,0 +1,54 @@
+import numpy as np
+
+from tesserae.utils.parallel import \
+    SharedArrays, imap_ordered, resolve_workers
+
+
+def _scaled_sum(context, task):
+    start, end = task
+    return context['scale'] * context['values'][start:end].sum()
+
+
+def _add_doubled(context):
+    context['doubled'] = 2 * context['values']
+    return context
+
+
+def _doubled_sum(context, task):
+    start, end = task
+    return context['doubled'][start:end].sum()
+
+
+def test_resolve_workers():
+    assert resolve_workers(None) == 1
+    assert resolve_workers(1) == 1
+    assert resolve_workers(3) == 3
+    assert resolve_workers(0) >= 1
+    assert resolve_workers(-1) >= 1
+
+
+def test_imap_ordered():
+    values = np.arange(1000, dtype=np.int64)
+    tasks = [(start, start + 7) for start in range(0, 1000, 7)]
+    expected = [3 * values[start:end].sum() for start, end in tasks]
+    with SharedArrays({'values': values}, {'scale': 3}) as shared:
+        results = list(imap_ordered(_scaled_sum, tasks, shared, 3))
+    assert results == expected
+
+
+def test_imap_ordered_setup():
+    values = np.arange(100, dtype=np.float64)
+    tasks = [(start, start + 10) for start in range(0, 100, 10)]
+    expected = [2 * values[start:end].sum() for start, end in tasks]
+    with SharedArrays({'values': values}) as shared:
+        results = list(
+            imap_ordered(_doubled_sum, tasks, shared, 2, setup=_add_doubled))
+    assert results == expected
+
+
+def test_shared_arrays_empty():
+    with SharedArrays({'values': np.zeros(0, dtype=np.int64)},
+                      {'scale': 1}) as shared:
+        results = list(
+            imap_ordered(_scaled_sum, [(0, 0)], shared, 2))
+    assert results == [0]
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from tesserae.db import TessMongoConnection
+from tesserae.db.entities import Text
+from tesserae.utils import ingest_text, remove_text
+from tesserae.utils.unitcache import CompiledUnits, _create_unit_cache_path, \
+    _query_units, load_units, unregister_units
+
+
+@pytest.fixture
+def unitcachedb(mini_latin_metadata):
+    conn = TessMongoConnection('localhost', 27017, None, None, 'unitcachedb')
+    for metadata in mini_latin_metadata:
+        text = Text.json_decode(metadata)
+        ingest_text(conn, text)
+    yield conn
+    for coll_name in conn.connection.list_collection_names():
+        conn.connection.drop_collection(coll_name)
+
+
+def test_registered_at_ingest(unitcachedb):
+    for text in unitcachedb.find(Text.collection):
+        for feature in ['form', 'lemmata']:
+            assert os.path.isdir(
+                _create_unit_cache_path(text.id, 'line', feature))
+            assert os.path.isdir(
+                _create_unit_cache_path(text.id, 'phrase', feature))
+
+
+def test_load_units_matches_query(unitcachedb):
+    text = unitcachedb.find(Text.collection)[0]
+    for unit_type in ['line', 'phrase']:
+        expected = _query_units(unitcachedb, text.id, unit_type, 'lemmata')
+        units = load_units(unitcachedb, text, unit_type, 'lemmata')
+        assert isinstance(units, CompiledUnits)
+        assert len(units) == len(expected)
+        assert list(units) == expected
+        assert list(units[1:4]) == expected[1:4]
+        assert units.column('_id') == [u['_id'] for u in expected]
+
+
+def test_load_units_built_on_first_use(unitcachedb):
+    text = unitcachedb.find(Text.collection)[0]
+    path = _create_unit_cache_path(text.id, 'line', 'semantic')
+    assert not os.path.isdir(path)
+    units = load_units(unitcachedb, text, 'line', 'semantic')
+    assert os.path.isdir(path)
+    assert list(units) == _query_units(unitcachedb, text.id, 'line',
+                                       'semantic')
+
+
+def test_unregister_units(unitcachedb):
+    text = unitcachedb.find(Text.collection)[0]
+    unregister_units(text, 'lemmata')
+    assert not os.path.isdir(
+        _create_unit_cache_path(text.id, 'line', 'lemmata'))
+    assert os.path.isdir(_create_unit_cache_path(text.id, 'line', 'form'))
+    remove_text(unitcachedb, text)
+    assert not os.path.isdir(_create_unit_cache_path(text.id, 'line', 'form'))